@@ -0,0 +1,103 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+import sys
+
+from oslo_config import cfg
+
+from distil import config
+from distil.common import constants
+from distil.common import openstack
+from distil import exceptions as exc
+from distil.service import backfill
+from distil.service import collector
+
+CONF = cfg.CONF
+
+CLI_OPTS = [
+    cfg.MultiStrOpt('project-id', default=[],
+                    help=('ID of a project to backfill, can be repeated. '
+                          'Defaults to all projects, filtered like '
+                          'distil-collector does.')),
+    cfg.StrOpt('start',
+               help=('The time that --rerate rewinds projects to. Usage '
+                     'of projects not collected yet starts from it, within '
+                     'max_collection_start_age. Time format is '
+                     'YYYY-MM-DDTHH:MM:SS')),
+    cfg.StrOpt('end', required=True,
+               help=('The time to collect usage up to. Time format is '
+                     'YYYY-MM-DDTHH:MM:SS')),
+    cfg.IntOpt('workers', default=4, min=1,
+               help=('The number of processes collecting usage at once, '
+                     'one project each.')),
+    cfg.IntOpt('span-windows', default=24, min=1,
+               help=('The number of windows collected at once for a '
+                     'project, before reporting progress.')),
+    cfg.IntOpt('span-timeout', default=3600, min=0,
+               help=('The time, in seconds, after which a span still in '
+                     'progress is treated as lost, e.g. as its worker '
+                     'died, and the backfill stops. 0 means no timeout.')),
+    cfg.BoolOpt('rerate', default=False,
+                help=('Delete the usage of the projects from --start '
+                      'onwards and collect it again, e.g. after a change '
+                      'of the meter mappings. To carry on with an '
+                      'interrupted re-rating, run the backfill again '
+                      'without --rerate.')),
+]
+
+CONF.register_cli_opts(CLI_OPTS)
+
+
+def _parse_time(value):
+    return datetime.strptime(value, constants.iso_time) if value else None
+
+
+def main():
+    config.parse_args(sys.argv[1:], 'distil-backfill')
+
+    if CONF.rerate and not CONF.start:
+        raise SystemExit('You must provide --start with --rerate')
+
+    projects = openstack.get_projects(domains=CONF.collector.include_domains)
+    if CONF.project_id:
+        projects = [p for p in projects if p['id'] in CONF.project_id]
+        missing = set(CONF.project_id) - set(p['id'] for p in projects)
+        if missing:
+            raise SystemExit('Unknown projects: %s' %
+                             ', '.join(sorted(missing)))
+    else:
+        projects = collector.filter_projects(projects)
+
+    try:
+        backfiller = backfill.Backfill(
+            projects,
+            _parse_time(CONF.end),
+            start=_parse_time(CONF.start),
+            workers=CONF.workers,
+            span_windows=CONF.span_windows,
+            rerate=CONF.rerate,
+            span_timeout=CONF.span_timeout,
+        )
+    except exc.DateTimeException as e:
+        raise SystemExit(str(e))
+
+    succeeded = backfiller.run()
+
+    sys.exit(0 if succeeded else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,13 +14,20 @@
 # limitations under the License.
 
 import abc
+import bisect
+import collections
 import hashlib
+import itertools
 import re
+import timeit
 
+from datetime import datetime
 from datetime import timedelta
 
 import jmespath
+from jmespath import visitor as jmespath_visitor
 import six
+import eventlet
 import yaml
 
 from oslo_config import cfg
@@ -28,15 +35,52 @@ from oslo_log import log as logging
 
 from distil.db import api as db_api
 from distil import exceptions as exc
+from distil.collector.metrics.base import StageTimings
 from distil import transformer as d_transformer
+from distil.transformer import arithmetic
 from distil.common import constants
 from distil.common import openstack
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+# Maximum number of resources transformed together when streaming samples,
+# bounding the size of the IN clause used to look up known resources.
+_STREAM_RESOURCE_BATCH_SIZE = 500
+
+# Interpreter shared by all compiled jmespath expressions. It is stateless
+# apart from its node visitor method cache, which is what makes reusing it
+# cheaper than jmespath.search.
+_JMESPATH_INTERPRETER = jmespath_visitor.TreeInterpreter()
+
+# A meter mapping compiled into its collection plan.
+#
+# meter: The name of the meter to get samples for.
+# service: The default service name of the usage entries.
+# type: The resource type.
+# unit: The unit of the usage entries.
+# res_id_template: Template used to build the resource ID from the sample.
+# transformer: The transformer instance used to transform samples.
+# filters: Compiled jmespath expressions samples must all match.
+# volume_sources: Lists of compiled jmespath expressions to get the sample
+#                 volume from, applied in order.
+# volume_fixed: Fixed volume to set on all samples, or None.
+# metadata: Tuples of (field, sources, template) to get resource info from.
+MeterMapping = collections.namedtuple(
+    'MeterMapping',
+    ['meter', 'service', 'type', 'unit', 'res_id_template', 'transformer',
+     'transformer_name', 'filters', 'volume_sources', 'volume_fixed',
+     'metadata'],
+)
+
 
 class BaseCollector(object):
+    # Whether the samples returned by get_meter keep their own timestamps,
+    # so that the samples of several windows fetched at once can be split
+    # into windows locally, as in catch-up mode. Collectors aggregating the
+    # samples of the given range (e.g. Gnocchi) must leave it False.
+    supports_catch_up = False
+
     def __init__(self, metrics_processors=[]):
         # Meter-to-service mapping, stored as a YAML file.
         meter_file = CONF.collector.meter_mappings_file
@@ -45,48 +89,233 @@ class BaseCollector(object):
                 self.meter_mappings = yaml.safe_load(f)
             except yaml.YAMLError:
                 raise exc.InvalidConfig("Invalid yaml file: %s" % meter_file)
+        # Meter mappings compiled once, so that expressions are not parsed
+        # and transformers are not loaded for every project window.
+        self.mapping_plans = tuple(
+            self._compile_mapping(mapping) for mapping in self.meter_mappings
+        )
         # Metrics processors, managed by the collector service.
         # Used to publish project-specific metrics.
         self.metrics_processors = metrics_processors
+        # NOTE(flwang): When posting samples by ceilometer REST API, it
+        # will use the format <tenant_id>:<source_name_from_user>
+        # so we need to use a regex to recognize it.
+        # All trusted source patterns are matched with a single regex, and
+        # the verdict is remembered for each (of the few) distinct sources.
+        trust_sources = CONF.collector.trust_sources
+        self._trust_sources_re = (
+            re.compile('|'.join('(?:%s)' % source
+                                for source in trust_sources))
+            if trust_sources else None
+        )
+        self._trusted_sources = {}
+
+    @classmethod
+    def _compile_mapping(cls, mapping):
+        """Compile a meter mapping from the YAML file into a MeterMapping."""
+        try:
+            filters = tuple(
+                jmespath.compile(expression)
+                for expression in (mapping.get('filters') or [])
+            )
+
+            volume_sources = []
+            volume_fixed = None
+            volume_config = mapping.get('volume')
+            if volume_config:
+                if isinstance(volume_config, dict):
+                    for key in ("sources", "source"):
+                        if volume_config.get(key):
+                            volume_sources.append(
+                                cls._compile_expressions(volume_config[key]))
+                else:
+                    volume_fixed = float(volume_config)
+
+            metadata = tuple(
+                (field, tuple(parameters['sources']),
+                 parameters.get('template'))
+                for field, parameters in mapping['metadata'].items()
+            )
+
+            transformer = d_transformer.get_transformer(
+                mapping['transformer'],
+                override_config=mapping.get('transformer_config', {}))
+
+            return MeterMapping(
+                meter=mapping['meter'],
+                service=mapping.get('service', mapping['meter']),
+                type=mapping['type'],
+                unit=mapping['unit'],
+                res_id_template=mapping.get('res_id_template', '%s'),
+                transformer=transformer,
+                transformer_name=mapping['transformer'],
+                filters=filters,
+                volume_sources=tuple(volume_sources),
+                volume_fixed=volume_fixed,
+                metadata=metadata,
+            )
+        except (KeyError, TypeError, ValueError,
+                jmespath.exceptions.JMESPathError) as e:
+            raise exc.InvalidConfig(
+                "Invalid meter mapping for meter %s: %s" %
+                (mapping.get('meter'), e)
+            )
+
+    @classmethod
+    def _compile_expressions(cls, expression):
+        """Compile a search expression, or a list of search expressions."""
+        if isinstance(expression, six.string_types):
+            return jmespath.compile(expression)
+        return [jmespath.compile(expr) for expr in expression]
 
     @abc.abstractmethod
     def get_meter(self, project, meter, start, end):
         raise NotImplementedError
 
-    def collect_usage(self, project, windows):
+    def get_meters(self, project_id, meters, start, end, timings=None):
+        """Get samples of several meters, grouped by meter name.
+
+        The default implementation calls get_meter once per distinct meter.
+        Collectors able to fetch several meters at once should override it.
+
+        :param timings: StageTimings to add the time spent getting the
+            samples of each meter to, as the get_meter stage.
+        :return: A dict mapping each meter name to its list of samples.
+        """
+        if timings is None:
+            timings = StageTimings()
+        usage_by_meter = {}
+        for meter in meters:
+            if meter not in usage_by_meter:
+                with timings.time('get_meter', meter=meter):
+                    usage_by_meter[meter] = self.get_meter(project_id, meter,
+                                                           start, end)
+        return usage_by_meter
+
+    def iter_meter(self, project_id, meter, start, end):
+        """Iterate over the samples of a meter, resource by resource.
+
+        All samples of a resource must be yielded together, in ascending
+        timestamp order. The default implementation gets all samples with
+        get_meter and sorts them by resource. Collectors able to page samples
+        from the backend in that order should override it.
+        """
+        samples = self.get_meter(project_id, meter, start, end)
+        # The sort is stable, so samples keep their timestamp order.
+        return iter(sorted(samples, key=lambda s: s['resource_id']))
+
+    def get_active_projects(self, start, end):
+        """Get the IDs of the projects with samples between start and end.
+
+        The default implementation returns None, as not all collectors can
+        tell which projects have samples without querying each of them, in
+        which case no project is treated as idle.
+
+        :return: A set of project IDs, or None.
+        """
+        return None
+
+    def collect_usage(self, project, windows, check_last_collected=False,
+                      deadline=None):
         """Collect usage for specific tenant.
 
+        :param check_last_collected: Only store the usage of each window if
+            the project's last collected time is still the window's start.
+            Windows collected in the meantime, e.g. by another collector,
+            are then skipped along with the following ones.
+        :param deadline: The UTC datetime after which no more windows are
+            started. At least the first window is always collected, the
+            following ones are left to a later collection.
         :return: True if no error happened otherwise return False.
         """
         LOG.info('collect_usage by %s for project: %s(%s)' %
                  (self.__class__.__name__, project['id'], project['name']))
 
-        for window_start, window_end in windows:
+        project_start = timeit.default_timer()
+        try:
+            return self._collect_windows_usage(project, windows,
+                                               check_last_collected, deadline)
+        finally:
+            self._publish_duration('project_duration',
+                                   timeit.default_timer() - project_start,
+                                   project_id=project['id'])
+
+    def _collect_windows_usage(self, project, windows, check_last_collected,
+                               deadline=None):
+        # In catch-up mode, the samples of all windows are fetched at once,
+        # and each window then gets its own share of them.
+        usage_by_window = None
+        timings = StageTimings()
+        if (CONF.collector.catch_up and self.supports_catch_up and
+                len(windows) > 1 and not CONF.collector.stream_samples):
+            try:
+                usage_by_window = self._get_usage_by_window(
+                    project['id'], windows, timings=timings)
+            except Exception as e:
+                LOG.exception(
+                    "Collection failed for %s(%s) in windows: %s - %s, "
+                    "reason: %s", project['id'], project['name'],
+                    windows[0][0].strftime(constants.iso_time),
+                    windows[-1][1].strftime(constants.iso_time),
+                    str(e)
+                )
+                return False
+
+        for index, (window_start, window_end) in enumerate(windows):
+            if index and deadline and datetime.utcnow() >= deadline:
+                LOG.info("Deadline passed, leaving project %s(%s) from "
+                         "window %s to the next collection.", project['id'],
+                         project['name'],
+                         window_start.strftime(constants.iso_time))
+                return True
+
             LOG.info("Project %s(%s) slice %s %s", project['id'],
                      project['name'], window_start, window_end)
 
             resources = {}
             usage_entries = []
+            window_timer = timeit.default_timer()
 
             try:
-                for mapping in self.meter_mappings:
-                    # Invoke get_meter function of specific collector.
-                    usage = self.get_meter(project['id'], mapping['meter'],
-                                           window_start, window_end)
-
-                    usage_by_resource = {}
-                    self._filter_and_group(usage, usage_by_resource)
-                    self._transform_usages(project['id'], usage_by_resource,
-                                           mapping, window_start, window_end,
-                                           resources, usage_entries)
+                if CONF.collector.stream_samples:
+                    self._transform_streamed_usages(
+                        project['id'], window_start, window_end, resources,
+                        usage_entries, timings=timings)
+                else:
+                    self._transform_window_usages(
+                        project['id'], window_start, window_end, resources,
+                        usage_entries,
+                        usage_by_meter=(usage_by_window[index]
+                                        if usage_by_window else None),
+                        timings=timings)
 
                 # Insert resources and usage_entries, and update last collected
                 # time of project within one session.
-                db_api.usages_add(project['id'], resources, usage_entries,
-                                  window_end)
+                with timings.time('usages_add'):
+                    db_api.usages_add(
+                        project['id'], resources, usage_entries, window_end,
+                        window_start if check_last_collected else None)
+
+                self._publish_usage(project['id'], window_start, window_end,
+                                    usage_entries)
+
+                # The stages of the window, and in catch-up mode the samples
+                # fetched for all windows with the first one, are published
+                # once the window is stored.
+                timings.publish(self.metrics_processors)
+                timings = StageTimings()
+                self._publish_duration(
+                    'window_duration', timeit.default_timer() - window_timer,
+                    project_id=project['id'], start=window_start,
+                    end=window_end)
 
                 LOG.info('Finish project %s(%s) slice %s %s', project['id'],
                          project['name'], window_start, window_end)
+            except exc.DuplicateException as e:
+                LOG.info("Skipping project %s(%s) from window %s: %s",
+                         project['id'], project['name'],
+                         window_start.strftime(constants.iso_time), str(e))
+                return True
             except Exception as e:
                 LOG.exception(
                     "Collection failed for %s(%s) in window: %s - %s, reason: "
@@ -99,25 +328,377 @@ class BaseCollector(object):
 
         return True
 
+    def _publish_usage(self, project_id, start, end, usage_entries):
+        """Publish the stored usage of a window to all metrics processors.
+
+        The volumes are added up by service and unit, and each metrics
+        processor gets them with a single usage_batch call, on a background
+        green thread if async_metrics_dispatch is enabled.
+        """
+        if not self.metrics_processors or not usage_entries:
+            return
+
+        totals = collections.OrderedDict()
+        for entry in usage_entries:
+            key = (entry['service'], entry['unit'])
+            totals[key] = totals.get(key, 0) + entry['volume']
+        usages = [(service, unit, volume)
+                  for (service, unit), volume in totals.items()]
+
+        for metrics_processor in self.metrics_processors:
+            if CONF.collector.async_metrics_dispatch:
+                eventlet.spawn_n(_dispatch_usage_batch, metrics_processor,
+                                 project_id, start, end, usages)
+            else:
+                _dispatch_usage_batch(metrics_processor, project_id, start,
+                                      end, usages)
+
+    def _publish_duration(self, method, duration, **kwargs):
+        """Publish a collection duration to all metrics processors."""
+        for metrics_processor in self.metrics_processors:
+            getattr(metrics_processor, method)(duration=duration, **kwargs)
+
+    def _get_usage_by_window(self, project_id, windows, timings=None):
+        """Get the samples of consecutive windows with one get_meters call.
+
+        :return: A list holding, for each window, a dict mapping each meter
+                 name to the samples of the window.
+        """
+        usage_by_meter = self.get_meters(
+            project_id,
+            [mapping.meter for mapping in self.mapping_plans],
+            windows[0][0],
+            windows[-1][1],
+            timings=timings,
+        )
+
+        window_starts = [start.strftime(constants.date_format)
+                         for start, _end in windows]
+        span_end = windows[-1][1].strftime(constants.date_format)
+        usage_by_window = [
+            dict((meter, []) for meter in usage_by_meter) for _w in windows
+        ]
+
+        for meter, samples in usage_by_meter.items():
+            for sample in samples:
+                timestamp = sample['timestamp']
+                if not isinstance(timestamp, six.string_types):
+                    timestamp = timestamp.strftime(constants.date_format)
+                # NOTE: Window boundaries are whole seconds, so comparing
+                # the timestamps down to the second is enough.
+                timestamp = timestamp[:19]
+                if timestamp >= span_end:
+                    continue
+                index = bisect.bisect_right(window_starts, timestamp) - 1
+                if index >= 0:
+                    usage_by_window[index][meter].append(sample)
+
+        return usage_by_window
+
+    def _transform_window_usages(self, project_id, window_start, window_end,
+                                 resources, usage_entries,
+                                 usage_by_meter=None, timings=None):
+        """Transform the usage of a window, with all its samples at once.
+
+        The samples of the window are fetched with get_meters, unless they
+        are given in usage_by_meter.
+        """
+        if timings is None:
+            timings = StageTimings()
+
+        if usage_by_meter is None:
+            # Invoke get_meters function of specific collector, to get
+            # the samples of every mapped meter for this window.
+            usage_by_meter = self.get_meters(
+                project_id,
+                [mapping.meter for mapping in self.mapping_plans],
+                window_start,
+                window_end,
+                timings=timings,
+            )
+
+        # Look up which of the window's resources are already known,
+        # once for the whole window rather than once per resource.
+        known_resource_ids = self._get_known_resource_ids(
+            project_id, usage_by_meter)
+
+        if CONF.collector.prefetch_os_distro:
+            self._prefetch_os_distro(project_id, usage_by_meter,
+                                     known_resource_ids)
+
+        if CONF.collector.prefetch_volume_types:
+            self._prefetch_volume_types(project_id, usage_by_meter)
+
+        if CONF.collector.prefetch_container_policies:
+            self._prefetch_container_policies(project_id, usage_by_meter)
+
+        untrusted = collections.Counter()
+        for mapping in self.mapping_plans:
+            usage = usage_by_meter.get(mapping.meter, [])
+
+            usage_by_resource = {}
+            with timings.time('filter_group', meter=mapping.meter):
+                untrusted.update(
+                    self._filter_and_group(usage, usage_by_resource))
+            self._transform_usages(project_id, usage_by_resource,
+                                   mapping, window_start, window_end,
+                                   resources, usage_entries,
+                                   known_resource_ids, timings=timings)
+
+        self._report_untrusted_samples(project_id, untrusted)
+
+    def _transform_streamed_usages(self, project_id, window_start, window_end,
+                                   resources, usage_entries, timings=None):
+        """Transform the usage of a window, streaming samples per resource.
+
+        The samples of each meter are read with iter_meter, and transformed
+        in batches of complete resources, so that only a batch of resources'
+        samples is held in memory at once rather than the whole window.
+        """
+        if timings is None:
+            timings = StageTimings()
+
+        mappings_by_meter = collections.OrderedDict()
+        for mapping in self.mapping_plans:
+            mappings_by_meter.setdefault(mapping.meter, []).append(mapping)
+
+        untrusted = collections.Counter()
+        for meter, mappings in mappings_by_meter.items():
+            samples = timings.iterate(
+                self.iter_meter(project_id, meter, window_start, window_end),
+                'get_meter', meter=meter)
+            for usage_by_resource in self._iter_resource_batches(
+                    samples, untrusted, timings=timings, meter=meter):
+                # The latest sample of each resource is enough to look up
+                # known resources and prefetch OS distro info, volume types
+                # and container policies.
+                batch = {
+                    meter: [entries[-1]
+                            for entries in usage_by_resource.values()],
+                }
+                known_resource_ids = self._get_known_resource_ids(
+                    project_id, batch)
+
+                if CONF.collector.prefetch_os_distro:
+                    self._prefetch_os_distro(project_id, batch,
+                                             known_resource_ids)
+
+                if CONF.collector.prefetch_volume_types:
+                    self._prefetch_volume_types(project_id, batch)
+
+                if CONF.collector.prefetch_container_policies:
+                    self._prefetch_container_policies(project_id, batch)
+
+                for mapping in mappings:
+                    self._transform_usages(project_id, usage_by_resource,
+                                           mapping, window_start, window_end,
+                                           resources, usage_entries,
+                                           known_resource_ids,
+                                           timings=timings)
+
+        self._report_untrusted_samples(project_id, untrusted)
+
+    def _iter_resource_batches(self, samples, untrusted, timings=None,
+                               meter=""):
+        """Group samples streamed resource by resource into batches.
+
+        Each batch holds the trusted samples of complete resources, by
+        resource ID, and is yielded once it holds sample_page_size samples
+        or _STREAM_RESOURCE_BATCH_SIZE resources. Untrusted samples are
+        counted by source in the given untrusted Counter.
+        """
+        if timings is None:
+            timings = StageTimings()
+
+        seen_resource_ids = set()
+        usage_by_resource = collections.OrderedDict()
+        sample_count = 0
+
+        for resource_id, group in itertools.groupby(
+                samples, key=lambda s: s['resource_id']):
+            # Resources are only complete if all their samples come together.
+            if resource_id in seen_resource_ids:
+                raise exc.IncorrectStateError(
+                    "Samples of resource %s were not streamed together." %
+                    resource_id
+                )
+            seen_resource_ids.add(resource_id)
+
+            # The samples of the resource are read before filtering them,
+            # so that fetching them is not timed as part of it.
+            group = list(group)
+            with timings.time('filter_group', meter=meter):
+                untrusted.update(
+                    self._filter_and_group(group, usage_by_resource))
+            sample_count += len(usage_by_resource.get(resource_id, ()))
+
+            if (sample_count >= CONF.collector.sample_page_size or
+                    len(usage_by_resource) >= _STREAM_RESOURCE_BATCH_SIZE):
+                yield usage_by_resource
+                usage_by_resource = collections.OrderedDict()
+                sample_count = 0
+
+        if usage_by_resource:
+            yield usage_by_resource
+
     def _filter_and_group(self, usage, usage_by_resource):
-        trust_sources = set(CONF.collector.trust_sources)
+        """Group samples by resource, discarding untrusted samples.
+
+        :return: A Counter of the untrusted samples discarded, by source.
+        """
+        untrusted = collections.Counter()
+        trust_sources_re = self._trust_sources_re
+        trusted_sources = self._trusted_sources
+
         for u in usage:
             # if we have a list of trust sources configured, then
             # discard everything not matching.
-            # NOTE(flwang): When posting samples by ceilometer REST API, it
-            # will use the format <tenant_id>:<source_name_from_user>
-            # so we need to use a regex to recognize it.
-            if (trust_sources and
-                    all([not re.match(source, u['source'])
-                         for source in trust_sources])):
-                LOG.warning('Ignoring untrusted usage sample from source `%s`',
-                            u['source'])
-                continue
+            if trust_sources_re is not None:
+                source = u['source']
+                trusted = trusted_sources.get(source)
+                if trusted is None:
+                    trusted = trust_sources_re.match(source) is not None
+                    trusted_sources[source] = trusted
+                if not trusted:
+                    untrusted[source] += 1
+                    continue
 
             resource_id = u['resource_id']
             entries = usage_by_resource.setdefault(resource_id, [])
             entries.append(u)
 
+        return untrusted
+
+    def _report_untrusted_samples(self, project_id, untrusted):
+        """Publish the counts of untrusted samples discarded for a project."""
+        for source, count in untrusted.items():
+            LOG.debug('Ignored %s untrusted usage samples from source `%s` '
+                      'for project %s', count, source, project_id)
+            for metrics_processor in self.metrics_processors:
+                metrics_processor.untrusted_samples(
+                    project_id=project_id,
+                    source=source,
+                    count=count,
+                )
+
+    @classmethod
+    def _get_resource_id(cls, mapping, resource_id):
+        """Get the ID a sample's resource is stored under in the DB."""
+        res_id = mapping.res_id_template % resource_id
+        # NOTE(flwang): Swift container IDs can be too long for the resource
+        # ID column, so they are hashed. See _transform_usages for details.
+        if mapping.type == "Object Storage Container":
+            res_id = hashlib.md5(res_id.encode('utf-8')).hexdigest()
+        return res_id
+
+    def _get_known_resource_ids(self, project_id, usage_by_meter):
+        """Get the IDs of the window's resources that already exist."""
+        resource_ids = set()
+        for mapping in self.mapping_plans:
+            for sample in usage_by_meter.get(mapping.meter, []):
+                resource_ids.add(
+                    self._get_resource_id(mapping, sample['resource_id']))
+
+        if not resource_ids:
+            return set()
+
+        return set(
+            res.id for res in
+            db_api.resource_get_by_ids(project_id, list(resource_ids))
+        )
+
+    def _prefetch_os_distro(self, project_id, usage_by_meter,
+                            known_resource_ids):
+        """Prefetch what is needed to get the OS distro of new instances."""
+        image_ids = set()
+        new_instances = False
+
+        for mapping in self.mapping_plans:
+            if mapping.type != 'Virtual Machine':
+                continue
+            for sample in usage_by_meter.get(mapping.meter, []):
+                res_id = self._get_resource_id(mapping, sample['resource_id'])
+                if res_id in known_resource_ids:
+                    continue
+                new_instances = True
+                image_url = sample.get('metadata', {}).get('image_ref_url')
+                if image_url and image_url != 'None':
+                    image_ids.add(image_url.split('/')[-1])
+
+        if not new_instances:
+            return
+
+        try:
+            openstack.prefetch_os_distro_info(project_id, image_ids)
+        except Exception as e:
+            # Not fatal, the OS distro of each instance is then looked up
+            # separately.
+            LOG.warning(
+                'Error occurred when prefetching OS distro info for project '
+                '%s, reason: %s' % (project_id, str(e))
+            )
+
+    def _prefetch_volume_types(self, project_id, usage_by_meter):
+        """Prefetch the volume types the volume transformers look up."""
+        volume_ids = set()
+        volume_types = set()
+
+        for mapping in self.mapping_plans:
+            if isinstance(mapping.transformer,
+                          arithmetic.DatabaseVolumeMaxTransformer):
+                key, keys = 'volume_id', volume_ids
+            elif isinstance(mapping.transformer,
+                            arithmetic.BlockStorageMaxTransformer):
+                key, keys = 'volume_type', volume_types
+            else:
+                continue
+            for sample in usage_by_meter.get(mapping.meter, []):
+                value = sample.get('metadata', {}).get(key)
+                if value:
+                    keys.add(value)
+
+        if not volume_ids and not volume_types:
+            return
+
+        try:
+            openstack.prefetch_volume_types(project_id, volume_ids,
+                                            volume_types)
+        except Exception as e:
+            # Not fatal, the volume type of each volume is then looked up
+            # separately.
+            LOG.warning(
+                'Error occurred when prefetching volume types for project '
+                '%s, reason: %s' % (project_id, str(e))
+            )
+
+    def _prefetch_container_policies(self, project_id, usage_by_meter):
+        """Prefetch the storage policies of the window's containers."""
+        container_names = set()
+
+        for mapping in self.mapping_plans:
+            if not isinstance(mapping.transformer,
+                              arithmetic.ObjectStorageMaxTransformer):
+                continue
+            for sample in usage_by_meter.get(mapping.meter, []):
+                # Container resource IDs are '<project_id>/<container>'.
+                parts = sample['resource_id'].split('/', 1)
+                if len(parts) == 2:
+                    container_names.add(parts[1])
+
+        if not container_names:
+            return
+
+        try:
+            openstack.prefetch_container_policies(project_id,
+                                                  container_names)
+        except Exception as e:
+            # Not fatal, the policy of each container is then looked up
+            # separately.
+            LOG.warning(
+                'Error occurred when prefetching container policies for '
+                'project %s, reason: %s' % (project_id, str(e))
+            )
+
     def _get_os_distro(self, entry):
         """Gets os distro info for instance.
 
@@ -129,21 +710,21 @@ class BaseCollector(object):
            use default value('unknown').
         """
         os_distro = 'unknown'
-        root_vol = None
+        image_meta = None
 
         try:
             # Check if the VM is booted from volume first. When VM is booted
             # from a windows image and do a rebuild using a linux image, the
             # 'image_ref' property will be set inappropriately.
-            root_vol = openstack.get_root_volume(entry['resource_id'])
+            image_meta = openstack.get_root_volume_image_metadata(
+                entry['resource_id'])
         except Exception as e:
             LOG.warning(
                 'Error occurred when getting root_volume for %s, reason: %s' %
                 (entry['resource_id'], str(e))
             )
 
-        if root_vol:
-            image_meta = getattr(root_vol, 'volume_image_metadata', {})
+        if image_meta is not None:
             os_distro = image_meta.get('os_distro', 'unknown')
         else:
             # 'image_ref_url' is always there no matter it is sample created by
@@ -156,11 +737,8 @@ class BaseCollector(object):
                 image_id = image_url.split('/')[-1]
 
                 try:
-                    os_distro = getattr(
-                        openstack.get_image(image_id),
-                        'os_distro',
-                        'unknown'
-                    )
+                    os_distro = (openstack.get_image_os_distro(image_id) or
+                                 'unknown')
                 except Exception as e:
                     LOG.warning(
                         'Error occurred when getting image %s, reason: %s' %
@@ -170,16 +748,15 @@ class BaseCollector(object):
         return os_distro
 
     def _get_resource_info(self, project_id, resource_id, resource_type, entry,
-                           defined_meta):
+                           defined_meta, known_resource_ids):
         resource_info = {'type': resource_type}
 
-        for field, parameters in defined_meta.items():
-            for source in parameters['sources']:
+        for field, sources, template in defined_meta:
+            for source in sources:
                 try:
                     value = entry['metadata'][source]
                     resource_info[field] = (
-                        parameters['template'] % value
-                        if 'template' in parameters else value
+                        template % value if template is not None else value
                     )
                     break
                 except KeyError:
@@ -188,7 +765,7 @@ class BaseCollector(object):
                     pass
 
         # If the resource is already created, don't update properties below.
-        if not db_api.resource_get_by_ids(project_id, [resource_id]):
+        if resource_id not in known_resource_ids:
             if resource_type == 'Virtual Machine':
                 resource_info['os_distro'] = self._get_os_distro(entry)
             if resource_type == 'Object Storage Container':
@@ -204,60 +781,43 @@ class BaseCollector(object):
         return resource_info
 
     def _transform_usages(self, project_id, usage_by_resource, mapping,
-                          window_start, window_end, resources, usage_entries):
-        service = (mapping['service'] if 'service' in mapping
-                   else mapping['meter'])
-
-        transformer = d_transformer.get_transformer(
-            mapping['transformer'],
-            override_config=mapping.get('transformer_config', {}))
+                          window_start, window_end, resources, usage_entries,
+                          known_resource_ids, timings=None):
+        service = mapping.service
+        transformer = mapping.transformer
+        if timings is None:
+            timings = StageTimings()
 
         for res_id, entries in usage_by_resource.items():
-            res_id = mapping.get('res_id_template', '%s') % res_id
+            res_id = mapping.res_id_template % res_id
 
             # NOTE(callumdickinson): If one or more meter mapping filters are
             # defined, use them to drop samples that should not be considered
             # when creating usage entries.
-            if "filters" in mapping and mapping["filters"]:
+            if mapping.filters:
                 entries = (
                     sample
                     for sample in entries
-                    if self._sample_filter(mapping["filters"], sample)
+                    if self._sample_filter(mapping.filters, sample)
                 )
 
-            # NOTE(callumdickinson): Handle any volume handling options.
-            if "volume" in mapping and mapping["volume"]:
-                volume_config = mapping["volume"]
-                if isinstance(volume_config, dict):
-                    # NOTE(callumdickinson): If the meter mapping specifies
-                    # a custom volume source, overwrite the volume in the
-                    # samples with the values located using the defined
-                    # search expression (or list of expressions).
-                    # If a list of expressions, use the first match.
-                    for key in ("sources", "source"):
-                        if key in volume_config and volume_config[key]:
-                            volume_sources = volume_config[key]
-                            entries = (
-                                dict(
-                                    sample,
-                                    volume=self._sample_search(
-                                        field="volume",
-                                        expression=volume_sources,
-                                        sample=sample,
-                                        value_type=float,
-                                    ),
-                                )
-                                for sample in entries
-                            )
-                # NOTE(callumdickinson): If volume is defined and is a
-                # non-None value, but does not fall into any other category,
-                # assume it is an override to set the volume to a fixed value
-                # and set that on all samples.
-                else:
-                    entries = (
-                        dict(sample, volume=float(volume_config))
-                        for sample in entries
-                    )
+            # NOTE(callumdickinson): If the meter mapping specifies
+            # a custom volume source, overwrite the volume in the
+            # samples with the values located using the defined
+            # search expression (or list of expressions).
+            # If a list of expressions, use the first match.
+            for volume_sources in mapping.volume_sources:
+                entries = self._sample_volumes(entries, volume_sources)
+
+            # NOTE(callumdickinson): If volume is defined and is a
+            # non-None value, but does not fall into any other category,
+            # assume it is an override to set the volume to a fixed value
+            # and set that on all samples.
+            if mapping.volume_fixed is not None:
+                entries = (
+                    dict(sample, volume=mapping.volume_fixed)
+                    for sample in entries
+                )
 
             # NOTE(callumdickinson): Render any sample filters applied above.
             entries = list(entries)
@@ -279,9 +839,11 @@ class BaseCollector(object):
                 )
                 continue
 
-            transformed = transformer.transform_usage(
-                service, entries, window_start, window_end
-            )
+            with timings.time('transform', meter=mapping.meter,
+                              transformer=mapping.transformer_name):
+                transformed = transformer.transform_usage(
+                    service, entries, window_start, window_end
+                )
 
             if transformed:
                 # NOTE(flwang): Currently the column size of resource id in DB
@@ -292,7 +854,7 @@ class BaseCollector(object):
                 # hashing the name only for swift to get a consistent
                 # id for swift billing. Another change will be proposed to
                 # openstack-billing to handle this case as well.
-                if mapping['type'] == "Object Storage Container":
+                if mapping.type == "Object Storage Container":
                     res_id = hashlib.md5(res_id.encode('utf-8')).hexdigest()
 
                 LOG.debug(
@@ -300,13 +862,15 @@ class BaseCollector(object):
                     (res_id, transformed)
                 )
 
-                res_info = self._get_resource_info(
-                    project_id,
-                    res_id,
-                    mapping['type'],
-                    entries[-1],
-                    mapping['metadata']
-                )
+                with timings.time('resource_info', meter=mapping.meter):
+                    res_info = self._get_resource_info(
+                        project_id,
+                        res_id,
+                        mapping.type,
+                        entries[-1],
+                        mapping.metadata,
+                        known_resource_ids,
+                    )
 
                 res = resources.setdefault(res_id, res_info)
                 res.update(res_info)
@@ -315,24 +879,27 @@ class BaseCollector(object):
                     entry = {
                         'service': service,
                         'volume': volume,
-                        'unit': mapping['unit'],
+                        'unit': mapping.unit,
                         'resource_id': res_id,
                         'start': window_start,
                         'end': window_end,
                         'tenant_id': project_id
                     }
                     usage_entries.append(entry)
-                    # Push the usage entry to all active metrics processors.
-                    for metrics_processor in self.metrics_processors:
-                        metrics_processor.usage(
-                            project_id=entry["tenant_id"],
-                            service=entry["service"],
-                            unit=entry["unit"],
-                            resource_id=entry["resource_id"],
-                            start=entry["start"],
-                            end=entry["end"],
-                            volume=entry["volume"],
-                        )
+
+    @classmethod
+    def _sample_volumes(cls, samples, expression):
+        """Set the volume of each sample from a search expression."""
+        for sample in samples:
+            yield dict(
+                sample,
+                volume=cls._sample_search(
+                    field="volume",
+                    expression=expression,
+                    sample=sample,
+                    value_type=float,
+                ),
+            )
 
     @classmethod
     def _sample_search(
@@ -344,14 +911,14 @@ class BaseCollector(object):
         default=0,
         value_type=None,
     ):
-        if isinstance(expression, six.string_types):
-            expressions = [expression]
-            expressions_str = "search expression '{}'".format(expression)
-        else:  # list
+        # NOTE: Expressions may either be strings, or expressions
+        # precompiled with jmespath.compile.
+        if isinstance(expression, (list, tuple)):
             expressions = expression
-            expressions_str = "search expressions {}".format(expression)
+        else:
+            expressions = [expression]
         for search_expr in expressions:
-            value = jmespath.search(search_expr, sample)
+            value = _search(search_expr, sample)
             if value is not None:
                 if value_type:
                     try:
@@ -365,10 +932,10 @@ class BaseCollector(object):
                                 "sample: {})"
                             ).format(
                                 field,
-                                expressions_str,
+                                _expressions_str(expression),
                                 value_type.__name__,
                                 err,
-                                repr(search_expr),
+                                repr(_expression_str(search_expr)),
                                 repr(value),
                                 repr(sample),
                             ),
@@ -381,7 +948,7 @@ class BaseCollector(object):
                     " -> using the default value of {}"
                 ).format(
                     field,
-                    expressions_str,
+                    _expressions_str(expression),
                     sample,
                     default,
                 ),
@@ -390,7 +957,7 @@ class BaseCollector(object):
         raise exc.SearchExpressionNotFoundError(
             "Value not found for field '{}' using {} in sample: {}".format(
                 field,
-                expressions_str,
+                _expressions_str(expression),
                 sample,
             ),
         )
@@ -399,26 +966,65 @@ class BaseCollector(object):
     def _sample_filter(cls, filters, sample):
         # NOTE(callumdickinson): Only allow the sample if *ALL* filters
         # return a positive result.
+        # The filters are only formatted for the debug log messages when
+        # they are emitted, as this runs for every sample.
+        debug = LOG.isEnabledFor(logging.DEBUG)
         for filter in filters:
-            result = jmespath.search(filter, sample)
+            result = _search(filter, sample)
             if not result:
-                LOG.debug(
-                    (
-                        "Dropping sample due to meter mapping filter result: "
-                        "sample=%s, filters=%s, filter=%s, result=%s"
-                    ),
-                    sample,
-                    filters,
-                    filter,
-                    result,
-                )
+                if debug:
+                    LOG.debug(
+                        (
+                            "Dropping sample due to meter mapping filter "
+                            "result: sample=%s, filters=%s, filter=%s, "
+                            "result=%s"
+                        ),
+                        sample,
+                        [_expression_str(f) for f in filters],
+                        _expression_str(filter),
+                        result,
+                    )
                 return False
-        LOG.debug(
-            (
-                "Sample passed through meter mapping filters: "
-                "sample=%s, filters=%s"
-            ),
-            sample,
-            filters,
-        )
+        if debug:
+            LOG.debug(
+                (
+                    "Sample passed through meter mapping filters: "
+                    "sample=%s, filters=%s"
+                ),
+                sample,
+                [_expression_str(f) for f in filters],
+            )
         return True
+
+
+def _search(expression, sample):
+    """Search a sample using a jmespath expression string or compiled one."""
+    if isinstance(expression, six.string_types):
+        return jmespath.search(expression, sample)
+    return _JMESPATH_INTERPRETER.visit(expression.parsed, sample)
+
+
+def _expression_str(expression):
+    """Return the source string of a jmespath expression."""
+    return getattr(expression, 'expression', expression)
+
+
+def _expressions_str(expression):
+    """Describe a search expression, or a list of them, for messages."""
+    if isinstance(expression, (list, tuple)):
+        return "search expressions {}".format(
+            [_expression_str(expr) for expr in expression])
+    return "search expression '{}'".format(_expression_str(expression))
+
+
+def _dispatch_usage_batch(metrics_processor, project_id, start, end, usages):
+    """Hand the usage of a window to a metrics processor.
+
+    Errors are logged rather than raised, as the usage is already stored.
+    """
+    try:
+        metrics_processor.usage_batch(project_id, start, end, usages)
+    except Exception:
+        LOG.exception("Failed to publish the usage of project %s to metrics "
+                      "processor %s.", project_id,
+                      metrics_processor.__class__.__name__)
@@ -13,10 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from distil.collector import base
+from distil.collector.metrics.base import StageTimings
 from distil.common import constants
 from distil.common import general
 from distil.common import openstack
@@ -26,6 +29,8 @@ CONF = cfg.CONF
 
 
 class CeilometerCollector(base.BaseCollector):
+    supports_catch_up = True
+
     def __init__(self, *args, **kwargs):
         super(CeilometerCollector, self).__init__(*args, **kwargs)
         self._cclient = None
@@ -77,6 +82,211 @@ class CeilometerCollector(base.BaseCollector):
             # The response from Ceilometer API is in descending order,
             # but there have been cases where the response from the API
             # is not actually sorted, so explicitly sort the structure
-            # to reverse the order here.
-            for obj in sorted(sample_objs, key=lambda s: s.timestamp)
+            # to reverse the order here. The timestamps are parsed rather
+            # than compared as strings, as they do not all have microseconds,
+            # and the parsed timestamps are cached for the transformers.
+            for obj in sorted(
+                sample_objs,
+                key=lambda s: general.parse_timestamp(s.timestamp))
+        ]
+
+    @general.disable_ssl_warnings
+    def get_meters(self, project_id, meters, start, end, timings=None):
+        """Get samples of several meters, grouped by meter name.
+
+        When batch_meter_queries is enabled, the samples of all the given
+        meters are fetched with a single Ceilometer complex query, and split
+        by meter locally, the query being timed as a get_meter stage without
+        a meter. Otherwise, one query is made per distinct meter.
+
+        The batched query returns up to batch_query_limit samples. When it
+        reaches the limit, the result may be truncated, so the samples of
+        each meter are paged with iter_meter instead.
+        """
+        if not CONF.collector.batch_meter_queries:
+            return super(CeilometerCollector, self).get_meters(
+                project_id, meters, start, end, timings=timings)
+
+        if timings is None:
+            timings = StageTimings()
+
+        usage_by_meter = dict((meter, []) for meter in meters)
+        if not usage_by_meter:
+            return usage_by_meter
+
+        query_filter = {
+            "and": [
+                {"=": {"project_id": project_id}},
+                {"in": {"counter_name": list(usage_by_meter.keys())}},
+                {">=": {"timestamp": start.strftime(constants.date_format)}},
+                {"<": {"timestamp": end.strftime(constants.date_format)}},
+            ],
+        }
+        limit = CONF.collector.batch_query_limit
+        with timings.time('get_meter'):
+            sample_objs = self._get_ceilometer_client().query_samples.query(
+                filter=json.dumps(query_filter),
+                orderby=json.dumps([{"timestamp": "asc"}]),
+                limit=limit,
+            )
+
+        if len(sample_objs) >= limit:
+            LOG.warning(
+                "Batched query of the samples of project %s between %s and "
+                "%s reached batch_query_limit (%s), paging the samples of "
+                "each meter instead.", project_id, start, end, limit)
+            for meter in usage_by_meter:
+                with timings.time('get_meter', meter=meter):
+                    # Sorted the same way as get_meter does, the sort being
+                    # stable for the samples of each resource.
+                    usage_by_meter[meter] = sorted(
+                        self.iter_meter(project_id, meter, start, end),
+                        key=lambda s: general.parse_timestamp(s['timestamp']))
+            return usage_by_meter
+
+        # Sort the samples explicitly, the same way as get_meter does,
+        # so the per-meter lists are always in ascending timestamp order.
+        for obj in sorted(
+                sample_objs,
+                key=lambda s: general.parse_timestamp(s.timestamp)):
+            sample = obj.to_dict()
+            if sample['meter'] in usage_by_meter:
+                usage_by_meter[sample['meter']].append(sample)
+
+        return usage_by_meter
+
+    @general.disable_ssl_warnings
+    def get_active_projects(self, start, end):
+        """Get the IDs of the projects with samples between start and end.
+
+        The resources with samples in the range are listed with a single
+        query, without their meter links, of up to idle_projects_probe_limit
+        resources, as Ceilometer caps the resources it returns to its
+        default_api_return_limit otherwise. When the limit is reached, the
+        list may be truncated, and None is returned so that no project is
+        treated as idle.
+        """
+        query = [
+            dict(field='timestamp', op='ge',
+                 value=start.strftime(constants.date_format)),
+            dict(field='timestamp', op='lt',
+                 value=end.strftime(constants.date_format)),
         ]
+
+        limit = CONF.collector.idle_projects_probe_limit
+        resources = self._get_ceilometer_client().resources.list(
+            q=query, limit=limit, links=False)
+
+        if len(resources) >= limit:
+            LOG.warning(
+                "Listing the resources with samples between %s and %s "
+                "reached idle_projects_probe_limit (%s), not skipping idle "
+                "projects.", start, end, limit)
+            return None
+
+        return set(resource.project_id for resource in resources)
+
+    @general.disable_ssl_warnings
+    def iter_meter(self, project_id, meter, start, end):
+        """Iterate over the samples of a meter, resource by resource.
+
+        Samples are paged from the Ceilometer complex query API, in pages
+        of sample_page_size, ordered by resource ID and then timestamp.
+        Each page starts from the resource and timestamp of the last sample
+        of the previous page, skipping samples already yielded. If a whole
+        page has the same resource and timestamp, the samples with them are
+        paged by message ID instead, with _iter_key_samples.
+        """
+        conditions = [
+            {"=": {"project_id": project_id}},
+            {"=": {"counter_name": meter}},
+            {">=": {"timestamp": start.strftime(constants.date_format)}},
+            {"<": {"timestamp": end.strftime(constants.date_format)}},
+        ]
+        orderby = json.dumps([{"resource_id": "asc"}, {"timestamp": "asc"}])
+        page_size = CONF.collector.sample_page_size
+
+        # The resource ID and timestamp of the last sample yielded, and the
+        # IDs of the samples yielded with that resource ID and timestamp.
+        last_key = None
+        last_ids = set()
+        # Whether the next page should start strictly after last_key.
+        skip_last_key = False
+
+        while True:
+            page_conditions = list(conditions)
+            if last_key:
+                resource_id, timestamp = last_key
+                page_conditions.append({"or": [
+                    {">": {"resource_id": resource_id}},
+                    {"and": [
+                        {"=": {"resource_id": resource_id}},
+                        {(">" if skip_last_key else ">="): {
+                            "timestamp": timestamp}},
+                    ]},
+                ]})
+
+            sample_objs = self._get_ceilometer_client().query_samples.query(
+                filter=json.dumps({"and": page_conditions}),
+                orderby=orderby,
+                limit=page_size,
+            )
+
+            first_key = None
+            for obj in sample_objs:
+                sample = obj.to_dict()
+                key = (sample['resource_id'], sample['timestamp'])
+                first_key = first_key or key
+                if key != last_key:
+                    last_key = key
+                    last_ids = set()
+                elif sample['id'] in last_ids:
+                    continue
+                last_ids.add(sample['id'])
+                yield sample
+
+            if len(sample_objs) < page_size:
+                return
+
+            # NOTE: If a whole page has the same resource ID and timestamp,
+            # the next page would be the same, so get the rest of the
+            # samples with them by message ID, and move past the timestamp.
+            skip_last_key = first_key == last_key
+            if skip_last_key:
+                for sample in self._iter_key_samples(conditions, *last_key):
+                    if sample['id'] not in last_ids:
+                        last_ids.add(sample['id'])
+                        yield sample
+
+    def _iter_key_samples(self, conditions, resource_id, timestamp):
+        """Iterate over the samples of a resource at a timestamp.
+
+        Samples are paged from the Ceilometer complex query API, in pages
+        of sample_page_size, ordered by message ID.
+        """
+        key_conditions = conditions + [
+            {"=": {"resource_id": resource_id}},
+            {"=": {"timestamp": timestamp}},
+        ]
+        orderby = json.dumps([{"message_id": "asc"}])
+        page_size = CONF.collector.sample_page_size
+        last_id = None
+
+        while True:
+            page_conditions = list(key_conditions)
+            if last_id:
+                page_conditions.append({">": {"message_id": last_id}})
+
+            sample_objs = self._get_ceilometer_client().query_samples.query(
+                filter=json.dumps({"and": page_conditions}),
+                orderby=orderby,
+                limit=page_size,
+            )
+
+            for obj in sample_objs:
+                sample = obj.to_dict()
+                last_id = sample['id']
+                yield sample
+
+            if len(sample_objs) < page_size:
+                return
@@ -0,0 +1,252 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from distil.collector import base
+from distil.common import constants
+from distil.common import general
+from distil.common import openstack
+from distil import exceptions as exc
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Server-side aggregation used for the meters of each transformer, when the
+# meter mapping does not set one explicitly. The transformers produce the
+# same result from the single aggregated sample of a resource as they would
+# from all of its samples.
+TRANSFORMER_AGGREGATIONS = {
+    'numbool': 'max',
+    'max': 'max',
+    'storagemax': 'max',
+    'blockstoragemax': 'max',
+    'objectstoragemax': 'max',
+    'sum': 'sum',
+}
+
+AGGREGATIONS = ('max', 'sum', 'last')
+
+# The maximum number of resources searched for by ID at once, within the
+# default api.max_limit of Gnocchi (1000).
+SEARCH_BATCH_SIZE = 500
+
+
+class GnocchiCollector(base.BaseCollector):
+    """Collector for the Gnocchi aggregates API.
+
+    Rather than getting every sample of a meter, the samples of each
+    resource are aggregated by Gnocchi over the window, and the collector
+    gets one sample per resource holding the aggregated volume, along with
+    the attributes of the resource as its metadata.
+
+    The aggregation of each meter is set with the 'aggregation' key of its
+    meter mapping (one of max, sum or last), or derived from its transformer.
+    The Gnocchi resource type of the meter can be set with the
+    'resource_type' key. Virtual Machine meters must use the 'instance'
+    resource type, whose image_ref attribute gives the OS distro.
+
+    Gnocchi does not keep the source of measures, so the samples have the
+    source set by the gnocchi_source option.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(GnocchiCollector, self).__init__(*args, **kwargs)
+        # The aggregation and resource type used for each meter.
+        self.meter_aggregations = {}
+        for mapping in self.meter_mappings:
+            meter = mapping['meter']
+            aggregation = self._get_aggregation(mapping)
+            resource_type = mapping.get(
+                'resource_type', CONF.collector.gnocchi_resource_type)
+            if self.meter_aggregations.get(
+                    meter, (aggregation, resource_type)) != (aggregation,
+                                                             resource_type):
+                raise exc.InvalidConfig(
+                    "Meter %s is mapped with different aggregations or "
+                    "resource types." % meter
+                )
+            if (mapping.get('type') == 'Virtual Machine' and
+                    resource_type != 'instance'):
+                raise exc.InvalidConfig(
+                    "Virtual Machine meter %s must be mapped with the "
+                    "'instance' resource type." % meter
+                )
+            self.meter_aggregations[meter] = (aggregation, resource_type)
+
+    @classmethod
+    def _get_aggregation(cls, mapping):
+        aggregation = mapping.get(
+            'aggregation',
+            TRANSFORMER_AGGREGATIONS.get(mapping.get('transformer')),
+        )
+        if aggregation not in AGGREGATIONS:
+            raise exc.InvalidConfig(
+                "No server-side aggregation for meter %s with transformer "
+                "%s, set 'aggregation' to one of: %s" %
+                (mapping.get('meter'), mapping.get('transformer'),
+                 ', '.join(AGGREGATIONS))
+            )
+        return aggregation
+
+    def _request(self, path, body, params=None):
+        sess = openstack.get_keystone_session()
+        kwargs = {}
+        if CONF.collector.gnocchi_endpoint:
+            url = CONF.collector.gnocchi_endpoint.rstrip('/') + path
+        else:
+            url = path
+            kwargs['endpoint_filter'] = {
+                'service_type': 'metric',
+                'region_name': CONF.keystone_authtoken.region_name,
+            }
+        resp = sess.post(url, json=body, params=params, **kwargs)
+        return resp.json()
+
+    @general.disable_ssl_warnings
+    def get_meter(self, project_id, meter, start, end):
+        """Get one aggregated sample per resource of a particular meter.
+
+        Sample example:
+        [
+            {
+                "meter": "volume.size",
+                "metadata": {
+                    "display_name": "my-volume",
+                    "volume_type": "b1.standard"
+                },
+                "project_id": "35b17138-b364-4e6a-a131-8f3099c5be68",
+                "resource_id": "bd9431c1-8d69-4ad3-803a-8d4a6b89fd36",
+                "source": "openstack",
+                "timestamp": "2015-01-01T12:00:00",
+                "volume": 20.0
+            }
+        ]
+        """
+        aggregation, resource_type = self.meter_aggregations.get(
+            meter, ('max', CONF.collector.gnocchi_resource_type))
+
+        groups = self._request(
+            '/v1/aggregates',
+            {
+                'operations': ['metric', meter, aggregation],
+                'resource_type': resource_type,
+                'search': {'=': {'project_id': project_id}},
+            },
+            params={
+                'start': start.strftime(constants.date_format),
+                'stop': end.strftime(constants.date_format),
+                'granularity': CONF.collector.gnocchi_granularity,
+                'groupby': 'id',
+            },
+        )
+
+        volumes = {}
+        for group in groups:
+            points = [
+                point for point in _iter_points(group.get('measures'))
+                if point[2] is not None
+            ]
+            if points:
+                volumes[group['group']['id']] = _aggregate(aggregation,
+                                                           points)
+        LOG.debug('Got %s aggregated %s volumes for %s resources of project '
+                  '%s', aggregation, meter, len(volumes), project_id)
+
+        if not volumes:
+            return []
+
+        resources = self._search_resources(resource_type, volumes)
+
+        samples = []
+        timestamp = start.strftime(constants.date_format)
+        for resource in resources:
+            if resource['id'] not in volumes:
+                continue
+            metadata = resource
+            if 'image_ref' in resource:
+                # NOTE: Ceilometer samples of instances give their image as
+                # a URL, which the OS distro is looked up from.
+                metadata = dict(resource, image_ref_url=resource['image_ref'])
+            samples.append({
+                'meter': meter,
+                'metadata': metadata,
+                'project_id': project_id,
+                # NOTE: Gnocchi keeps the ID the resource was created with,
+                # e.g. '<project_id>/<container>' for Swift containers, as
+                # the ID is turned into a UUID when it is not one.
+                'resource_id': (resource.get('original_resource_id') or
+                                resource['id']),
+                'source': CONF.collector.gnocchi_source,
+                'timestamp': timestamp,
+                'volume': volumes[resource['id']],
+            })
+
+        return samples
+
+    def _search_resources(self, resource_type, resource_ids):
+        """Get the resources of a type with the given IDs.
+
+        Gnocchi caps the resources returned by a search at its api.max_limit
+        setting, so the IDs are searched for in batches, and the IDs of a
+        batch missing from the result are searched for again, until none of
+        them are found.
+        """
+        resource_ids = sorted(resource_ids)
+        resources = []
+        for i in range(0, len(resource_ids), SEARCH_BATCH_SIZE):
+            batch = set(resource_ids[i:i + SEARCH_BATCH_SIZE])
+            while batch:
+                found = [
+                    resource for resource in self._request(
+                        '/v1/search/resource/%s' % resource_type,
+                        {'in': {'id': sorted(batch)}},
+                        params={'limit': len(batch)},
+                    )
+                    if resource['id'] in batch
+                ]
+                if not found:
+                    break
+                resources.extend(found)
+                batch.difference_update(resource['id'] for resource in found)
+        return resources
+
+
+def _iter_points(measures):
+    """Iterate over the [timestamp, granularity, value] points of measures.
+
+    The points are nested in dicts by resource, metric and aggregation
+    method, depending on the Gnocchi version and query, next to the
+    references of the metrics.
+    """
+    if isinstance(measures, dict):
+        for key in sorted(measures):
+            if key == 'references':
+                continue
+            for point in _iter_points(measures[key]):
+                yield point
+    elif isinstance(measures, list):
+        for point in measures:
+            yield point
+
+
+def _aggregate(aggregation, points):
+    """Reduce the points of a resource's measures to one volume."""
+    if aggregation == 'sum':
+        return sum(point[2] for point in points)
+    if aggregation == 'last':
+        return max(points, key=lambda point: point[0])[2]
+    return max(point[2] for point in points)
@@ -13,6 +13,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import contextlib
+import timeit
+
+
+class StageTimings(object):
+    """
+    Time spent in each stage of the collection pipeline,
+    by meter and transformer, added up over a window.
+    """
+
+    def __init__(self):
+        self._durations = collections.OrderedDict()
+
+    def add(self, stage, duration, meter="", transformer=""):
+        """
+        Add time spent in a stage, in seconds.
+        """
+        key = (stage, meter, transformer)
+        self._durations[key] = self._durations.get(key, 0.0) + duration
+
+    @contextlib.contextmanager
+    def time(self, stage, meter="", transformer=""):
+        """
+        Add the time spent in the block to a stage.
+        """
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add(stage, timeit.default_timer() - start, meter,
+                     transformer)
+
+    def iterate(self, iterable, stage, meter="", transformer=""):
+        """
+        Iterate over an iterable, adding the time spent getting
+        each item (e.g. from a paged API) to a stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = timeit.default_timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, timeit.default_timer() - start, meter,
+                         transformer)
+                return
+            self.add(stage, timeit.default_timer() - start, meter,
+                     transformer)
+            yield item
+
+    def publish(self, metrics_processors):
+        """
+        Publish the stage durations to the given metrics processors.
+        """
+        for (stage, meter, transformer), duration in self._durations.items():
+            for metrics_processor in metrics_processors:
+                metrics_processor.stage_duration(
+                    stage=stage,
+                    meter=meter,
+                    transformer=transformer,
+                    duration=duration,
+                )
+
 
 class BaseCollectorMetrics(object):
     """
@@ -71,3 +135,60 @@ class BaseCollectorMetrics(object):
         Update relevant metrics with the new usage entry.
         """
         raise NotImplementedError()
+
+    def usage_batch(self, project_id, start, end, usages):
+        """
+        Update relevant metrics with the usage of a project's window,
+        given as a list of (service, unit, volume) tuples, with the
+        volumes of all resources added up for each service and unit.
+
+        The default implementation calls usage for each tuple,
+        without a resource ID.
+        """
+        for service, unit, volume in usages:
+            self.usage(
+                project_id=project_id,
+                service=service,
+                unit=unit,
+                resource_id=None,
+                start=start,
+                end=end,
+                volume=volume,
+            )
+
+    def untrusted_samples(self, project_id, source, count):
+        """
+        Update relevant metrics with the number of samples from an untrusted
+        source that were discarded for the project.
+        """
+        pass
+
+    def openstack_cache(self, namespace, hits, misses, size):
+        """
+        Update the OpenStack metadata cache metrics for the given namespace
+        with the cache's total hit and miss counts, and its current size
+        (None if unknown).
+        """
+        pass
+
+    def stage_duration(self, stage, meter, transformer, duration):
+        """
+        Update relevant metrics with the time spent, in seconds,
+        in a stage of the collection pipeline for a window.
+        The meter and transformer are empty for stages not specific to them.
+        """
+        pass
+
+    def project_duration(self, project_id, duration):
+        """
+        Update relevant metrics with the time taken, in seconds,
+        to collect the usage of a project.
+        """
+        pass
+
+    def window_duration(self, project_id, start, end, duration):
+        """
+        Update relevant metrics with the time taken, in seconds,
+        to collect the usage of a project for a window.
+        """
+        pass
@@ -25,8 +25,10 @@ from pkg_resources import get_distribution
 from prometheus_client import CollectorRegistry
 from prometheus_client import Counter
 from prometheus_client import Gauge
+from prometheus_client import Histogram
 from prometheus_client import Info
 from prometheus_client import make_wsgi_app
+from prometheus_client import Summary
 from sqlalchemy import __version__ as sqlalchemy_version
 
 from distil.collector.metrics.base import BaseCollectorMetrics
@@ -35,13 +37,43 @@ from distil.version import version_info as distil_version_info
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+# Buckets of the stage duration histogram, in seconds. Stages range from
+# cached lookups taking milliseconds to large queries taking minutes.
+STAGE_DURATION_BUCKETS = (
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0,
+)
+
+# Labels of the usage counter for each usage aggregation level.
+USAGE_LABELS = {
+    "project": ("project_id", "service", "unit"),
+    "top_projects": ("project_id", "service", "unit"),
+    "service": ("service", "unit"),
+    "global": ("unit",),
+}
+
+# Project ID the usage of the projects outside the top projects is added
+# up under, when aggregating usage by top projects.
+OTHER_PROJECTS = "other"
+
+# The number of projects whose total usage of a service is tracked, outside
+# the top projects, as a multiple of the number of top projects. The
+# projects with the least usage are dropped beyond it.
+TRACKED_PROJECTS_FACTOR = 10
+
 
 class PrometheusCollectorMetrics(BaseCollectorMetrics):
     """
     Prometheus exporter for Distil Collector.
     """
 
-    def __init__(self, host, port):
+    def __init__(
+        self,
+        host,
+        port,
+        usage_aggregation="project",
+        usage_top_projects=100,
+        usage_expiry=0,
+    ):
         """
         Initialise the Distil Collector Prometheus exporter
         and seed the metrics with initial values.
@@ -49,6 +81,22 @@ class PrometheusCollectorMetrics(BaseCollectorMetrics):
         # Bind host and port for the Prometheus exporter WSGI server.
         self.host = host
         self.port = port
+        # Aggregation level of the usage counter, the number of projects
+        # with their own series for each service when aggregating by top
+        # projects, and the time after which unchanged series are removed.
+        self.usage_aggregation = usage_aggregation
+        self.usage_top_projects = usage_top_projects
+        self.usage_expiry = usage_expiry
+        # Unix timestamp of the last change of each usage counter series,
+        # by label values. Set before seeding the gauges, as the series are
+        # expired whenever the last run's end time is updated.
+        self._usage_updated = {}
+        # Total usage of the projects of each (service, unit) when
+        # aggregating by top projects, the top projects among them, and
+        # the Unix timestamp of the last change of each project's total.
+        self._usage_project_totals = {}
+        self._usage_top_project_ids = {}
+        self._usage_project_updated = {}
         # WSGI server object reference.
         self._server = None
         # Prometheus metric collector registry. All metrics are binded
@@ -157,14 +205,83 @@ class PrometheusCollectorMetrics(BaseCollectorMetrics):
             registry=self.registry,
         )
         self.last_run_duration_seconds(run_end - run_start)
-        # Aggregate usage counter, for each service under each project.
+        # Aggregate usage counter, for each service under each project,
+        # or at the configured aggregation level.
         # Gets created as projects get collected.
         self._usage_total = Counter(
             name="distil_collector_usage_total",
             documentation=(
                 "Total usage under each service for a given project"
             ),
-            labelnames=("project_id", "service", "unit"),
+            labelnames=USAGE_LABELS[usage_aggregation],
+            registry=self.registry,
+        )
+        # Counter of samples discarded because of their untrusted source,
+        # for each source name (without the tenant ID prefix of sources
+        # set by users). Gets created as untrusted samples are found.
+        self._untrusted_samples_total = Counter(
+            name="distil_collector_untrusted_samples_total",
+            documentation=(
+                "Total samples discarded because of their untrusted source"
+            ),
+            labelnames=("source",),
+            registry=self.registry,
+        )
+        # OpenStack metadata cache hit and miss counters, and cache sizes,
+        # for each cache namespace (e.g. flavors, volume_types).
+        # Gets created as the caches get used.
+        self._openstack_cache_hits_total = Counter(
+            name="distil_collector_openstack_cache_hits_total",
+            documentation=(
+                "Total OpenStack metadata lookups served from the cache"
+            ),
+            labelnames=("namespace",),
+            registry=self.registry,
+        )
+        self._openstack_cache_misses_total = Counter(
+            name="distil_collector_openstack_cache_misses_total",
+            documentation=(
+                "Total OpenStack metadata lookups not found in the cache"
+            ),
+            labelnames=("namespace",),
+            registry=self.registry,
+        )
+        self._openstack_cache_entries = Gauge(
+            name="distil_collector_openstack_cache_entries",
+            documentation=(
+                "Number of entries in the OpenStack metadata cache"
+            ),
+            labelnames=("namespace",),
+            registry=self.registry,
+        )
+        # The last hit and miss totals reported for each cache namespace,
+        # used to increase the counters by the difference.
+        self._openstack_cache_totals = {}
+        # Time spent in each stage of the collection pipeline per window,
+        # for each meter and transformer the stage is specific to.
+        # Gets created as projects get collected.
+        self._stage_duration_seconds = Histogram(
+            name="distil_collector_stage_duration_seconds",
+            documentation=(
+                "Time spent in each collection stage for a window, "
+                "in seconds"
+            ),
+            labelnames=("stage", "meter", "transformer"),
+            buckets=STAGE_DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        # Time taken to collect each project, and each window of a project.
+        # Not labelled by project, to keep the number of series bounded.
+        self._project_duration_seconds = Summary(
+            name="distil_collector_project_duration_seconds",
+            documentation="Time taken to collect a project, in seconds",
+            registry=self.registry,
+        )
+        self._window_duration_seconds = Summary(
+            name="distil_collector_window_duration_seconds",
+            documentation=(
+                "Time taken to collect a window of a project, in seconds"
+            ),
             registry=self.registry,
         )
 
@@ -178,6 +295,9 @@ class PrometheusCollectorMetrics(BaseCollectorMetrics):
             return cls(
                 host=CONF.collector.exporter_host,
                 port=CONF.collector.exporter_port,
+                usage_aggregation=CONF.collector.exporter_usage_aggregation,
+                usage_top_projects=CONF.collector.exporter_usage_top_projects,
+                usage_expiry=CONF.collector.exporter_usage_expiry,
             )
         return None
 
@@ -234,6 +354,7 @@ class PrometheusCollectorMetrics(BaseCollectorMetrics):
             timestamp,
         )
         self._last_run_end.set(timestamp)
+        self._expire_usage_series(timestamp)
 
     def last_run_duration_seconds(self, duration):
         """
@@ -272,11 +393,255 @@ class PrometheusCollectorMetrics(BaseCollectorMetrics):
             unit,
             volume,
         )
-        self._usage_total.labels(
-            project_id=project_id,
-            service=service,
-            unit=unit,
-        ).inc(volume)
+        self._inc_usage(project_id, service, unit, volume)
+
+    def usage_batch(self, project_id, start, end, usages):
+        """
+        Add the usage of a project's window to the service-level
+        aggregate counters.
+        """
+        LOG.debug(
+            (
+                "Increasing Prometheus counter 'distil_collector_usage_total' "
+                "for %i services of project %s"
+            ),
+            len(usages),
+            project_id,
+        )
+        for service, unit, volume in usages:
+            self._inc_usage(project_id, service, unit, volume)
+
+    def _inc_usage(self, project_id, service, unit, volume):
+        """
+        Increase the usage counter series the usage of a project's service
+        is aggregated under.
+        """
+        if self.usage_aggregation == "global":
+            labels = (unit,)
+        elif self.usage_aggregation == "service":
+            labels = (service, unit)
+        elif self.usage_aggregation == "top_projects":
+            labels = (self._get_top_project_id(project_id, service, unit,
+                                               volume), service, unit)
+        else:
+            labels = (project_id, service, unit)
+        self._usage_total.labels(*labels).inc(volume)
+        # Series only ever increased by 0 are tracked from their creation,
+        # so that they expire as well.
+        if volume or labels not in self._usage_updated:
+            self._usage_updated[labels] = _get_utcnow_timestamp()
+
+    def _get_top_project_id(self, project_id, service, unit, volume):
+        """
+        Add to the total usage of a project's service, and return the
+        project ID its usage counter series is labelled with: the project's
+        own if it is one of the top projects for the service, otherwise
+        OTHER_PROJECTS.
+
+        Once the top projects are all taken, a project with more usage
+        than the top project with the least takes its place, and the
+        series of the project it replaces is removed.
+
+        The totals of up to TRACKED_PROJECTS_FACTOR times as many projects
+        as the top projects are kept, dropping those of the projects with
+        the least usage outside the top projects beyond that.
+        """
+        key = (service, unit)
+        totals = self._usage_project_totals.setdefault(key, {})
+        top_project_ids = self._usage_top_project_ids.setdefault(key, set())
+        totals[project_id] = totals.get(project_id, 0) + volume
+        updated_key = (project_id, service, unit)
+        if volume or updated_key not in self._usage_project_updated:
+            self._usage_project_updated[updated_key] = _get_utcnow_timestamp()
+
+        top_project_id = self._update_top_project_ids(
+            project_id, service, unit, totals, top_project_ids)
+
+        if len(totals) > self.usage_top_projects * TRACKED_PROJECTS_FACTOR:
+            least_project_id = min(
+                (tracked_id for tracked_id in totals
+                 if tracked_id not in top_project_ids),
+                key=totals.get,
+            )
+            del totals[least_project_id]
+            del self._usage_project_updated[(least_project_id, service,
+                                             unit)]
+
+        return top_project_id
+
+    def _update_top_project_ids(self, project_id, service, unit, totals,
+                                top_project_ids):
+        """
+        Add a project to the top projects of a service if its total usage
+        makes it one, and return the project ID its usage counter series is
+        labelled with.
+        """
+        if project_id in top_project_ids:
+            return project_id
+        if len(top_project_ids) < self.usage_top_projects:
+            top_project_ids.add(project_id)
+            return project_id
+
+        least_project_id = min(top_project_ids, key=totals.get)
+        if totals[project_id] <= totals[least_project_id]:
+            return OTHER_PROJECTS
+
+        LOG.debug(
+            (
+                "Replacing project %s with project %s among the top "
+                "projects of 'distil_collector_usage_total' for service %s"
+            ),
+            least_project_id,
+            project_id,
+            service,
+        )
+        top_project_ids.remove(least_project_id)
+        top_project_ids.add(project_id)
+        self._remove_usage_series((least_project_id, service, unit))
+        return project_id
+
+    def _remove_usage_series(self, labels):
+        """
+        Remove a usage counter series, if it exists.
+        """
+        if self._usage_updated.pop(labels, None) is not None:
+            self._usage_total.remove(*labels)
+
+    def _expire_usage_series(self, timestamp):
+        """
+        Remove the usage counter series that have not changed
+        for usage_expiry seconds, as of the given Unix timestamp.
+        """
+        if not self.usage_expiry:
+            return
+        expired = [
+            labels for labels, updated in self._usage_updated.items()
+            if timestamp - updated >= self.usage_expiry
+        ]
+        for labels in expired:
+            LOG.debug(
+                (
+                    "Removing expired Prometheus counter "
+                    "'distil_collector_usage_total' series: %s"
+                ),
+                labels,
+            )
+            self._remove_usage_series(labels)
+        # Projects whose usage has not changed have to make it
+        # to the top projects again.
+        expired = [
+            key for key, updated in self._usage_project_updated.items()
+            if timestamp - updated >= self.usage_expiry
+        ]
+        for project_id, service, unit in expired:
+            del self._usage_project_updated[(project_id, service, unit)]
+            self._usage_project_totals[(service, unit)].pop(project_id, None)
+            self._usage_top_project_ids[(service, unit)].discard(project_id)
+
+    def untrusted_samples(self, project_id, source, count):
+        """
+        Add the discarded untrusted samples to the per-source counter.
+
+        Sources set by users have the format <tenant_id>:<source_name>,
+        so the tenant ID is stripped to keep the label's values bounded.
+        """
+        source = source.split(":", 1)[-1]
+        LOG.debug(
+            (
+                "Increasing Prometheus counter "
+                "'distil_collector_untrusted_samples_total"
+                '{source="%s"}\' by: %i'
+            ),
+            source,
+            count,
+        )
+        self._untrusted_samples_total.labels(source=source).inc(count)
+
+    def openstack_cache(self, namespace, hits, misses, size):
+        """
+        Update the OpenStack metadata cache metrics for the given namespace.
+        """
+        LOG.debug(
+            (
+                "Updating Prometheus OpenStack cache metrics for namespace "
+                "'%s': hits=%i, misses=%i, size=%s"
+            ),
+            namespace,
+            hits,
+            misses,
+            size,
+        )
+        last_hits, last_misses = self._openstack_cache_totals.get(
+            namespace,
+            (0, 0),
+        )
+        # The totals only go down if the cache was recreated,
+        # in which case they count from zero again.
+        self._openstack_cache_hits_total.labels(namespace=namespace).inc(
+            hits - last_hits if hits >= last_hits else hits,
+        )
+        self._openstack_cache_misses_total.labels(namespace=namespace).inc(
+            misses - last_misses if misses >= last_misses else misses,
+        )
+        self._openstack_cache_totals[namespace] = (hits, misses)
+        if size is not None:
+            self._openstack_cache_entries.labels(namespace=namespace).set(
+                size,
+            )
+
+    def stage_duration(self, stage, meter, transformer, duration):
+        """
+        Observe the time spent in a collection stage for a window.
+        """
+        LOG.debug(
+            (
+                "Observing Prometheus histogram "
+                "'distil_collector_stage_duration_seconds"
+                '{stage="%s",meter="%s",transformer="%s"}\' '
+                "value: %f"
+            ),
+            stage,
+            meter,
+            transformer,
+            duration,
+        )
+        self._stage_duration_seconds.labels(
+            stage=stage,
+            meter=meter,
+            transformer=transformer,
+        ).observe(duration)
+
+    def project_duration(self, project_id, duration):
+        """
+        Observe the time taken to collect a project.
+        """
+        LOG.debug(
+            (
+                "Observing Prometheus summary "
+                "'distil_collector_project_duration_seconds' "
+                "value for project %s: %f"
+            ),
+            project_id,
+            duration,
+        )
+        self._project_duration_seconds.observe(duration)
+
+    def window_duration(self, project_id, start, end, duration):
+        """
+        Observe the time taken to collect a window of a project.
+        """
+        LOG.debug(
+            (
+                "Observing Prometheus summary "
+                "'distil_collector_window_duration_seconds' "
+                "value for project %s window %s - %s: %f"
+            ),
+            project_id,
+            start,
+            end,
+            duration,
+        )
+        self._window_duration_seconds.observe(duration)
 
 
 def _get_utcnow_timestamp():
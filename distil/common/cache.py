@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import time
+
 from oslo_cache import core
 from oslo_config import cfg
 from functools import wraps
@@ -56,3 +59,93 @@ def memoize(function):
             CACHE_REGION.set(key, value)
         return value
     return wrapper
+
+
+class TTLCache(object):
+    """A size-bounded, in-process LRU cache whose entries expire.
+
+    Entries older than ``ttl`` seconds are treated as missing. When the
+    cache holds ``maxsize`` entries, the least recently used one is evicted
+    to make room for a new one. A ``ttl`` of 0 disables expiry.
+
+    The number of lookups served from and missing the cache are counted in
+    ``hits`` and ``misses``.
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, core.NO_VALUE) is not core.NO_VALUE
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self._timer():
+            self.misses += 1
+            return default
+        # Re-insert the entry to mark it as the most recently used.
+        self._data[key] = (value, expires)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        while self._data and len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+        expires = self._timer() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+
+    def clear(self):
+        self._data.clear()
+
+
+class RegionCache(object):
+    """A namespaced view of an oslo.cache region, usable as a TTLCache.
+
+    Entries are stored in the region under ``distil-<namespace>-<key>``,
+    so several namespaces can share one region. Entries older than ``ttl``
+    seconds are treated as missing, on top of the expiration configured for
+    the region itself. Evicting entries to keep the cache bounded is left to
+    the cache backend, so the size of the cache is not known.
+    """
+
+    def __init__(self, namespace, ttl, region=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._region = region
+
+    @property
+    def region(self):
+        return self._region or CACHE_REGION
+
+    def _key(self, key):
+        return "%s%s-%s" % (KEY_PREFIX, self.namespace, key)
+
+    def __contains__(self, key):
+        return self.get(key, core.NO_VALUE) is not core.NO_VALUE
+
+    def get(self, key, default=None):
+        value = self.region.get(self._key(key),
+                                expiration_time=self.ttl or None)
+        if value is core.NO_VALUE:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.region.set(self._key(key), value)
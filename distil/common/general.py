@@ -33,6 +33,14 @@ CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 _TRANS_CONFIG = None
 
+_EPOCH = datetime(1970, 1, 1)
+# Unix timestamps, in microseconds, of the sample timestamps parsed so far.
+# Samples of the same polling cycle often share timestamps, so they are
+# only parsed once, however many transformers and collection steps use
+# them. The cache is emptied once it holds _TIMESTAMP_CACHE_SIZE entries.
+_TIMESTAMP_CACHE = {}
+_TIMESTAMP_CACHE_SIZE = 100000
+
 
 def get_transformer_config(name):
     global _TRANS_CONFIG
@@ -47,16 +55,73 @@ def get_transformer_config(name):
     return _TRANS_CONFIG.get(name, {})
 
 
-def get_windows(start, end):
-    """Get configured hour windows in a given range."""
+def to_epoch_us(value):
+    """Convert a datetime, in UTC, to a Unix timestamp in microseconds."""
+    delta = value - _EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds)
+
+
+def parse_timestamp(timestamp):
+    """Parse a sample timestamp into a Unix timestamp in microseconds.
+
+    Timestamps are datetimes, or strings in the '%Y-%m-%dT%H:%M:%S.%f' or
+    '%Y-%m-%dT%H:%M:%S' format, in UTC. Strings are parsed by position
+    rather than with strptime, and the result is cached.
+
+    :raises ValueError: If the timestamp is not in one of these formats.
+    """
+    if isinstance(timestamp, datetime):
+        return to_epoch_us(timestamp)
+
+    epoch = _TIMESTAMP_CACHE.get(timestamp)
+    if epoch is None:
+        epoch = _parse_timestamp(timestamp)
+        if len(_TIMESTAMP_CACHE) >= _TIMESTAMP_CACHE_SIZE:
+            _TIMESTAMP_CACHE.clear()
+        _TIMESTAMP_CACHE[timestamp] = epoch
+    return epoch
+
+
+def _parse_timestamp(timestamp):
+    length = len(timestamp)
+    if (length < 19 or timestamp[4] != '-' or timestamp[7] != '-' or
+            timestamp[10] != 'T' or timestamp[13] != ':' or
+            timestamp[16] != ':'):
+        raise ValueError("Invalid timestamp: %s" % timestamp)
+
+    microsecond = 0
+    if length > 19:
+        fraction = timestamp[20:]
+        if (timestamp[19] != '.' or not 0 < len(fraction) <= 6 or
+                not fraction.isdigit()):
+            raise ValueError("Invalid timestamp: %s" % timestamp)
+        microsecond = int(fraction.ljust(6, '0'))
+
+    # datetime validates the ranges of the fields.
+    return to_epoch_us(datetime(
+        int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+        microsecond,
+    ))
+
+
+def get_windows(start, end, max_windows=None):
+    """Get configured hour windows in a given range.
+
+    At most max_windows windows are returned, max_windows_per_cycle by
+    default.
+    """
     windows = []
     window_size = timedelta(hours=CONF.collector.collect_window)
+    if max_windows is None:
+        max_windows = CONF.collector.max_windows_per_cycle
 
     while start + window_size <= end:
         window_end = start + window_size
         windows.append((start, window_end))
 
-        if len(windows) >= CONF.collector.max_windows_per_cycle:
+        if len(windows) >= max_windows:
             break
 
         start = window_end
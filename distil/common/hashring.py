@@ -0,0 +1,52 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import hashlib
+
+# Number of points each member has on the ring. More points spread the keys
+# more evenly between members.
+DEFAULT_REPLICAS = 100
+
+
+class HashRing(object):
+    """Consistent hash ring assigning keys to members.
+
+    Each member is placed at several points of the ring, and a key belongs
+    to the member at the first point after the key's hash. When a member
+    leaves, only its keys move, and they are spread across the remaining
+    members.
+    """
+
+    def __init__(self, members, replicas=DEFAULT_REPLICAS):
+        self.members = sorted(set(members))
+        points = sorted(
+            (_hash('%s-%s' % (member, i)), member)
+            for member in self.members
+            for i in range(replicas)
+        )
+        self._hashes = [point[0] for point in points]
+        self._points = [point[1] for point in points]
+
+    def get_member(self, key):
+        """Get the member a key belongs to, or None if there are none."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._points[index]
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
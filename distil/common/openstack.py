@@ -13,12 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict
+import os
 import re
 
 from ceilometerclient import client as ceilometerclient
 from cinderclient.v2 import client as cinderclient
 from cinderclient.exceptions import NotFound as CinderNotFound
+import eventlet
 from glanceclient import client as glanceclient
 from keystoneauth1.identity import v3
 from keystoneauth1.exceptions import NotFound
@@ -26,20 +27,108 @@ from keystoneauth1 import session
 from keystoneclient.v3 import client as ks_client
 from novaclient import client as novaclient
 from novaclient.exceptions import NotFound as NovaNotFound
+from oslo_cache import core as cache_core
 from oslo_config import cfg
+import requests
 
 from distil.common import cache as distil_cache
 from distil.common import general
 
 CONF = cfg.CONF
 KS_SESSION = None
-cache = defaultdict(dict)
 ROOT_DEVICE_PATTERN = re.compile('^/dev/(x?v|s|h)da1?$')
 
+# Expiring caches of metadata looked up from OpenStack services, by kind
+# (e.g. 'flavors' or 'volume_types').
+_CACHES = {}
+
+# Service clients, by service, built once per process by _get_client, and
+# the ID of the process they were built in.
+_CLIENTS = {}
+_CLIENTS_PID = None
+
+
+def _get_cache(namespace):
+    if namespace not in _CACHES:
+        ttl = CONF.collector.openstack_cache_ttl
+        if CONF.collector.openstack_cache_backend == 'oslo_cache':
+            if distil_cache.CACHE_REGION is None:
+                distil_cache.setup_cache(CONF)
+            _CACHES[namespace] = distil_cache.RegionCache(namespace, ttl)
+        else:
+            maxsize = int(CONF.collector.openstack_cache_sizes.get(
+                namespace, CONF.collector.openstack_cache_size))
+            _CACHES[namespace] = distil_cache.TTLCache(maxsize, ttl)
+    return _CACHES[namespace]
+
+
+def get_cache_stats():
+    """Return the hit and miss counts and size of each metadata cache.
+
+    :returns: A dict of (hits, misses, size) tuples by cache namespace.
+              The size is None for caches whose size is not known.
+    """
+    stats = {}
+    for namespace, ns_cache in _CACHES.items():
+        try:
+            size = len(ns_cache)
+        except TypeError:
+            size = None
+        stats[namespace] = (ns_cache.hits, ns_cache.misses, size)
+    return stats
+
+
+def _check_process():
+    """Drop the session and clients inherited from a parent process.
+
+    Their connections must not be shared with a forked process, e.g. a
+    backfill worker.
+    """
+    global KS_SESSION, _CLIENTS_PID
+
+    pid = os.getpid()
+    if _CLIENTS_PID != pid:
+        KS_SESSION = None
+        _CLIENTS.clear()
+        _CLIENTS_PID = pid
+
+
+def reset_clients():
+    """Drop the keystone session and the service clients built so far."""
+    global KS_SESSION
+
+    KS_SESSION = None
+    _CLIENTS.clear()
+
 
-def _get_keystone_session():
+def _get_http_session():
+    """Build the HTTP session the keystone session sends requests with.
+
+    Its connection pool holds up to openstack_pool_size connections per
+    host, so that concurrent requests reuse them rather than opening new
+    ones, with TCP keep-alive if openstack_tcp_keepalive is enabled.
+    """
+    if CONF.collector.openstack_tcp_keepalive:
+        adapter_class = session.TCPKeepAliveAdapter
+    else:
+        adapter_class = requests.adapters.HTTPAdapter
+    adapter = adapter_class(
+        pool_connections=CONF.collector.openstack_pool_size,
+        pool_maxsize=CONF.collector.openstack_pool_size,
+    )
+
+    http_session = requests.Session()
+    for scheme in list(http_session.adapters):
+        http_session.mount(scheme, adapter)
+    return http_session
+
+
+def get_keystone_session():
+    """Get the keystone session shared by the clients of this process."""
     global KS_SESSION
 
+    _check_process()
+
     if not KS_SESSION:
         auth = v3.Password(
             auth_url=CONF.keystone_authtoken.auth_url,
@@ -49,52 +138,73 @@ def _get_keystone_session():
             user_domain_name=CONF.keystone_authtoken.user_domain_name,
             project_domain_name=CONF.keystone_authtoken.project_domain_name,
         )
-        KS_SESSION = session.Session(auth=auth, verify=False)
+        KS_SESSION = session.Session(auth=auth, verify=False,
+                                     session=_get_http_session())
 
     return KS_SESSION
 
 
+def _get_client(service, factory):
+    """Get the client of a service, built with factory on first use.
+
+    Clients are built once per process, and share the keystone session.
+    """
+    _check_process()
+
+    client = _CLIENTS.get(service)
+    if client is None:
+        client = factory(get_keystone_session())
+        _CLIENTS[service] = client
+    return client
+
+
 def get_keystone_client():
-    sess = _get_keystone_session()
-    return ks_client.Client(session=sess)
+    return _get_client(
+        'keystone',
+        lambda sess: ks_client.Client(session=sess),
+    )
 
 
 def get_ceilometer_client():
-    sess = _get_keystone_session()
-
-    return ceilometerclient.get_client(
-        '2',
-        session=sess,
-        region_name=CONF.keystone_authtoken.region_name
+    return _get_client(
+        'ceilometer',
+        lambda sess: ceilometerclient.get_client(
+            '2',
+            session=sess,
+            region_name=CONF.keystone_authtoken.region_name
+        ),
     )
 
 
 def get_cinder_client():
-    sess = _get_keystone_session()
-
-    return cinderclient.Client(
-        session=sess,
-        region_name=CONF.keystone_authtoken.region_name
+    return _get_client(
+        'cinder',
+        lambda sess: cinderclient.Client(
+            session=sess,
+            region_name=CONF.keystone_authtoken.region_name
+        ),
     )
 
 
 def get_glance_client():
-    sess = _get_keystone_session()
-
-    return glanceclient.Client(
-        '2',
-        session=sess,
-        region_name=CONF.keystone_authtoken.region_name
+    return _get_client(
+        'glance',
+        lambda sess: glanceclient.Client(
+            '2',
+            session=sess,
+            region_name=CONF.keystone_authtoken.region_name
+        ),
     )
 
 
 def get_nova_client():
-    sess = _get_keystone_session()
-
-    return novaclient.Client(
-        '2',
-        session=sess,
-        region_name=CONF.keystone_authtoken.region_name
+    return _get_client(
+        'nova',
+        lambda sess: novaclient.Client(
+            '2',
+            session=sess,
+            region_name=CONF.keystone_authtoken.region_name
+        ),
     )
 
 
@@ -146,52 +256,162 @@ def get_image(image_id):
 
 
 @general.disable_ssl_warnings
-def get_root_volume(instance_id):
-    nova = get_nova_client()
-    volumes = nova.volumes.get_server_volumes(instance_id)
+def get_image_os_distro(image_id):
+    """Get the os_distro property of an image, or None if it has none."""
+    images = _get_cache('images')
+    os_distro = images.get(image_id, cache_core.NO_VALUE)
+    if os_distro is cache_core.NO_VALUE:
+        os_distro = getattr(get_image(image_id), 'os_distro', None)
+        images.set(image_id, os_distro)
+    return os_distro
+
+
+def _get_volume_image_metadata(volume):
+    # Only plain data is cached, as caches backed by oslo.cache pickle
+    # their values, and client resources can not be pickled.
+    return dict(getattr(volume, 'volume_image_metadata', None) or {})
+
+
+@general.disable_ssl_warnings
+def get_volume_image_metadata(volume_id):
+    """Get the metadata of the image a volume was created from, if any."""
+    volumes = _get_cache('volumes')
+    image_meta = volumes.get(volume_id)
+    if image_meta is None:
+        cinder = get_cinder_client()
+        image_meta = _get_volume_image_metadata(cinder.volumes.get(volume_id))
+        volumes.set(volume_id, image_meta)
+    return image_meta
+
+
+@general.disable_ssl_warnings
+def get_root_volume_id(instance_id):
+    """Get the ID of the root volume of an instance booted from volume.
+
+    :returns: The volume ID, or None if the instance is booted from image.
+    """
+    # The ID of the root volume of each instance is cached, with None
+    # meaning the instance is known not to be booted from volume.
+    root_volumes = _get_cache('root_volumes')
+    vol_id = root_volumes.get(instance_id, cache_core.NO_VALUE)
+
+    if vol_id is cache_core.NO_VALUE:
+        nova = get_nova_client()
+        volumes = nova.volumes.get_server_volumes(instance_id)
 
-    vol_id = None
-    volume = None
+        vol_id = None
+        for vol in volumes:
+            if ROOT_DEVICE_PATTERN.search(vol.device):
+                vol_id = vol.volumeId
+                break
 
-    for vol in volumes:
-        if ROOT_DEVICE_PATTERN.search(vol.device):
-            vol_id = vol.volumeId
-            break
+        root_volumes.set(instance_id, vol_id)
+
+    return vol_id
+
+
+@general.disable_ssl_warnings
+def get_root_volume(instance_id):
+    vol_id = get_root_volume_id(instance_id)
 
     if vol_id:
         cinder = get_cinder_client()
-        volume = cinder.volumes.get(vol_id)
+        return cinder.volumes.get(vol_id)
+
+    return None
+
+
+@general.disable_ssl_warnings
+def get_root_volume_image_metadata(instance_id):
+    """Get the image metadata of the root volume of an instance.
+
+    :returns: The volume_image_metadata of the root volume, or None if the
+              instance is booted from image.
+    """
+    vol_id = get_root_volume_id(instance_id)
+
+    if vol_id:
+        return get_volume_image_metadata(vol_id)
+
+    return None
+
+
+@general.disable_ssl_warnings
+def prefetch_os_distro_info(project_id, image_ids=None):
+    """Cache the metadata needed to find the OS distro of instances.
+
+    Lists the servers and volumes of the project, and the given images,
+    with one request each, so that get_root_volume_image_metadata and
+    get_image_os_distro can be served from the cache for the instances of
+    the project.
+    """
+    search_opts = {'all_tenants': True, 'project_id': project_id}
 
-    return volume
+    nova = get_nova_client()
+    servers = nova.servers.list(search_opts=search_opts, limit=-1)
+    cinder = get_cinder_client()
+    volumes = cinder.volumes.list(search_opts=search_opts)
+
+    volume_cache = _get_cache('volumes')
+    root_volume_ids = {}
+    for volume in volumes:
+        volume_cache.set(volume.id, _get_volume_image_metadata(volume))
+        for attachment in getattr(volume, 'attachments', None) or []:
+            if ROOT_DEVICE_PATTERN.search(attachment.get('device') or ''):
+                root_volume_ids[attachment['server_id']] = volume.id
+
+    root_volumes = _get_cache('root_volumes')
+    for server in servers:
+        root_volumes.set(server.id, root_volume_ids.get(server.id))
+
+    if image_ids:
+        glance = get_glance_client()
+        image_cache = _get_cache('images')
+        image_ids = sorted(image_ids)
+        # Keep the request URLs to a sensible length.
+        for i in range(0, len(image_ids), 100):
+            images = glance.images.list(
+                filters={'id': 'in:%s' % ','.join(image_ids[i:i + 100])})
+            for image in images:
+                image_cache.set(image.id, getattr(image, 'os_distro', None))
 
 
 @general.disable_ssl_warnings
 def get_flavor_name(flavor_id):
-    if flavor_id not in cache["flavors"]:
+    flavors = _get_cache('flavors')
+    flavor_name = flavors.get(flavor_id)
+    if flavor_name is None:
         nova = get_nova_client()
         try:
             flavor_name = nova.flavors.get(flavor_id).name
         except NovaNotFound:
             return None
-        cache["flavors"][flavor_id] = flavor_name
-    return cache["flavors"][flavor_id]
+        flavors.set(flavor_id, flavor_name)
+    return flavor_name
 
 
 @general.disable_ssl_warnings
 def get_volume_type_for_volume(volume_id):
-    if volume_id not in cache["volume_id_to_type"]:
+    # The type of each volume is cached, with None meaning the volume is
+    # known to have no volume type.
+    volume_id_to_type = _get_cache('volume_id_to_type')
+    volume_type = volume_id_to_type.get(volume_id, cache_core.NO_VALUE)
+    if volume_type is cache_core.NO_VALUE:
         cinder = get_cinder_client()
         try:
             vol = cinder.volumes.get(volume_id)
         except CinderNotFound:
             return None
-        cache["volume_id_to_type"][volume_id] = vol.volume_type
-    return cache["volume_id_to_type"][volume_id]
+        volume_type = vol.volume_type
+        volume_id_to_type.set(volume_id, volume_type)
+    return volume_type
 
 
 @general.disable_ssl_warnings
 def get_volume_type_name(volume_type):
-    if volume_type not in cache["volume_types"]:
+    volume_types = _get_cache('volume_types')
+    volume_type_name = volume_types.get(volume_type)
+    if volume_type_name is None:
         cinder = get_cinder_client()
         try:
             vtype = cinder.volume_types.get(volume_type)
@@ -200,27 +420,71 @@ def get_volume_type_name(volume_type):
                 vtype = cinder.volume_types.find(name=volume_type)
             except CinderNotFound:
                 return None
-        cache["volume_types"][vtype.id] = vtype.name
-        cache["volume_types"][vtype.name] = vtype.name
-    return cache["volume_types"][volume_type]
+        # Volume types are looked up by either ID or name.
+        volume_types.set(vtype.id, vtype.name)
+        volume_types.set(vtype.name, vtype.name)
+        volume_type_name = vtype.name
+    return volume_type_name
 
 
 @general.disable_ssl_warnings
-def get_object_storage_url(project_id):
-    ks = get_keystone_client()
-    try:
-        endpoint = ks.endpoints.list(
+def prefetch_volume_types(project_id, volume_ids=None, volume_types=None):
+    """Cache the volume types of a project's volumes, and their names.
+
+    Only the given volume IDs and volume type references (IDs or names)
+    missing from the cache are resolved, with one (paged) listing of the
+    volumes of the project, and one listing of the volume types, so that
+    get_volume_type_for_volume and get_volume_type_name can be served from
+    the cache.
+    """
+    volume_id_to_type = _get_cache('volume_id_to_type')
+    type_names = _get_cache('volume_types')
+    cinder = None
+
+    if any(volume_id_to_type.get(volume_id, cache_core.NO_VALUE)
+           is cache_core.NO_VALUE for volume_id in volume_ids or ()):
+        cinder = get_cinder_client()
+        volume_cache = _get_cache('volumes')
+        volumes = cinder.volumes.list(
+            search_opts={'all_tenants': True, 'project_id': project_id})
+        for volume in volumes:
+            volume_cache.set(volume.id, _get_volume_image_metadata(volume))
+            volume_id_to_type.set(volume.id, volume.volume_type)
+
+    if any(type_names.get(volume_type) is None
+           for volume_type in volume_types or ()):
+        cinder = cinder or get_cinder_client()
+        for vtype in cinder.volume_types.list():
+            # Volume types are looked up by either ID or name.
+            type_names.set(vtype.id, vtype.name)
+            type_names.set(vtype.name, vtype.name)
+
+
+def _get_object_storage_endpoint():
+    # The URL template of the public object storage endpoint is looked up
+    # from the service catalog once, rather than for each container.
+    endpoints = _get_cache('endpoints')
+    url = endpoints.get('object-store')
+    if url is None:
+        ks = get_keystone_client()
+        url = ks.endpoints.list(
             service=ks.services.list(type="object-store")[0],
             interface="public",
-            region=CONF.keystone_authtoken.region_name)[0]
-        return endpoint.url % {'tenant_id': project_id}
+            region=CONF.keystone_authtoken.region_name)[0].url
+        endpoints.set('object-store', url)
+    return url
+
+
+@general.disable_ssl_warnings
+def get_object_storage_url(project_id):
+    try:
+        return _get_object_storage_endpoint() % {'tenant_id': project_id}
     except KeyError:
         return None
 
 
-@general.disable_ssl_warnings
-def get_container_policy(project_id, container_name):
-    sess = _get_keystone_session()
+def _head_container_policy(project_id, container_name):
+    sess = get_keystone_session()
     url = get_object_storage_url(project_id)
     if url:
         try:
@@ -230,3 +494,49 @@ def get_container_policy(project_id, container_name):
         except NotFound:
             return None
     return None
+
+
+@general.disable_ssl_warnings
+def get_container_policy(project_id, container_name):
+    # The storage policy of each container is cached, with None meaning
+    # the container has none, or was not found.
+    policies = _get_cache('container_policies')
+    key = '%s/%s' % (project_id, container_name)
+    policy = policies.get(key, cache_core.NO_VALUE)
+    if policy is cache_core.NO_VALUE:
+        policy = _head_container_policy(project_id, container_name)
+        policies.set(key, policy)
+    return policy
+
+
+@general.disable_ssl_warnings
+def prefetch_container_policies(project_id, container_names):
+    """Cache the storage policies of a project's containers.
+
+    The policies missing from the cache are looked up concurrently, with up
+    to container_policy_concurrency HEAD requests at once sharing the
+    connection pool of the keystone session, so that get_container_policy
+    can be served from the cache. Containers whose lookup fails are left to
+    get_container_policy.
+    """
+    policies = _get_cache('container_policies')
+    missing = [
+        name for name in sorted(set(container_names))
+        if ('%s/%s' % (project_id, name)) not in policies
+    ]
+    if not missing:
+        return
+
+    # Resolve the endpoint before the requests are sent concurrently.
+    _get_object_storage_endpoint()
+
+    def head(container_name):
+        try:
+            return _head_container_policy(project_id, container_name)
+        except Exception:
+            return cache_core.NO_VALUE
+
+    pool = eventlet.GreenPool(CONF.collector.container_policy_concurrency)
+    for container_name, policy in zip(missing, pool.imap(head, missing)):
+        if policy is not cache_core.NO_VALUE:
+            policies.set('%s/%s' % (project_id, container_name), policy)
@@ -57,8 +57,95 @@ COLLECTOR_OPTS = [
                help=('Window of usage collection in hours.')),
     cfg.StrOpt('collector_backend', default='ceilometer',
                help=('Data collector.')),
+    cfg.StrOpt('gnocchi_endpoint',
+               help=('The URL of the Gnocchi API used by the gnocchi '
+                     'collector backend. By default, it is looked up in the '
+                     'service catalog.')),
+    cfg.IntOpt('gnocchi_granularity', default=3600, min=1,
+               help=('The granularity, in seconds, of the measures the '
+                     'gnocchi collector backend aggregates. It must be '
+                     'defined in the archive policies of the metrics.')),
+    cfg.StrOpt('gnocchi_resource_type', default='generic',
+               help=('The Gnocchi resource type searched for the meters of '
+                     'mappings without a resource_type.')),
+    cfg.StrOpt('gnocchi_source', default='openstack',
+               help=('The source of the samples of the gnocchi collector '
+                     'backend, matched against trust_sources. Gnocchi does '
+                     'not keep the source of measures, so all of them are '
+                     'trusted or not.')),
+    cfg.BoolOpt('batch_meter_queries', default=False,
+                help=('Fetch the samples for all mapped meters of a project '
+                      'window in a single backend query, instead of one '
+                      'query per meter. Requires the Ceilometer complex '
+                      'query API.')),
+    cfg.IntOpt('batch_query_limit', default=100000, min=1,
+               help=('The maximum number of samples fetched by a batched '
+                     'meter query. If a query reaches it, the result may '
+                     'have been truncated, so the samples of each meter are '
+                     'fetched in pages of sample_page_size instead.')),
+    cfg.BoolOpt('stream_samples', default=False,
+                help=('Read the samples of each meter resource by resource, '
+                      'in pages of sample_page_size, and transform them as '
+                      'each resource completes, instead of loading all the '
+                      'samples of a project window at once. Bounds memory '
+                      'use for projects with many samples. Requires the '
+                      'Ceilometer complex query API.')),
+    cfg.IntOpt('sample_page_size', default=1000, min=1,
+               help=('The number of samples fetched per backend request '
+                     'when stream_samples is enabled.')),
     cfg.IntOpt('max_windows_per_cycle', default=1,
                help=('The maximum number of windows per collecting cycle.')),
+    cfg.BoolOpt('catch_up', default=False,
+                help=('When a project is more than one window behind, fetch '
+                      'the samples of each meter for all the windows of the '
+                      'collecting cycle in a single query, and split them '
+                      'into windows locally. Windows are still transformed '
+                      'and committed one at a time, in order. Holds the '
+                      "samples of the whole span in memory, so it is not "
+                      'used together with stream_samples. Only used by '
+                      'collectors returning the samples with their own '
+                      'timestamps, such as the ceilometer collector.')),
+    cfg.IntOpt('collect_pool_size', default=1, min=1,
+               help=('The number of projects to collect usage for '
+                     'concurrently within a collecting cycle. Each project '
+                     'is handled by its own green thread, holding its own '
+                     'project lock. Default is 1 (one project at a time).')),
+    cfg.StrOpt('project_claiming', default='lock',
+               choices=['lock', 'lease'],
+               help=('How collectors make sure only one of them collects '
+                     'usage for a project at a time. "lock" creates and '
+                     'deletes a lock record per project. "lease" claims '
+                     'lease_batch_size projects at a time with an expiring '
+                     'lease, renewed while the projects are being '
+                     'collected, so the leases of a stopped collector '
+                     'expire on their own.')),
+    cfg.IntOpt('lease_batch_size', default=10, min=1,
+               help=('The number of projects claimed at once when '
+                     'project_claiming is "lease".')),
+    cfg.IntOpt('lease_duration', default=600, min=3,
+               help=('How long, in seconds, a project lease lasts unless '
+                     'renewed. Leases are renewed every third of it.')),
+    cfg.StrOpt('shard_membership', default='static',
+               choices=['static', 'db'],
+               help=('How collectors find the members to shard projects '
+                     'between. Each project is assigned to one member with '
+                     'a consistent hash of its ID, and each collector only '
+                     'collects usage for its own projects. "static" uses '
+                     'shard_members, and does not shard projects if it is '
+                     'empty. "db" uses the collectors that registered '
+                     'themselves in the database within '
+                     'shard_member_timeout, so the projects of a collector '
+                     'that stopped are spread between the others.')),
+    cfg.ListOpt('shard_members', default=[],
+                help=('The process identifiers (host name and '
+                      'partitioning_suffix, joined with "_") of the '
+                      'collectors sharing projects, when shard_membership '
+                      'is "static".')),
+    cfg.IntOpt('shard_member_timeout', default=7200, min=1,
+               help=('How long, in seconds, a collector stays a member '
+                     'after it last started a collecting cycle, when '
+                     'shard_membership is "db". It should be longer than '
+                     'the longest collecting cycle.')),
     cfg.IntOpt('max_collection_start_age',
                default=864,
                help=('The maximum time period for determining the start time '
@@ -88,10 +175,85 @@ COLLECTOR_OPTS = [
     cfg.StrOpt('partitioning_suffix',
                help=('Collector partitioning group suffix. It is used when '
                      'running multiple collectors in favor of lock.')),
+    cfg.StrOpt('openstack_cache_backend', default='memory',
+               choices=['memory', 'oslo_cache'],
+               help=('Where the collector caches metadata looked up from '
+                     'OpenStack services, such as flavors, volume types, '
+                     'images and volumes. "memory" keeps a size-bounded '
+                     'cache in each collector process, "oslo_cache" uses '
+                     'the cache region configured in the [cache] section.')),
+    cfg.IntOpt('openstack_cache_ttl', default=3600, min=0,
+               help=('How long, in seconds, the collector caches metadata '
+                     'looked up from OpenStack services. '
+                     '0 means entries never expire.')),
+    cfg.IntOpt('openstack_cache_size', default=10000, min=1,
+               help=('The maximum number of metadata entries the collector '
+                     'caches in memory, per kind of entry.')),
+    cfg.DictOpt('openstack_cache_sizes', default={},
+                help=('Overrides of openstack_cache_size for specific kinds '
+                      'of entry, e.g. "flavors:500,volume_types:100". The '
+                      'kinds are flavors, volume_types, volume_id_to_type, '
+                      'images, volumes, root_volumes, endpoints and '
+                      'container_policies.')),
+    cfg.IntOpt('openstack_pool_size', default=10, min=1,
+               help=('The maximum number of HTTP connections kept open to '
+                     'each OpenStack service endpoint, shared by all the '
+                     'service clients of a process.')),
+    cfg.BoolOpt('openstack_tcp_keepalive', default=True,
+                help=('Enable TCP keep-alive on the connections to the '
+                      'OpenStack services, so that idle connections kept '
+                      'in the pool are not dropped.')),
+    cfg.BoolOpt('prefetch_os_distro', default=False,
+                help=('When new instances are found in a project window, '
+                      "list the project's servers, volumes and images once "
+                      'to resolve their OS distro, instead of looking each '
+                      'instance up separately.')),
+    cfg.BoolOpt('prefetch_volume_types', default=False,
+                help=('Before transforming the usage of volumes in a '
+                      'project window, list the volumes of the project and '
+                      'the volume types once to resolve the volume types '
+                      'missing from the cache, instead of looking each '
+                      'volume up separately.')),
+    cfg.BoolOpt('prefetch_container_policies', default=False,
+                help=('Before transforming the usage of object storage '
+                      'containers in a project window, look up the storage '
+                      'policies missing from the cache concurrently, '
+                      'instead of one container at a time.')),
+    cfg.IntOpt('container_policy_concurrency', default=10, min=1,
+               help=('The maximum number of container storage policy '
+                     'lookups sent at once when prefetching them. Keep it '
+                     'within openstack_pool_size, so that connections are '
+                     'reused.')),
+    cfg.BoolOpt('skip_idle_projects', default=False,
+                help=('Ask the collector backend which projects have '
+                      'samples in the windows of each cycle at its start, '
+                      'and only collect usage for '
+                      'those. The last collected time of the other projects '
+                      'is advanced in bulk, without storing any usage. Only '
+                      'used by backends able to tell, such as ceilometer.')),
+    cfg.IntOpt('idle_projects_probe_limit', default=100000, min=1,
+               help=('The maximum number of resources listed from the '
+                     'collector backend to find the projects with samples, '
+                     'when skip_idle_projects is enabled. If the list '
+                     'reaches it, it may have been truncated, so no '
+                     'project is skipped in that cycle.')),
     cfg.StrOpt('project_order', default='ascending',
-               choices=['ascending', 'descending', 'random'],
+               choices=['ascending', 'descending', 'random', 'staleness'],
                help=('The order of project IDs to do usage collection. '
-                     'Default is ascending.')),
+                     '"staleness" collects the projects with the oldest '
+                     'last collected time first. Default is ascending.')),
+    cfg.IntOpt('cycle_time_budget', default=0, min=0,
+               help=('The time, in seconds, after which a collecting cycle '
+                     'stops starting to collect usage for more projects, '
+                     'or more windows of the projects in progress, leaving '
+                     'them to the next cycle. Set it below '
+                     'periodic_interval so that cycles do not overrun. '
+                     'Default is 0 (no limit).')),
+    cfg.BoolOpt('async_metrics_dispatch', default=False,
+                help=('Hand the usage of each collected window to the '
+                      'metrics processors on a background green thread, '
+                      'rather than in the collecting thread. '
+                      'Default is False.')),
     cfg.BoolOpt('enable_exporter', default=False,
                 help=('Flag for enabling the Distil Collector '
                       'Prometheus exporter.')),
@@ -101,6 +263,27 @@ COLLECTOR_OPTS = [
     cfg.IntOpt('exporter_port', default=16799,
                help=('The bind port for the Distil Collector '
                      'Prometheus exporter.')),
+    cfg.StrOpt('exporter_usage_aggregation', default='project',
+               choices=['project', 'top_projects', 'service', 'global'],
+               help=('How the distil_collector_usage_total metric of the '
+                     'Distil Collector Prometheus exporter is aggregated. '
+                     '"project" has a series for each project, service and '
+                     'unit. "top_projects" only has series for the '
+                     'exporter_usage_top_projects projects with the most '
+                     'usage of each service, adding up the usage of the '
+                     'other projects under the project ID "other". '
+                     '"service" has a series for each service and unit, '
+                     'and "global" one for each unit. Default is project.')),
+    cfg.IntOpt('exporter_usage_top_projects', default=100, min=1,
+               help=('The number of projects with their own '
+                     'distil_collector_usage_total series for each service, '
+                     'when exporter_usage_aggregation is "top_projects".')),
+    cfg.IntOpt('exporter_usage_expiry', default=0, min=0,
+               help=('The time, in seconds, after which the '
+                     'distil_collector_usage_total series that have not '
+                     'changed are removed from the Distil Collector '
+                     'Prometheus exporter, checked at the end of each '
+                     'collecting cycle. Default is 0 (never).')),
 ]
 
 ODOO_OPTS = [
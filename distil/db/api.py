@@ -66,6 +66,11 @@ def drop_db():
     return IMPL.drop_db()
 
 
+def dispose_engine():
+    """Close the pooled database connections, e.g. before forking."""
+    return IMPL.dispose_engine()
+
+
 def to_dict(func):
     def decorator(*args, **kwargs):
         res = func(*args, **kwargs)
@@ -88,6 +93,14 @@ def usage_get(project_id, start_at, end_at):
     return IMPL.usage_get(project_id, start_at, end_at)
 
 
+def projects_advance_last_collected(updates):
+    return IMPL.projects_advance_last_collected(updates)
+
+
+def projects_rewind(project_ids, start):
+    return IMPL.projects_rewind(project_ids, start)
+
+
 # NOTE(lingxian): This method is not used anywhere but for testing purpose.
 def usage_add(project_id, resource_id, samples, unit,
               start_at, end_at):
@@ -98,8 +111,10 @@ def usage_add(project_id, resource_id, samples, unit,
                           start_at, end_at)
 
 
-def usages_add(project_id, resources, usage_entries, last_collect):
-    return IMPL.usages_add(project_id, resources, usage_entries, last_collect)
+def usages_add(project_id, resources, usage_entries, last_collect,
+               previous_last_collect=None):
+    return IMPL.usages_add(project_id, resources, usage_entries, last_collect,
+                           previous_last_collect)
 
 
 # NOTE(lingxian): This method is not used anywhere but for testing purpose.
@@ -111,6 +126,10 @@ def project_add(values, last_collect=None):
     return IMPL.project_add(values, last_collect)
 
 
+def projects_add(projects, last_collect=None):
+    return IMPL.projects_add(projects, last_collect)
+
+
 def resource_get_by_ids(project_id, resource_ids):
     return IMPL.resource_get_by_ids(project_id, resource_ids)
 
@@ -153,3 +172,35 @@ def delete_project_lock(project_id):
 def project_lock(project_id, owner):
     with IMPL.project_lock(project_id, owner):
         yield
+
+
+# Project Leases.
+
+def claim_projects(project_ids, owner, limit, lease_seconds):
+    return IMPL.claim_projects(project_ids, owner, limit, lease_seconds)
+
+
+def renew_project_leases(project_ids, owner, lease_seconds):
+    return IMPL.renew_project_leases(project_ids, owner, lease_seconds)
+
+
+def release_project_leases(project_ids, owner):
+    return IMPL.release_project_leases(project_ids, owner)
+
+
+def get_project_leases(project_ids):
+    return IMPL.get_project_leases(project_ids)
+
+
+# Collector Members.
+
+def collector_member_heartbeat(name):
+    return IMPL.collector_member_heartbeat(name)
+
+
+def collector_member_get_all(seen_since):
+    return IMPL.collector_member_get_all(seen_since)
+
+
+def collector_member_delete(name):
+    return IMPL.collector_member_delete(name)
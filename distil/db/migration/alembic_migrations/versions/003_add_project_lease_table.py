@@ -0,0 +1,41 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add-project-lease-table
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '003'
+down_revision = '002'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'project_leases',
+        sa.Column('project_id', sa.String(length=100), nullable=False),
+        sa.Column('owner', sa.String(length=100), nullable=True),
+        sa.Column('expires', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('project_id'),
+    )
+    op.create_index('ix_project_leases_expires', 'project_leases',
+                    ['expires'])
@@ -17,6 +17,7 @@
 
 import contextlib
 from datetime import datetime
+from datetime import timedelta
 import json
 import sys
 import threading
@@ -31,6 +32,8 @@ import sqlalchemy as sa
 from sqlalchemy import func
 
 from distil.db.sqlalchemy import models as m
+from distil.db.sqlalchemy.models import CollectorMember
+from distil.db.sqlalchemy.models import ProjectLease
 from distil.db.sqlalchemy.models import ProjectLock
 from distil.db.sqlalchemy.models import Resource
 from distil.db.sqlalchemy.models import Tenant
@@ -45,6 +48,10 @@ CONF = cfg.CONF
 _FACADE = None
 _LOCK = threading.Lock()
 
+# Maximum number of values in a single IN clause, to stay well within the
+# bound parameter limits of the database backends.
+_IN_CLAUSE_BATCH_SIZE = 500
+
 
 def _create_facade_lazily():
     global _LOCK, _FACADE
@@ -72,6 +79,12 @@ def cleanup():
     _FACADE = None
 
 
+def dispose_engine():
+    """Close the pooled database connections, e.g. before forking."""
+    if _FACADE is not None:
+        _FACADE.get_engine().dispose()
+
+
 def get_backend():
     return sys.modules[__name__]
 
@@ -158,36 +171,41 @@ def _project_get(session, project_id):
     return session.query(Tenant).filter_by(id=project_id).first()
 
 
+def _get_new_project_last_collected(values, last_collect=None):
+    # TODO(callumdickinson): Move this somewhere more generic.
+    # NOTE(callumdickinson): Determine the appropriate value
+    # to use for `last_collected`.
+    # The latest (newest) of the following are used:
+    #   * The maximum acceptable `last_collected` value, calculated by
+    #     subtracting `max_collection_start_age` from the current time
+    #   * The oldest `last_collected` value from the projects to collect
+    #     (passed in as `last_collect`)
+    #   * The project creation time, if the field is recorded in Keytstone
+    #     (as the `created_on` field, added by Adjutant on creation)
+    last_collected_candidates = [
+        get_max_last_collected(
+            CONF.collector.max_collection_start_age,
+        ),
+    ]
+    if last_collect:
+        last_collected_candidates.append(last_collect)
+    if "created_on" in values:
+        last_collected_candidates.append(
+            datetime.strptime(
+                values["created_on"],
+                "%Y-%m-%dT%H:%M:%S",
+            ).replace(minute=0, second=0),
+        )
+    return max(last_collected_candidates)
+
+
 def project_add(values, last_collect=None):
     session = get_session()
     project = _project_get(session, values['id'])
 
     if not project:
-        # TODO(callumdickinson): Move this somewhere more generic.
-        # NOTE(callumdickinson): Determine the appropriate value
-        # to use for `last_collected`.
-        # The latest (newest) of the following are used:
-        #   * The maximum acceptable `last_collected` value, calculated by
-        #     subtracting `max_collection_start_age` from the current time
-        #   * The oldest `last_collected` value from the projects to collect
-        #     (passed in as `last_collect`)
-        #   * The project creation time, if the field is recorded in Keytstone
-        #     (as the `created_on` field, added by Adjutant on creation)
-        last_collected_candidates = [
-            get_max_last_collected(
-                CONF.collector.max_collection_start_age,
-            ),
-        ]
-        if last_collect:
-            last_collected_candidates.append(last_collect)
-        if "created_on" in values:
-            last_collected_candidates.append(
-                datetime.strptime(
-                    values["created_on"],
-                    "%Y-%m-%dT%H:%M:%S",
-                ).replace(minute=0, second=0),
-            )
-        last_collected = max(last_collected_candidates)
+        last_collected = _get_new_project_last_collected(values,
+                                                         last_collect)
 
         project = Tenant(id=values['id'], name=values['name'],
                          info=values['description'], created=datetime.utcnow(),
@@ -203,6 +221,45 @@ def project_add(values, last_collect=None):
     return project
 
 
+def projects_add(projects, last_collect=None):
+    """Add new projects with one bulk INSERT.
+
+    The projects must not be in the database yet. If some of them were
+    added in the meantime, e.g. by another collector, the projects are
+    added one by one instead, keeping the existing ones.
+
+    :return: A dict mapping the ID of each project to its last collected
+             time.
+    """
+    session = get_session()
+    timestamp = datetime.utcnow()
+    rows = [
+        {
+            'id': values['id'],
+            'name': values['name'],
+            'info': values['description'],
+            'created': timestamp,
+            'last_collected': _get_new_project_last_collected(values,
+                                                              last_collect),
+        }
+        for values in projects
+    ]
+    if not rows:
+        return {}
+
+    try:
+        with session.begin(subtransactions=True):
+            session.execute(Tenant.__table__.insert(), rows)
+    except db_exception.DBDuplicateEntry:
+        session.rollback()
+        return dict(
+            (values['id'], project_add(values, last_collect).last_collected)
+            for values in projects
+        )
+
+    return dict((row['id'], row['last_collected']) for row in rows)
+
+
 def project_get_all(**filters):
     session = get_session()
     query = session.query(Tenant)
@@ -296,50 +353,109 @@ def usage_add(project_id, resource_id, samples, unit,
         raise e
 
 
-def _get_resource(session, project_id, resource_id):
-    return session.query(Resource).filter_by(
-        id=resource_id, tenant_id=project_id).first()
+def _resource_get_by_ids(session, project_id, resource_ids):
+    """Get resources of a project by ID, in IN-list sized batches."""
+    resource_ids = list(resource_ids)
+    result = []
+
+    for i in range(0, len(resource_ids), _IN_CLAUSE_BATCH_SIZE):
+        query = session.query(Resource).filter(
+            Resource.tenant_id == project_id,
+            Resource.id.in_(resource_ids[i:i + _IN_CLAUSE_BATCH_SIZE]))
+        result.extend(query.all())
+
+    return result
 
 
-def usages_add(project_id, resources, usage_entries, last_collect):
+def usages_add(project_id, resources, usage_entries, last_collect,
+               previous_last_collect=None):
     """Add resources and usages for a project within one session.
 
-    Update tenant.last_collected as well.
+    Update tenant.last_collected as well. If previous_last_collect is given,
+    nothing is written unless it is still the tenant's last_collected, and
+    DuplicateException is raised instead, as the usage was collected in the
+    meantime.
+
+    Existing resources are loaded with one query, new resources and usage
+    entries are written with bulk INSERTs (executemany), and the tenant is
+    updated with a single UPDATE, all within the same transaction.
     """
     session = get_session()
     timestamp = datetime.utcnow()
 
     try:
         with session.begin(subtransactions=True):
+            existing = dict(
+                (res_db.id, res_db) for res_db in
+                _resource_get_by_ids(session, project_id, resources.keys())
+            )
+
+            new_resources = []
+            updated_resources = []
             for (id, res_info) in six.iteritems(resources):
-                res_db = _get_resource(session, project_id, id)
+                res_db = existing.get(id)
                 if res_db:
                     orig_info = json.loads(res_db.info) or {}
                     orig_info.update(res_info)
-                    res_db.info = json.dumps(orig_info)
+                    updated_resources.append({
+                        'id': id,
+                        'tenant_id': project_id,
+                        'info': json.dumps(orig_info),
+                    })
                 else:
-                    resource_ref = Resource(
-                        id=id,
-                        info=json.dumps(res_info),
-                        tenant_id=project_id,
-                        created=timestamp
-                    )
-                    session.add(resource_ref)
-
-            for entry in usage_entries:
-                entry_db = UsageEntry(
-                    service=entry['service'],
-                    volume=entry['volume'],
-                    unit=entry['unit'],
-                    resource_id=entry['resource_id'],
-                    tenant_id=entry['tenant_id'],
-                    start=entry['start'],
-                    end=entry['end'],
-                    created=timestamp)
-                session.add(entry_db)
-
-            project_db = _project_get(session, project_id)
-            project_db.last_collected = last_collect
+                    new_resources.append({
+                        'id': id,
+                        'tenant_id': project_id,
+                        'info': json.dumps(res_info),
+                        'created': timestamp,
+                    })
+
+            if new_resources:
+                session.execute(Resource.__table__.insert(), new_resources)
+            if updated_resources:
+                session.bulk_update_mappings(Resource, updated_resources)
+
+            if usage_entries:
+                session.execute(
+                    UsageEntry.__table__.insert(),
+                    [
+                        {
+                            'service': entry['service'],
+                            'volume': entry['volume'],
+                            'unit': entry['unit'],
+                            'resource_id': entry['resource_id'],
+                            'tenant_id': entry['tenant_id'],
+                            'start': entry['start'],
+                            'end': entry['end'],
+                            'created': timestamp,
+                        }
+                        for entry in usage_entries
+                    ],
+                )
+
+            table = Tenant.__table__
+            condition = table.c.id == project_id
+            if previous_last_collect is not None:
+                condition = sa.and_(
+                    condition,
+                    table.c.last_collected == previous_last_collect)
+            result = session.execute(
+                table.update().
+                where(condition).
+                values(last_collected=last_collect)
+            )
+            if not result.rowcount and previous_last_collect is not None:
+                raise exceptions.DuplicateException(
+                    "Usage of project %s from %s was already collected." %
+                    (project_id, previous_last_collect)
+                )
+            if not result.rowcount:
+                raise exceptions.NotFoundException(
+                    "Project %s not found." % project_id
+                )
+    except exceptions.DuplicateException:
+        session.rollback()
+        raise
     except Exception as e:
         session.rollback()
         raise exceptions.DBException(
@@ -347,6 +463,83 @@ def usages_add(project_id, resources, usage_entries, last_collect):
         )
 
 
+def projects_advance_last_collected(updates):
+    """Advance the last collected time of projects without usage.
+
+    Each update is a (project_id, previous_last_collect, last_collect)
+    tuple, and is only applied if the project's last_collected is still
+    previous_last_collect. The updates are written with a single bulk
+    UPDATE (executemany).
+    """
+    if not updates:
+        return
+
+    session = get_session()
+    table = Tenant.__table__
+
+    try:
+        with session.begin(subtransactions=True):
+            session.execute(
+                table.update().
+                where(sa.and_(
+                    table.c.id == sa.bindparam('_id'),
+                    table.c.last_collected == sa.bindparam('_previous'),
+                )).
+                values(last_collected=sa.bindparam('_last_collected')),
+                [
+                    {
+                        '_id': project_id,
+                        '_previous': previous,
+                        '_last_collected': last_collect,
+                    }
+                    for project_id, previous, last_collect in updates
+                ],
+            )
+    except Exception as e:
+        session.rollback()
+        raise exceptions.DBException(
+            "Error occurs when advancing last collected time, reason: %s" %
+            str(e)
+        )
+
+
+def projects_rewind(project_ids, start):
+    """Rewind projects collected past start, to collect their usage again.
+
+    The usage entries of the projects from start onwards are deleted, and
+    their last_collected is set back to start, within one transaction.
+    """
+    session = get_session()
+    usage_table = UsageEntry.__table__
+    tenant_table = Tenant.__table__
+    project_ids = list(project_ids)
+
+    try:
+        with session.begin(subtransactions=True):
+            for i in range(0, len(project_ids), _IN_CLAUSE_BATCH_SIZE):
+                batch = project_ids[i:i + _IN_CLAUSE_BATCH_SIZE]
+                session.execute(
+                    usage_table.delete().
+                    where(sa.and_(
+                        usage_table.c.tenant_id.in_(batch),
+                        usage_table.c.start >= start,
+                    ))
+                )
+                session.execute(
+                    tenant_table.update().
+                    where(sa.and_(
+                        tenant_table.c.id.in_(batch),
+                        tenant_table.c.last_collected > start,
+                    )).
+                    values(last_collected=start)
+                )
+    except Exception as e:
+        session.rollback()
+        raise exceptions.DBException(
+            "Error occurs when rewinding projects, reason: %s" % str(e)
+        )
+
+
 def resource_add(project_id, resource_id, resource_info):
     session = get_session()
     resource_ref = Resource(
@@ -368,12 +561,7 @@ def resource_add(project_id, resource_id, resource_info):
 
 def resource_get_by_ids(project_id, resource_ids):
     session = get_session()
-    query = session.query(Resource)
-
-    query = (query.filter(Resource.id.in_(resource_ids)).
-             filter(Resource.tenant_id == project_id))
-
-    return query.all()
+    return _resource_get_by_ids(session, project_id, resource_ids)
 
 
 def get_project_locks(project_id):
@@ -458,3 +646,199 @@ def project_lock(project_id, owner):
         yield
     finally:
         delete_project_lock(project_id)
+
+
+def _skip_locked_supported(dialect):
+    """Whether the database supports SELECT ... FOR UPDATE SKIP LOCKED."""
+    version = dialect.server_version_info or ()
+    if dialect.name == 'postgresql':
+        return version >= (9, 5)
+    if dialect.name == 'mysql':
+        if getattr(dialect, '_is_mariadb', False):
+            return version >= (10, 6)
+        return version >= (8, 0, 1)
+    return False
+
+
+def _ensure_project_leases(session, project_ids):
+    """Create the missing lease records of the given projects, unclaimed."""
+    existing = set()
+    for i in range(0, len(project_ids), _IN_CLAUSE_BATCH_SIZE):
+        query = session.query(ProjectLease.project_id).filter(
+            ProjectLease.project_id.in_(
+                project_ids[i:i + _IN_CLAUSE_BATCH_SIZE]))
+        existing.update(row.project_id for row in query)
+
+    missing = [
+        {'project_id': project_id, 'owner': None, 'expires': None}
+        for project_id in set(project_ids) - existing
+    ]
+    if not missing:
+        return
+
+    insert = ProjectLease.__table__.insert()
+    try:
+        with session.begin(subtransactions=True):
+            session.execute(insert, missing)
+    except db_exception.DBDuplicateEntry:
+        # Another collector created some of them at the same time, so
+        # create the rest one by one.
+        for values in missing:
+            try:
+                with session.begin(subtransactions=True):
+                    session.execute(insert, values)
+            except db_exception.DBDuplicateEntry:
+                pass
+
+
+def claim_projects(project_ids, owner, limit, lease_seconds):
+    """Claim up to limit of the given projects for a lease.
+
+    Projects are claimed in the given order, if they are unclaimed, their
+    lease has expired, or they are already claimed by the owner (which
+    renews the lease). The next candidates are claimed together in one
+    transaction, skipping rows locked by other collectors where the
+    database supports SKIP LOCKED. Elsewhere (e.g. SQLite), the UPDATE
+    checks again that the projects are claimable.
+
+    :return: The IDs of the claimed projects, in the given order.
+    """
+    session = get_session()
+    project_ids = list(project_ids)
+    claimed = []
+
+    try:
+        _ensure_project_leases(session, project_ids)
+
+        table = ProjectLease.__table__
+        skip_locked = _skip_locked_supported(session.get_bind().dialect)
+        i = 0
+        while i < len(project_ids) and len(claimed) < limit:
+            candidates = project_ids[i:i + limit - len(claimed)]
+            i += len(candidates)
+
+            now = datetime.utcnow()
+            claimable = sa.or_(
+                table.c.owner == sa.null(),
+                table.c.owner == owner,
+                table.c.expires < now,
+            )
+            with session.begin(subtransactions=True):
+                query = session.query(ProjectLease.project_id).filter(
+                    ProjectLease.project_id.in_(candidates), claimable)
+                if skip_locked:
+                    query = query.with_for_update(skip_locked=True)
+                claimable_ids = [row.project_id for row in query]
+                if not claimable_ids:
+                    continue
+
+                result = session.execute(
+                    table.update().
+                    where(sa.and_(table.c.project_id.in_(claimable_ids),
+                                  claimable)).
+                    values(owner=owner,
+                           expires=now + timedelta(seconds=lease_seconds))
+                )
+
+            if result.rowcount != len(claimable_ids):
+                # Some were claimed by another collector in the meantime.
+                query = session.query(ProjectLease.project_id).filter(
+                    ProjectLease.project_id.in_(claimable_ids),
+                    ProjectLease.owner == owner)
+                claimable_ids = [row.project_id for row in query]
+
+            claimable_ids = set(claimable_ids)
+            claimed.extend(project_id for project_id in candidates
+                           if project_id in claimable_ids)
+    except Exception as e:
+        session.rollback()
+        raise exceptions.DBException(
+            "Error occurs when claiming projects, reason: %s" % str(e)
+        )
+
+    return claimed
+
+
+def renew_project_leases(project_ids, owner, lease_seconds):
+    """Extend the leases of the given projects still held by the owner.
+
+    :return: The number of leases renewed.
+    """
+    session = get_session()
+    table = ProjectLease.__table__
+    expires = datetime.utcnow() + timedelta(seconds=lease_seconds)
+    project_ids = list(project_ids)
+    renewed = 0
+
+    for i in range(0, len(project_ids), _IN_CLAUSE_BATCH_SIZE):
+        result = session.execute(
+            table.update().
+            where(sa.and_(
+                table.c.project_id.in_(
+                    project_ids[i:i + _IN_CLAUSE_BATCH_SIZE]),
+                table.c.owner == owner,
+            )).
+            values(expires=expires)
+        )
+        renewed += result.rowcount
+
+    return renewed
+
+
+def release_project_leases(project_ids, owner):
+    """Release the leases of the given projects held by the owner."""
+    session = get_session()
+    table = ProjectLease.__table__
+    project_ids = list(project_ids)
+
+    for i in range(0, len(project_ids), _IN_CLAUSE_BATCH_SIZE):
+        session.execute(
+            table.update().
+            where(sa.and_(
+                table.c.project_id.in_(
+                    project_ids[i:i + _IN_CLAUSE_BATCH_SIZE]),
+                table.c.owner == owner,
+            )).
+            values(owner=None, expires=None)
+        )
+
+
+def get_project_leases(project_ids):
+    session = get_session()
+    query = session.query(ProjectLease).filter(
+        ProjectLease.project_id.in_(list(project_ids)))
+    return query.all()
+
+
+def collector_member_heartbeat(name):
+    """Record that the collector member is alive, adding it if new."""
+    session = get_session()
+    now = datetime.utcnow()
+    table = CollectorMember.__table__
+
+    result = session.execute(
+        table.update().where(table.c.name == name).values(last_seen=now))
+    if result.rowcount:
+        return
+
+    try:
+        session.execute(table.insert().values(name=name, last_seen=now))
+    except db_exception.DBDuplicateEntry:
+        # Added by another process with the same name in the meantime.
+        session.execute(
+            table.update().where(table.c.name == name).values(last_seen=now))
+
+
+def collector_member_get_all(seen_since):
+    """Get the names of the collector members seen since the given time."""
+    session = get_session()
+    query = session.query(CollectorMember.name).filter(
+        CollectorMember.last_seen >= seen_since).order_by(
+        CollectorMember.name)
+    return [row.name for row in query]
+
+
+def collector_member_delete(name):
+    session = get_session()
+    table = CollectorMember.__table__
+    session.execute(table.delete().where(table.c.name == name))
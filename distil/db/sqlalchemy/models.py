@@ -128,3 +128,24 @@ class ProjectLock(DistilBase):
     project_id = Column(String(100), primary_key=True, nullable=False)
     owner = Column(String(100), nullable=False)
     created = Column(DateTime, nullable=False)
+
+
+class ProjectLease(DistilBase):
+    """Time-limited claim of a project by a collector.
+
+    A project is unclaimed when it has no owner, or when its lease has
+    expired.
+    """
+    __tablename__ = 'project_leases'
+
+    project_id = Column(String(100), primary_key=True, nullable=False)
+    owner = Column(String(100), nullable=True)
+    expires = Column(DateTime, nullable=True, index=True)
+
+
+class CollectorMember(DistilBase):
+    """Collector instance taking part in project sharding."""
+    __tablename__ = 'collector_members'
+
+    name = Column(String(100), primary_key=True, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
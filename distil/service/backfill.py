@@ -0,0 +1,303 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from datetime import datetime
+import multiprocessing
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from six.moves import queue
+from stevedore import driver
+
+from distil.common import constants
+from distil.common import general
+from distil.common import openstack
+from distil.db import api as db_api
+from distil import exceptions as exc
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Collector used by the current (worker) process.
+_COLLECTOR = None
+
+# How often, in seconds, spans in progress are checked for failures while
+# waiting for their results.
+_POLL_INTERVAL = 1
+
+
+def _init_worker():
+    global _COLLECTOR
+    _COLLECTOR = driver.DriverManager(
+        'distil.collector',
+        CONF.collector.collector_backend,
+        invoke_on_load=True,
+        invoke_kwds={"metrics_processors": []},
+    ).driver
+
+
+def _collect_span(project, windows):
+    """Collect the usage of a project over consecutive windows.
+
+    :return: A (project_id, windows, succeeded) tuple.
+    """
+    try:
+        succeeded = _COLLECTOR.collect_usage(project, windows,
+                                             check_last_collected=True)
+    except Exception:
+        LOG.exception("Backfill failed for project %s(%s).",
+                      project['id'], project['name'])
+        succeeded = False
+    return project['id'], windows, succeeded
+
+
+def _check_window_aligned(name, value):
+    """Check a time is on a window boundary, counted from the epoch.
+
+    Windows collected from a time off their boundaries would overlap the
+    windows collected by distil-collector, e.g. billing usage twice when
+    re-rating.
+    """
+    window_seconds = CONF.collector.collect_window * 3600
+    seconds = (value - datetime(1970, 1, 1)).total_seconds()
+    if seconds % window_seconds:
+        raise exc.DateTimeException(
+            "The %s time %s is not a multiple of the collection window "
+            "(%s hours)." % (name, value.strftime(constants.iso_time),
+                             CONF.collector.collect_window))
+
+
+class _InlineResult(object):
+    """The result of work run by _InlinePool, like an AsyncResult."""
+
+    def __init__(self, successful):
+        self._successful = successful
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self._successful
+
+
+class _InlinePool(object):
+    """Runs the work in the current process, for a single worker."""
+
+    def __init__(self):
+        _init_worker()
+
+    def apply_async(self, func, args, callback):
+        try:
+            result = func(*args)
+        except Exception:
+            LOG.exception("Backfill work failed.")
+            return _InlineResult(False)
+        callback(result)
+        return _InlineResult(True)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class Backfill(object):
+    """Collect the usage of projects up to an end time, in parallel.
+
+    The windows of each project, from its last collected time, are split
+    into spans of span_windows windows. The spans of a project are collected
+    one after another, as each moves its last collected time forward, while
+    up to workers projects are collected at once in a process pool. As the
+    last collected time is stored after each window, a backfill that was
+    interrupted carries on where it stopped when run again.
+
+    A span that raises out of its worker fails its project. A span that does
+    not finish within span_timeout seconds, e.g. as its worker died, ends
+    the backfill.
+
+    The start and end times must be on window boundaries, or DateTimeException
+    is raised.
+    """
+
+    def __init__(self, projects, end, start=None, workers=1,
+                 span_windows=24, rerate=False, span_timeout=None):
+        _check_window_aligned('end', end)
+        if start:
+            _check_window_aligned('start', start)
+        self.projects = collections.OrderedDict(
+            (p['id'], p) for p in projects)
+        self.end = end
+        self.start = start
+        self.workers = workers
+        self.span_windows = span_windows
+        self.rerate = rerate
+        self.span_timeout = span_timeout
+
+    def _get_spans(self):
+        """Get the spans of windows left to collect for each project."""
+        if self.rerate:
+            db_api.projects_rewind(list(self.projects), self.start)
+
+        last_collected = dict(db_api.get_last_collected_all())
+        last_collected.update(db_api.projects_add(
+            [p for p in self.projects.values()
+             if p['id'] not in last_collected],
+            self.start,
+        ))
+
+        spans = collections.OrderedDict()
+        for project_id in self.projects:
+            project_spans = collections.deque()
+            start = last_collected[project_id]
+            while True:
+                windows = general.get_windows(start, self.end,
+                                              max_windows=self.span_windows)
+                if not windows:
+                    break
+                project_spans.append(windows)
+                start = windows[-1][1]
+            if project_spans:
+                spans[project_id] = project_spans
+        return spans
+
+    def _wait_result(self, results, pending):
+        """Wait for the result of a span in progress.
+
+        :param pending: The (async result, windows, start time) of the span
+                        in progress of each project.
+        :return: A (project_id, windows, succeeded) tuple, or None if a
+                 span did not finish within span_timeout.
+        """
+        while True:
+            try:
+                return results.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+            now = datetime.utcnow()
+            for project_id, (result, windows, started) in pending.items():
+                if result.ready() and not result.successful():
+                    # The span raised out of its worker, so the callback
+                    # giving its result was not called.
+                    LOG.error("Backfill of project %s failed in its "
+                              "worker.", project_id)
+                    return project_id, windows, False
+                if (self.span_timeout and
+                        (now - started).total_seconds() > self.span_timeout):
+                    LOG.error("Backfill of project %s from %s did not "
+                              "finish within %s seconds, its worker may "
+                              "have died.", project_id, windows[0][0],
+                              self.span_timeout)
+                    return None
+
+    def _create_pool(self):
+        if self.workers == 1:
+            return _InlinePool()
+        # Connections must not be shared with the worker processes.
+        db_api.dispose_engine()
+        openstack.reset_clients()
+        return multiprocessing.Pool(self.workers, initializer=_init_worker)
+
+    def run(self):
+        """Run the backfill.
+
+        :return: True if the usage of all projects was collected, otherwise
+                 False.
+        """
+        spans = self._get_spans()
+        total = sum(len(w) for s in spans.values() for w in s)
+        LOG.info("Backfilling %s window(s) of %s project(s) up to %s, with "
+                 "%s worker(s). %s project(s) already up-to-date.",
+                 total, len(spans), self.end, self.workers,
+                 len(self.projects) - len(spans))
+        if not spans:
+            return True
+
+        waiting = collections.deque(spans)
+        results = queue.Queue()
+        pool = self._create_pool()
+        started = datetime.utcnow()
+        done = 0
+        failed = []
+        in_progress = 0
+        # The span in progress of each project.
+        pending = {}
+
+        def submit(project_id):
+            windows = spans[project_id].popleft()
+            result = pool.apply_async(
+                _collect_span,
+                (self.projects[project_id], windows),
+                callback=results.put,
+            )
+            pending[project_id] = (result, windows, datetime.utcnow())
+
+        try:
+            while waiting or in_progress:
+                while waiting and in_progress < self.workers:
+                    submit(waiting.popleft())
+                    in_progress += 1
+
+                result = self._wait_result(results, pending)
+                if result is None:
+                    pool.terminate()
+                    pool.join()
+                    LOG.error("Backfill stopped, run it again to carry on "
+                              "from where each project stopped.")
+                    return False
+                project_id, windows, succeeded = result
+                del pending[project_id]
+                done += len(windows)
+                if not succeeded:
+                    # The following spans can only be collected once this
+                    # one is, so the project is left for the next run.
+                    failed.append(project_id)
+                    in_progress -= 1
+                elif spans[project_id]:
+                    submit(project_id)
+                else:
+                    in_progress -= 1
+
+                elapsed = datetime.utcnow() - started
+                LOG.info(
+                    "Backfill progress: %s/%s window(s) (%.1f%%), project "
+                    "%s collected up to %s, %s project(s) failed, %s "
+                    "elapsed.", done, total, 100.0 * done / total,
+                    project_id, windows[-1][1] if succeeded else windows[0][0],
+                    len(failed), elapsed,
+                )
+        except KeyboardInterrupt:
+            LOG.warning("Backfill interrupted, run it again to carry on "
+                        "from where each project stopped.")
+            pool.terminate()
+            pool.join()
+            return False
+
+        pool.close()
+        pool.join()
+
+        if failed:
+            LOG.error("Backfill failed for %s project(s): %s. Run it again "
+                      "to retry them.", len(failed), ', '.join(failed))
+            return False
+
+        LOG.info("Backfill of %s project(s) finished in %s.", len(spans),
+                 datetime.utcnow() - started)
+        return True
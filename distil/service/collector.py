@@ -14,8 +14,10 @@
 # limitations under the License.
 
 from datetime import datetime
+from datetime import timedelta
 import os
 from random import shuffle
+import timeit
 
 import eventlet
 from oslo_config import cfg
@@ -25,15 +27,24 @@ from oslo_service import threadgroup
 from stevedore import driver
 from stevedore import extension
 
+from distil.collector.metrics.base import StageTimings
 from distil.db import api as db_api
 from distil import exceptions
 from distil.common import constants
 from distil.common import general
+from distil.common import hashring
 from distil.common import openstack
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+# Per-project collection results.
+PROJECT_LOCKED = 'locked'
+PROJECT_UP_TO_DATE = 'up-to-date'
+PROJECT_SUCCEEDED = 'succeeded'
+PROJECT_FAILED = 'failed'
+PROJECT_DEFERRED = 'deferred'
+
 
 def filter_projects(projects):
     p_filtered = list()
@@ -52,6 +63,10 @@ def filter_projects(projects):
     return p_filtered
 
 
+def _past_deadline(deadline):
+    return deadline is not None and datetime.utcnow() >= deadline
+
+
 class CollectorService(service.Service):
     def __init__(self):
         super(CollectorService, self).__init__()
@@ -90,6 +105,15 @@ class CollectorService(service.Service):
                 "ignore_tenants."
             )
 
+        if (CONF.collector.shard_membership == 'static' and
+                CONF.collector.shard_members and
+                general.get_process_identifier() not in
+                CONF.collector.shard_members):
+            raise exceptions.InvalidConfig(
+                "Collector %s is not one of the shard_members." %
+                general.get_process_identifier()
+            )
+
     def start(self):
         LOG.info("Starting collector service...")
 
@@ -107,6 +131,13 @@ class CollectorService(service.Service):
 
         if self.thread_grp:
             self.thread_grp.stop()
+        if CONF.collector.shard_membership == 'db':
+            # Leave straight away, so the other members take over the
+            # projects of this collector from their next cycle.
+            try:
+                db_api.collector_member_delete(self.identifier)
+            except Exception:
+                LOG.exception("Leaving the collector members failed.")
         for metrics_processor in self.metrics_processors:
             metrics_processor.stop()
         super(CollectorService, self).stop()
@@ -117,7 +148,7 @@ class CollectorService(service.Service):
         super(CollectorService, self).reset()
         logging.setup(CONF, 'distil-collector')
 
-    def _get_projects_by_order(self, projects):
+    def _get_projects_by_order(self, projects, last_collected):
         if CONF.collector.project_order == 'ascending':
             return projects
         elif CONF.collector.project_order == 'descending':
@@ -126,6 +157,230 @@ class CollectorService(service.Service):
         elif CONF.collector.project_order == 'random':
             shuffle(projects)
             return projects
+        elif CONF.collector.project_order == 'staleness':
+            return sorted(projects, key=lambda p: last_collected[p['id']])
+
+    def _get_shard_members(self):
+        if CONF.collector.shard_membership == 'db':
+            db_api.collector_member_heartbeat(self.identifier)
+            return db_api.collector_member_get_all(
+                datetime.utcnow() -
+                timedelta(seconds=CONF.collector.shard_member_timeout))
+        return CONF.collector.shard_members
+
+    def _get_shard_projects(self, projects):
+        """Get the projects assigned to this collector's shard.
+
+        Projects are assigned to the shard members with a consistent hash of
+        their ID, so that members joining or leaving only move the projects
+        of their own shard. All projects are returned when there are no
+        shard members.
+        """
+        members = self._get_shard_members()
+        if not members:
+            return projects
+
+        ring = hashring.HashRing(members)
+        shard = [p for p in projects
+                 if ring.get_member(p['id']) == self.identifier]
+
+        LOG.info("%s of %s project(s) in the shard of %s, out of %s "
+                 "member(s).", len(shard), len(projects), self.identifier,
+                 len(ring.members))
+
+        return shard
+
+    def _skip_idle_projects(self, projects, last_collected, end):
+        """Advance the last collected time of projects without samples.
+
+        The collector is asked once which projects have samples in the
+        windows of this cycle. The windows of the other projects are
+        skipped, as they have no usage.
+
+        :return: The projects with samples, and the number of idle projects.
+        """
+        windows_by_project = dict(
+            (p['id'], general.get_windows(last_collected[p['id']], end))
+            for p in projects
+        )
+        windows = [w for w in windows_by_project.values() if w]
+        if not windows:
+            return projects, 0
+
+        # Only the windows collected in this cycle are probed.
+        active = self.collector.get_active_projects(
+            min(w[0][0] for w in windows), max(w[-1][1] for w in windows))
+        if active is None:
+            return projects, 0
+
+        active_projects = []
+        updates = []
+        for project in projects:
+            windows = windows_by_project[project['id']]
+            if project['id'] in active or not windows:
+                active_projects.append(project)
+            else:
+                updates.append((project['id'], windows[0][0],
+                                windows[-1][1]))
+
+        db_api.projects_advance_last_collected(updates)
+
+        LOG.info("Advanced the last collected time of %s idle project(s), "
+                 "%s project(s) left to collect.", len(updates),
+                 len(active_projects))
+
+        return active_projects, len(updates)
+
+    def _collect_project_usage(self, project, start, end, deadline=None):
+        """Collect usage for a single project, holding its project lock.
+
+        :return: One of the PROJECT_* collection result constants.
+        """
+        if _past_deadline(deadline):
+            return PROJECT_DEFERRED
+
+        # Check if the project is being processed by other collector
+        # instance. If no, will get a lock and continue processing,
+        # otherwise just skip it.
+        lock_start = timeit.default_timer()
+        locks = db_api.get_project_locks(project['id'])
+        if locks and locks[0].owner != self.identifier:
+            LOG.debug(
+                "Project %s is being processed by collector %s." %
+                (project['id'], locks[0].owner)
+            )
+            return PROJECT_LOCKED
+
+        result = PROJECT_LOCKED
+
+        try:
+            with db_api.project_lock(project['id'], self.identifier):
+                self._publish_lock_duration(
+                    timeit.default_timer() - lock_start)
+                result = self._collect_claimed_project_usage(
+                    project, start, end, deadline)
+        except exceptions.DuplicateException as e:
+            LOG.warning(
+                'Obtaining the project lock failed: %s. Process: %s',
+                e,
+                self.identifier,
+            )
+
+        # Co-operatively yield to give other threads
+        # (mainly metrics processors) a chance to run.
+        eventlet.sleep()
+
+        return result
+
+    def _publish_lock_duration(self, duration):
+        """Publish the time spent acquiring project locks or leases."""
+        timings = StageTimings()
+        timings.add('lock', duration)
+        timings.publish(self.metrics_processors)
+
+    def _collect_claimed_project_usage(self, project, start, end,
+                                       deadline=None):
+        """Collect usage for a single project held by this collector.
+
+        :param start: The project's last collected time, from the cycle's
+            snapshot. Windows collected since by another collector are
+            skipped when storing their usage.
+        :param deadline: The cycle's deadline, after which the project's
+            remaining windows are left to the next cycle.
+        :return: One of the PROJECT_* collection result constants.
+        """
+        windows = general.get_windows(start, end)
+        if not windows:
+            LOG.info(
+                "project %s(%s) already up-to-date.",
+                project['id'], project['name']
+            )
+            return PROJECT_UP_TO_DATE
+        elif self.collector.collect_usage(project, windows,
+                                          check_last_collected=True,
+                                          deadline=deadline):
+            return PROJECT_SUCCEEDED
+        return PROJECT_FAILED
+
+    def _collect_leased_projects_usage(self, projects, last_collected, end,
+                                       deadline=None):
+        """Collect usage for projects claimed in batches with leases.
+
+        Projects are claimed lease_batch_size at a time, collected, and
+        released. While they are held, a heartbeat renews their leases, so
+        that only the leases of a collector that stopped running expire.
+
+        :return: An iterator of PROJECT_* collection results, with
+                 PROJECT_LOCKED for projects held by other collectors, and
+                 PROJECT_DEFERRED for projects not started by the deadline.
+        """
+        projects_by_id = dict((p['id'], p) for p in projects)
+        project_ids = [p['id'] for p in projects]
+        batch_size = CONF.collector.lease_batch_size
+        leased = set()
+        heartbeat = eventlet.spawn(self._renew_project_leases, leased)
+        pool = eventlet.GreenPool(CONF.collector.collect_pool_size)
+
+        try:
+            for i in range(0, len(project_ids), batch_size):
+                # Claim no more projects once the time budget is used up.
+                if _past_deadline(deadline):
+                    for _ in project_ids[i:]:
+                        yield PROJECT_DEFERRED
+                    break
+                batch = project_ids[i:i + batch_size]
+                lock_start = timeit.default_timer()
+                claimed = db_api.claim_projects(
+                    batch, self.identifier, len(batch),
+                    CONF.collector.lease_duration)
+                self._publish_lock_duration(
+                    timeit.default_timer() - lock_start)
+                for project_id in set(batch) - set(claimed):
+                    LOG.debug("Project %s is leased by another collector.",
+                              project_id)
+                    yield PROJECT_LOCKED
+
+                leased.update(claimed)
+                try:
+                    for result in pool.imap(
+                        lambda project_id: self._collect_leased_project_usage(
+                            projects_by_id[project_id],
+                            last_collected[project_id], end, deadline),
+                        claimed,
+                    ):
+                        yield result
+                finally:
+                    leased.difference_update(claimed)
+                    db_api.release_project_leases(claimed, self.identifier)
+        finally:
+            heartbeat.kill()
+
+    def _collect_leased_project_usage(self, project, start, end,
+                                      deadline=None):
+        if _past_deadline(deadline):
+            return PROJECT_DEFERRED
+
+        result = self._collect_claimed_project_usage(project, start, end,
+                                                     deadline)
+
+        # Co-operatively yield to give other threads
+        # (mainly metrics processors) a chance to run.
+        eventlet.sleep()
+
+        return result
+
+    def _renew_project_leases(self, leased):
+        """Renew the leases of the projects being collected, periodically."""
+        interval = CONF.collector.lease_duration / 3.0
+        while True:
+            eventlet.sleep(interval)
+            if not leased:
+                continue
+            try:
+                db_api.renew_project_leases(list(leased), self.identifier,
+                                            CONF.collector.lease_duration)
+            except Exception:
+                LOG.exception("Renewing project leases failed.")
 
     def collect_usage(self):
         # NOTE(dalees): oslo_service LoopingCallBase._run_loop does not handle
@@ -160,11 +415,16 @@ class CollectorService(service.Service):
         projects = openstack.get_projects(
             domains=CONF.collector.include_domains)
         valid_projects = filter_projects(projects)
-        project_ids = [p['id'] for p in valid_projects]
+
+        # Load the last collected time of all projects in one scan, rather
+        # than looking up each project when collecting it.
+        last_collected = dict(db_api.get_last_collected_all())
 
         # For new created project, we use the earliest last collection time
         # among existing valid projects as the start time.
-        last_collect = db_api.get_last_collect(project_ids).last_collected
+        existing = [last_collected[p['id']] for p in valid_projects
+                    if p['id'] in last_collected]
+        last_collect = min(existing) if existing else None
 
         end = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
         if CONF.collect_end_time:
@@ -176,49 +436,68 @@ class CollectorService(service.Service):
         processed_count = 0
         # Number of projects already up-to-date.
         updated_count = 0
-
-        valid_projects = self._get_projects_by_order(valid_projects)
-        for project in valid_projects:
-            # Check if the project is being processed by other collector
-            # instance. If no, will get a lock and continue processing,
-            # otherwise just skip it.
-            locks = db_api.get_project_locks(project['id'])
-            if locks and locks[0].owner != self.identifier:
-                LOG.debug(
-                    "Project %s is being processed by collector %s." %
-                    (project['id'], locks[0].owner)
-                )
+        # Number of projects left to the next cycle.
+        deferred_count = 0
+
+        # NOTE: The shard is taken after last_collect is worked out from
+        # all projects, so that all members start new projects from the
+        # same time.
+        valid_projects = self._get_shard_projects(valid_projects)
+
+        # Add the new projects all at once.
+        last_collected.update(db_api.projects_add(
+            [p for p in valid_projects if p['id'] not in last_collected],
+            last_collect,
+        ))
+
+        if CONF.collector.skip_idle_projects:
+            valid_projects, idle_count = self._skip_idle_projects(
+                valid_projects, last_collected, end)
+            processed_count += idle_count
+            success_count += idle_count
+
+        valid_projects = self._get_projects_by_order(valid_projects,
+                                                     last_collected)
+
+        # Projects not started once the time budget is used up are left to
+        # the next cycle.
+        deadline = None
+        if CONF.collector.cycle_time_budget:
+            deadline = collection_start + timedelta(
+                seconds=CONF.collector.cycle_time_budget)
+
+        # Collect usage for up to collect_pool_size projects at once.
+        # Results are yielded in project order, regardless of which
+        # project finishes first.
+        if CONF.collector.project_claiming == 'lease':
+            results = self._collect_leased_projects_usage(
+                valid_projects, last_collected, end, deadline)
+        else:
+            pool = eventlet.GreenPool(CONF.collector.collect_pool_size)
+            results = pool.imap(
+                lambda project: self._collect_project_usage(
+                    project, last_collected[project['id']], end, deadline),
+                valid_projects,
+            )
+        for result in results:
+            if result == PROJECT_LOCKED:
                 continue
-
-            try:
-                with db_api.project_lock(project['id'], self.identifier):
-                    processed_count += 1
-
-                    # Add a project or get last_collected of existing project.
-                    db_project = db_api.project_add(project, last_collect)
-                    start = db_project.last_collected
-
-                    windows = general.get_windows(start, end)
-                    if not windows:
-                        LOG.info(
-                            "project %s(%s) already up-to-date.",
-                            project['id'], project['name']
-                        )
-                        updated_count += 1
-                        continue
-
-                    if self.collector.collect_usage(project, windows):
-                        success_count += 1
-            except exceptions.DuplicateException as e:
-                LOG.warning(
-                    'Obtaining the project lock failed: %s. Process: %s',
-                    e,
-                    self.identifier,
-                )
-
-            # Co-operatively yield to give other threads
-            # (mainly metrics processors) a chance to run.
-            eventlet.sleep()
+            processed_count += 1
+            if result == PROJECT_UP_TO_DATE:
+                updated_count += 1
+            elif result == PROJECT_SUCCEEDED:
+                success_count += 1
+            elif result == PROJECT_DEFERRED:
+                # Deferred projects are not up-to-date, so they keep the
+                # collector running when collect_end_time is set.
+                deferred_count += 1
+
+        if deferred_count:
+            LOG.warning(
+                "Collecting cycle time budget of %s seconds used up, leaving "
+                "%s project(s) to the next cycle.",
+                CONF.collector.cycle_time_budget, deferred_count,
+            )
 
         LOG.info("Finished collecting usage for %s projects." % success_count)
         collection_end = datetime.utcnow()
@@ -228,13 +507,17 @@ class CollectorService(service.Service):
         collection_taken = collection_end - collection_start
         LOG.info("Collection time was: %ss." % collection_taken.seconds)
 
-        # Update the last_run_end and last_run_duration_seconds metric
-        # on all metrics processors.
+        # Update the last_run_end, last_run_duration_seconds and OpenStack
+        # cache metrics on all metrics processors.
+        cache_stats = openstack.get_cache_stats()
         for metrics_processor in self.metrics_processors:
             metrics_processor.last_run_end(collection_end_timestamp)
             metrics_processor.last_run_duration_seconds(
                 collection_taken.total_seconds(),
             )
+            for namespace, (hits, misses, size) in cache_stats.items():
+                metrics_processor.openstack_cache(
+                    namespace, hits, misses, size)
 
         # If we start distil-collector manually with 'collect_end_time' param
         # specified, the service should be stopped automatically after all
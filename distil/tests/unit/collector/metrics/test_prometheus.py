@@ -310,6 +310,255 @@ class PrometheusCollectorMetricsTest(base.DistilWithDbTestCase):
         else:
             self.fail("Metric 'distil_collector_usage_total' not found")
 
+    @mock.patch("distil.collector.base.BaseCollector.get_meter")
+    def test_stage_duration(self, mock_get_meter):
+        """Test the collection stage and duration metrics."""
+        project_id = "fake_project_id"
+        project = {"id": project_id, "name": "fake_project"}
+        mock_get_meter.return_value = [
+            {
+                "resource_id": "%s/my_container" % project_id,
+                "source": "openstack",
+                "volume": 1024,
+            },
+        ]
+        db_api.project_add(
+            {
+                "id": project_id,
+                "name": "fake_project",
+                "description": "project for test",
+            }
+        )
+        metrics_processor = PrometheusCollectorMetrics("127.0.0.1", 16799)
+        collector = base_collector.BaseCollector(
+            metrics_processors=[metrics_processor],
+        )
+        collector.collect_usage(
+            project,
+            [
+                (datetime(2017, 2, 27, 0), datetime(2017, 2, 27, 1)),
+                (datetime(2017, 2, 27, 1), datetime(2017, 2, 27, 2)),
+            ],
+        )
+        counts = {}
+        for metric in prometheus_parser.text_string_to_metric_families(
+            self.get_exporter_client(metrics_processor).get("/metrics").get_data(as_text=True),
+        ):
+            for sample in metric.samples:
+                if sample.name == "distil_collector_stage_duration_seconds_count":
+                    counts[
+                        (
+                            sample.labels["stage"],
+                            sample.labels["meter"],
+                            sample.labels["transformer"],
+                        )
+                    ] = sample.value
+                elif sample.name in (
+                    "distil_collector_project_duration_seconds_count",
+                    "distil_collector_window_duration_seconds_count",
+                ):
+                    counts[sample.name] = sample.value
+        # One observation of each stage per window.
+        meter = "storage.containers.objects.size"
+        self.assertEqual(2, counts[("get_meter", meter, "")])
+        self.assertEqual(2, counts[("filter_group", meter, "")])
+        self.assertEqual(2, counts[("transform", meter, "max")])
+        self.assertEqual(2, counts[("resource_info", meter, "")])
+        self.assertEqual(2, counts[("usages_add", "", "")])
+        self.assertEqual(
+            1,
+            counts["distil_collector_project_duration_seconds_count"],
+        )
+        self.assertEqual(
+            2,
+            counts["distil_collector_window_duration_seconds_count"],
+        )
+
+    def _get_usage_total(self, metrics_processor):
+        """Get the usage_total metric values, by sorted label values."""
+        values = {}
+        for metric in prometheus_parser.text_string_to_metric_families(
+            self.get_exporter_client(metrics_processor).get("/metrics").get_data(as_text=True),
+        ):
+            for sample in metric.samples:
+                if sample.name == "distil_collector_usage_total":
+                    values[tuple(sorted(sample.labels.items()))] = sample.value
+        return values
+
+    def test_usage_total_aggregation(self):
+        """Test the 'usage_total' metric aggregation levels."""
+        start = datetime(2017, 2, 27)
+        end = datetime(2017, 2, 27, 1)
+        usages = {
+            "project_1": [("o1.standard", "byte", 10), ("c1.c1r1", "hour", 1)],
+            "project_2": [("o1.standard", "byte", 20)],
+        }
+        expected = {
+            "service": {
+                (("service", "c1.c1r1"), ("unit", "hour")): 1,
+                (("service", "o1.standard"), ("unit", "byte")): 30,
+            },
+            "global": {
+                (("unit", "byte"),): 30,
+                (("unit", "hour"),): 1,
+            },
+        }
+        for aggregation, values in expected.items():
+            metrics_processor = PrometheusCollectorMetrics(
+                "127.0.0.1",
+                16799,
+                usage_aggregation=aggregation,
+            )
+            for project_id, project_usages in sorted(usages.items()):
+                metrics_processor.usage_batch(project_id, start, end,
+                                              project_usages)
+            self.assertEqual(values, self._get_usage_total(metrics_processor))
+
+    def test_usage_total_top_projects(self):
+        """Test the 'usage_total' metric aggregated by top projects."""
+        start = datetime(2017, 2, 27)
+        end = datetime(2017, 2, 27, 1)
+        metrics_processor = PrometheusCollectorMetrics(
+            "127.0.0.1",
+            16799,
+            usage_aggregation="top_projects",
+            usage_top_projects=2,
+        )
+        for project_id, volume in (
+            ("project_1", 10),
+            ("project_2", 20),
+            ("project_3", 5),
+            # Takes the place of project_1, with more usage in total.
+            ("project_4", 15),
+        ):
+            metrics_processor.usage_batch(project_id, start, end,
+                                          [("o1.standard", "byte", volume)])
+
+        self.assertEqual(
+            {
+                (("project_id", "project_2"), ("service", "o1.standard"),
+                 ("unit", "byte")): 20,
+                (("project_id", "other"), ("service", "o1.standard"),
+                 ("unit", "byte")): 5,
+                (("project_id", "project_4"), ("service", "o1.standard"),
+                 ("unit", "byte")): 15,
+            },
+            self._get_usage_total(metrics_processor),
+        )
+
+    @mock.patch("distil.collector.metrics.prometheus._get_utcnow_timestamp")
+    def test_usage_total_expiry(self, mock_timestamp):
+        """Test the expiry of unchanged 'usage_total' metric series."""
+        start = datetime(2017, 2, 27)
+        end = datetime(2017, 2, 27, 1)
+        mock_timestamp.return_value = 1000.0
+        metrics_processor = PrometheusCollectorMetrics(
+            "127.0.0.1",
+            16799,
+            usage_expiry=600,
+        )
+        metrics_processor.usage_batch("project_1", start, end,
+                                      [("o1.standard", "byte", 10)])
+        # Series only ever increased by 0 expire as well.
+        metrics_processor.usage_batch("project_3", start, end,
+                                      [("o1.standard", "byte", 0)])
+        mock_timestamp.return_value = 1300.0
+        metrics_processor.usage_batch("project_3", start, end,
+                                      [("o1.standard", "byte", 0)])
+        metrics_processor.usage_batch("project_2", start, end,
+                                      [("o1.standard", "byte", 20)])
+
+        metrics_processor.last_run_end(1500.0)
+        self.assertEqual(
+            set(["project_1", "project_2", "project_3"]),
+            set(dict(labels)["project_id"] for labels in
+                self._get_usage_total(metrics_processor)),
+        )
+
+        metrics_processor.last_run_end(1600.0)
+        self.assertEqual(
+            set(["project_2"]),
+            set(dict(labels)["project_id"] for labels in
+                self._get_usage_total(metrics_processor)),
+        )
+
+    @mock.patch("distil.collector.metrics.prometheus."
+                "TRACKED_PROJECTS_FACTOR", 3)
+    def test_usage_total_top_projects_tracked(self):
+        """Test the bound on the project totals kept for top projects."""
+        start = datetime(2017, 2, 27)
+        end = datetime(2017, 2, 27, 1)
+        metrics_processor = PrometheusCollectorMetrics(
+            "127.0.0.1",
+            16799,
+            usage_aggregation="top_projects",
+            usage_top_projects=1,
+        )
+        for project_id, volume in (
+            ("project_1", 30),
+            ("project_2", 20),
+            ("project_3", 10),
+            # Drops the total of project_3, with the least usage.
+            ("project_4", 15),
+        ):
+            metrics_processor.usage_batch(project_id, start, end,
+                                          [("o1.standard", "byte", volume)])
+
+        key = ("o1.standard", "byte")
+        self.assertEqual(
+            {"project_1": 30, "project_2": 20, "project_4": 15},
+            metrics_processor._usage_project_totals[key],
+        )
+        self.assertEqual(
+            set([("project_1",) + key, ("project_2",) + key,
+                 ("project_4",) + key]),
+            set(metrics_processor._usage_project_updated),
+        )
+
+    def test_openstack_cache(self):
+        """Test the OpenStack metadata cache metrics."""
+        metrics_processor = PrometheusCollectorMetrics("127.0.0.1", 16799)
+        metrics_processor.openstack_cache("flavors", 3, 2, 2)
+        metrics_processor.openstack_cache("flavors", 5, 2, 2)
+        metrics_processor.openstack_cache("volume_types", 1, 1, None)
+        values = {}
+        for metric in prometheus_parser.text_string_to_metric_families(
+            self.get_exporter_client(metrics_processor).get("/metrics").get_data(as_text=True),
+        ):
+            for sample in metric.samples:
+                if sample.name.startswith("distil_collector_openstack_cache"):
+                    values[(sample.name, sample.labels["namespace"])] = (
+                        sample.value
+                    )
+        self.assertEqual(
+            {
+                ("distil_collector_openstack_cache_hits_total", "flavors"): 5,
+                ("distil_collector_openstack_cache_misses_total", "flavors"): 2,
+                ("distil_collector_openstack_cache_entries", "flavors"): 2,
+                ("distil_collector_openstack_cache_hits_total", "volume_types"): 1,
+                ("distil_collector_openstack_cache_misses_total", "volume_types"): 1,
+            },
+            {
+                key: value for key, value in values.items()
+                if not key[0].endswith("_created")
+            },
+        )
+
+    def test_untrusted_samples(self):
+        """Test the untrusted samples are counted by source name."""
+        metrics_processor = PrometheusCollectorMetrics("127.0.0.1", 16799)
+        metrics_processor.untrusted_samples("project_1", "project_1:src", 3)
+        metrics_processor.untrusted_samples("project_2", "project_2:src", 2)
+        metrics_processor.untrusted_samples("project_1", "openstack", 1)
+        values = {}
+        for metric in prometheus_parser.text_string_to_metric_families(
+            self.get_exporter_client(metrics_processor).get("/metrics").get_data(as_text=True),
+        ):
+            for sample in metric.samples:
+                if sample.name == "distil_collector_untrusted_samples_total":
+                    values[sample.labels["source"]] = sample.value
+        self.assertEqual({"src": 5, "openstack": 1}, values)
+
     def get_exporter_client(self, metrics_processor):
         """Create a client for sending requests to the Prometheus exporter."""
         return WerkzeugClient(
@@ -15,6 +15,8 @@
 
 from datetime import datetime
 from datetime import timedelta
+import hashlib
+import json
 import os
 
 import mock
@@ -22,8 +24,10 @@ import mock
 from decimal import Decimal
 
 from distil.collector import base as collector_base
+from distil.collector.metrics import base as metrics_base
 from distil.common import constants
 from distil.db import api as db_api
+from distil import exceptions as exc
 from distil.service import collector
 from distil.tests.unit import base
 from distil.tests.unit.collector.utils import FakeCeilometerSample
@@ -53,18 +57,13 @@ class CollectorBaseTest(base.DistilWithDbTestCase):
             group='collector'
         )
 
-    @mock.patch('distil.common.openstack.get_root_volume')
-    @mock.patch('distil.common.openstack.get_image')
+    @mock.patch('distil.common.openstack.get_root_volume_image_metadata')
+    @mock.patch('distil.common.openstack.get_image_os_distro')
     def test_get_os_distro_instance_active_boot_from_image(self,
                                                            mock_get_image,
                                                            mock_get_root):
         mock_get_root.return_value = None
-
-        class Image(object):
-            def __init__(self):
-                self.os_distro = 'linux'
-
-        mock_get_image.return_value = Image()
+        mock_get_image.return_value = 'linux'
 
         entry = {
             'resource_id': 'fake_vm_id',
@@ -80,19 +79,13 @@ class CollectorBaseTest(base.DistilWithDbTestCase):
 
         self.assertEqual('linux', os_distro)
 
-    @mock.patch('distil.common.openstack.get_root_volume',
+    @mock.patch('distil.common.openstack.get_root_volume_image_metadata',
                 side_effect=Exception())
-    @mock.patch('distil.common.openstack.get_image')
+    @mock.patch('distil.common.openstack.get_image_os_distro')
     def test_get_os_distro_instance_delete_boot_from_image(self,
                                                            mock_get_image,
                                                            mock_get_root):
-        mock_get_root.return_value = None
-
-        class Image(object):
-            def __init__(self):
-                self.os_distro = 'linux'
-
-        mock_get_image.return_value = Image()
+        mock_get_image.return_value = 'linux'
 
         entry = {
             'resource_id': 'fake_vm_id',
@@ -108,14 +101,28 @@ class CollectorBaseTest(base.DistilWithDbTestCase):
 
         self.assertEqual('linux', os_distro)
 
-    @mock.patch('distil.common.openstack.get_root_volume')
+    @mock.patch('distil.common.openstack.get_root_volume_image_metadata')
+    @mock.patch('distil.common.openstack.get_image_os_distro')
+    def test_get_os_distro_image_without_os_distro(self, mock_get_image,
+                                                   mock_get_root):
+        mock_get_root.return_value = None
+        mock_get_image.return_value = None
+
+        entry = {
+            'resource_id': 'fake_vm_id',
+            'metadata': {
+                'image_ref_url': 'http://cloud:9292/images/1-2-3-4'
+            }
+        }
+
+        collector = collector_base.BaseCollector()
+
+        self.assertEqual('unknown', collector._get_os_distro(entry))
+
+    @mock.patch('distil.common.openstack.get_root_volume_image_metadata')
     def test_get_os_distro_instance_active_boot_from_volume(self,
                                                             mock_get_root):
-        class Volume(object):
-            def __init__(self):
-                self.volume_image_metadata = {'os_distro': 'linux'}
-
-        mock_get_root.return_value = Volume()
+        mock_get_root.return_value = {'os_distro': 'linux'}
 
         entry = {
             'resource_id': 'fake_vm_id',
@@ -131,7 +138,7 @@ class CollectorBaseTest(base.DistilWithDbTestCase):
 
         self.assertEqual('linux', os_distro)
 
-    @mock.patch('distil.common.openstack.get_root_volume',
+    @mock.patch('distil.common.openstack.get_root_volume_image_metadata',
                 side_effect=Exception())
     def test_get_os_distro_instance_delete_boot_from_volume(self,
                                                             mock_get_root):
@@ -929,3 +936,519 @@ class CollectorBaseTest(base.DistilWithDbTestCase):
         ]
 
         self.assertEqual(expected, actual)
+
+    @mock.patch('distil.collector.base.BaseCollector.get_meter')
+    def test_collect_usage_known_resources(self, mock_get_meter):
+        end = datetime(2017, 2, 27, 1)
+        start = end - timedelta(hours=1)
+        project = "test_collect_usage_known_resources"
+        container_ids = [
+            "%s/container_%s" % (project, i) for i in range(3)
+        ]
+        hashed_ids = [
+            hashlib.md5(container_id.encode('utf-8')).hexdigest()
+            for container_id in container_ids
+        ]
+
+        mock_get_meter.return_value = [
+            {
+                "resource_id": container_id,
+                "source": "openstack",
+                "volume": 1024,
+            }
+            for container_id in container_ids
+        ]
+
+        db_api.project_add(
+            {"id": project, "name": project, "description": project})
+        # The first container has already been collected before.
+        db_api.resource_add(project, hashed_ids[0],
+                            {"type": "Object Storage Container",
+                             "name": "renamed"})
+
+        with mock.patch(
+            "distil.db.api.resource_get_by_ids",
+            side_effect=db_api.resource_get_by_ids,
+        ) as mock_get_resources:
+            collector = collector_base.BaseCollector()
+            ret = collector.collect_usage(
+                {"name": project, "id": project},
+                [(start, end)],
+            )
+
+        self.assertTrue(ret)
+        # Existing resources are looked up once for the whole window.
+        self.assertEqual(1, mock_get_resources.call_count)
+        self.assertEqual(
+            sorted(hashed_ids),
+            sorted(mock_get_resources.call_args[0][1]),
+        )
+
+        names = dict(
+            (res["id"], json.loads(res["info"])["name"])
+            for res in [
+                r.to_dict()
+                for r in db_api.resource_get_by_ids(project, hashed_ids)
+            ]
+        )
+        # Properties of existing resources are not overwritten.
+        self.assertEqual(
+            {
+                hashed_ids[0]: "renamed",
+                hashed_ids[1]: "container_1",
+                hashed_ids[2]: "container_2",
+            },
+            names,
+        )
+
+    def test_compile_mapping(self):
+        self.conf.set_default(
+            "meter_mappings_file",
+            os.path.join(
+                os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+                "test_collect_usage_filters_multiple",
+                "meter_mappings.yaml",
+            ),
+            group="collector",
+        )
+
+        collector = collector_base.BaseCollector()
+
+        self.assertEqual(1, len(collector.mapping_plans))
+        mapping = collector.mapping_plans[0]
+        self.assertEqual("cim.coe.cluster", mapping.meter)
+        self.assertEqual("coe1.worker", mapping.service)
+        self.assertEqual("%s", mapping.res_id_template)
+        self.assertEqual(2, len(mapping.filters))
+        self.assertEqual(
+            "to_number(metadata.node_count) >= `3`",
+            mapping.filters[0].expression,
+        )
+        self.assertEqual(1, len(mapping.volume_sources))
+        self.assertIsNone(mapping.volume_fixed)
+        self.assertEqual((("name", ("name",), None),), mapping.metadata)
+
+    def test_compile_mapping_invalid_filter(self):
+        self.conf.set_default(
+            "meter_mappings_file",
+            os.path.join(
+                os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+                "test_compile_mapping_invalid_filter",
+                "meter_mappings.yaml",
+            ),
+            group="collector",
+        )
+
+        self.assertRaises(exc.InvalidConfig, collector_base.BaseCollector)
+
+    @mock.patch("distil.transformer.get_transformer")
+    @mock.patch("distil.collector.base.BaseCollector.get_meter")
+    def test_collect_usage_transformer_loaded_once(self, mock_get_meter,
+                                                   mock_get_transformer):
+        end = datetime(2017, 2, 27, 3)
+        project = "test_collect_usage_transformer_loaded_once"
+        mock_get_meter.return_value = []
+        db_api.project_add(
+            {"id": project, "name": project, "description": project})
+
+        collector = collector_base.BaseCollector()
+        ret = collector.collect_usage(
+            {"name": project, "id": project},
+            [(end - timedelta(hours=i + 1), end - timedelta(hours=i))
+             for i in reversed(range(3))],
+        )
+
+        self.assertTrue(ret)
+        self.assertEqual(
+            len(collector.meter_mappings),
+            mock_get_transformer.call_count,
+        )
+
+    @mock.patch("distil.collector.base.BaseCollector.get_meter")
+    def test_collect_usage_check_last_collected(self, mock_get_meter):
+        project = "test_collect_usage_check_last_collected"
+        mock_get_meter.return_value = []
+        last_collected = db_api.project_add(
+            {"id": project, "name": project, "description": project},
+        ).last_collected
+
+        # The first window was collected in the meantime.
+        collector = collector_base.BaseCollector()
+        ret = collector.collect_usage(
+            {"name": project, "id": project},
+            [(last_collected - timedelta(hours=1), last_collected),
+             (last_collected, last_collected + timedelta(hours=1))],
+            check_last_collected=True,
+        )
+
+        # The project is skipped from the first window, without storing
+        # anything.
+        self.assertTrue(ret)
+        self.assertEqual(
+            set([last_collected - timedelta(hours=1)]),
+            set(call[0][2] for call in mock_get_meter.call_args_list),
+        )
+        self.assertEqual(last_collected,
+                         db_api.project_get(project).last_collected)
+
+    @mock.patch("distil.collector.base.BaseCollector.get_meter")
+    def test_collect_usage_deadline(self, mock_get_meter):
+        project = "test_collect_usage_deadline"
+        mock_get_meter.return_value = []
+        last_collected = db_api.project_add(
+            {"id": project, "name": project, "description": project},
+        ).last_collected
+
+        # The deadline has passed, so only the first window is collected.
+        collector = collector_base.BaseCollector()
+        ret = collector.collect_usage(
+            {"name": project, "id": project},
+            [(last_collected, last_collected + timedelta(hours=1)),
+             (last_collected + timedelta(hours=1),
+              last_collected + timedelta(hours=2))],
+            check_last_collected=True,
+            deadline=datetime.utcnow(),
+        )
+
+        self.assertTrue(ret)
+        self.assertEqual(
+            set([last_collected]),
+            set(call[0][2] for call in mock_get_meter.call_args_list),
+        )
+        self.assertEqual(last_collected + timedelta(hours=1),
+                         db_api.project_get(project).last_collected)
+
+    @mock.patch('distil.collector.base.BaseCollector.get_meter')
+    def test_collect_usage_streamed(self, mock_get_meter):
+        self.override_config('collector', stream_samples=True,
+                             sample_page_size=2)
+        end = datetime(2017, 2, 27, 1)
+        start = end - timedelta(hours=1)
+        project = "test_collect_usage_streamed"
+        container_ids = [
+            "%s/container_%s" % (project, i) for i in range(3)
+        ]
+
+        # Samples of the containers are interleaved, as they would be
+        # when sorted by timestamp.
+        mock_get_meter.return_value = [
+            {
+                "resource_id": container_id,
+                "source": "openstack",
+                "volume": volume,
+            }
+            for volume in (1024, 2048)
+            for container_id in container_ids
+        ]
+
+        db_api.project_add(
+            {"id": project, "name": project, "description": project})
+
+        with mock.patch(
+            "distil.db.api.resource_get_by_ids",
+            side_effect=db_api.resource_get_by_ids,
+        ) as mock_get_resources:
+            collector = collector_base.BaseCollector()
+            ret = collector.collect_usage(
+                {"name": project, "id": project},
+                [(start, end)],
+            )
+
+        self.assertTrue(ret)
+        # Each batch of resources holds up to sample_page_size samples.
+        self.assertEqual(3, mock_get_resources.call_count)
+
+        entries = db_api.usage_get(project, start, end)
+        self.assertEqual(3, len(entries))
+        for entry in entries:
+            self.assertEqual(2048, entry.volume)
+
+    @mock.patch('distil.collector.base.BaseCollector.iter_meter')
+    def test_collect_usage_streamed_out_of_order(self, mock_iter_meter):
+        self.override_config('collector', stream_samples=True)
+        end = datetime(2017, 2, 27, 1)
+        start = end - timedelta(hours=1)
+        project = "test_collect_usage_streamed_out_of_order"
+        mock_iter_meter.side_effect = lambda *args: iter([
+            {"resource_id": resource_id, "source": "openstack", "volume": 1}
+            for resource_id in ("%s/a" % project, "%s/b" % project,
+                                "%s/a" % project)
+        ])
+        db_api.project_add(
+            {"id": project, "name": project, "description": project})
+
+        collector = collector_base.BaseCollector()
+        ret = collector.collect_usage(
+            {"name": project, "id": project},
+            [(start, end)],
+        )
+
+        self.assertFalse(ret)
+        self.assertEqual([], db_api.usage_get(project, start, end))
+
+    def test_filter_and_group_trust_sources(self):
+        self.override_config(
+            'collector',
+            trust_sources=['openstack', '.{32}:TrafficAccounting'],
+        )
+        traffic_source = '22c4f150358e4ed287fa51e050d7f024:TrafficAccounting'
+        usage = [
+            {'source': 'openstack', 'resource_id': 1},
+            {'source': traffic_source, 'resource_id': 2},
+            {'source': 'fake', 'resource_id': 3},
+            {'source': 'openstack', 'resource_id': 1},
+            {'source': 'fake', 'resource_id': 3},
+        ]
+
+        collector = collector_base.BaseCollector()
+        usage_by_resource = {}
+        untrusted = collector._filter_and_group(usage, usage_by_resource)
+
+        self.assertEqual(
+            {
+                1: [usage[0], usage[3]],
+                2: [usage[1]],
+            },
+            usage_by_resource,
+        )
+        self.assertEqual({'fake': 2}, untrusted)
+        # The verdict is remembered for each distinct source.
+        self.assertEqual(
+            {'openstack': True, traffic_source: True, 'fake': False},
+            collector._trusted_sources,
+        )
+
+    @mock.patch('distil.collector.base.BaseCollector.get_meter')
+    def test_collect_usage_untrusted_samples(self, mock_get_meter):
+        self.override_config('collector', trust_sources=['openstack'])
+        end = datetime(2017, 2, 27, 1)
+        start = end - timedelta(hours=1)
+        project = "test_collect_usage_untrusted_samples"
+        mock_get_meter.return_value = [
+            {
+                "resource_id": "%s/container" % project,
+                "source": "fake",
+                "volume": 1024,
+            },
+        ]
+        db_api.project_add(
+            {"id": project, "name": project, "description": project})
+
+        metrics_processor = mock.Mock()
+        collector = collector_base.BaseCollector(
+            metrics_processors=[metrics_processor])
+        ret = collector.collect_usage(
+            {"name": project, "id": project},
+            [(start, end)],
+        )
+
+        self.assertTrue(ret)
+        # The samples of every mapped meter come from the untrusted source.
+        metrics_processor.untrusted_samples.assert_called_once_with(
+            project_id=project,
+            source="fake",
+            count=len(collector.mapping_plans),
+        )
+        metrics_processor.usage_batch.assert_not_called()
+
+    @mock.patch('distil.collector.base.BaseCollector.get_meter')
+    def test_collect_usage_catch_up(self, mock_get_meter):
+        self.override_config('collector', catch_up=True)
+        end = datetime(2017, 2, 27, 3)
+        start = end - timedelta(hours=3)
+        windows = [(start + timedelta(hours=i),
+                    start + timedelta(hours=i + 1)) for i in range(3)]
+        project = "test_collect_usage_catch_up"
+        resource_id = "%s/container" % project
+
+        # One sample per window, the volume being the window's hour.
+        mock_get_meter.return_value = [
+            {
+                "resource_id": resource_id,
+                "source": "openstack",
+                "timestamp": (window_start + timedelta(minutes=30)).strftime(
+                    constants.date_format_f),
+                "volume": i + 1,
+            }
+            for i, (window_start, _window_end) in enumerate(windows)
+        ]
+
+        db_api.project_add(
+            {"id": project, "name": project, "description": project},
+            start)
+
+        collector = collector_base.BaseCollector()
+        collector.supports_catch_up = True
+        ret = collector.collect_usage({"name": project, "id": project},
+                                      windows)
+
+        self.assertTrue(ret)
+        # The samples of all the windows are fetched at once.
+        mock_get_meter.assert_called_once_with(project, mock.ANY, start, end)
+
+        for i, (window_start, window_end) in enumerate(windows):
+            entries = db_api.usage_get(project, window_start, window_end)
+            self.assertEqual([i + 1], [entry.volume for entry in entries])
+        self.assertEqual(end, db_api.project_get(project).last_collected)
+
+    @mock.patch('distil.collector.base.BaseCollector.get_meter')
+    def test_collect_usage_usage_batch(self, mock_get_meter):
+        end = datetime(2017, 2, 27, 1)
+        start = end - timedelta(hours=1)
+        project = "test_collect_usage_usage_batch"
+        mock_get_meter.return_value = [
+            {
+                "resource_id": "%s/container_%s" % (project, volume),
+                "source": "openstack",
+                "volume": volume,
+            }
+            for volume in (1024, 2048)
+        ]
+        db_api.project_add(
+            {"id": project, "name": project, "description": project})
+
+        metrics_processor = mock.Mock()
+        collector = collector_base.BaseCollector(
+            metrics_processors=[metrics_processor])
+        ret = collector.collect_usage(
+            {"name": project, "id": project},
+            [(start, end)],
+        )
+
+        self.assertTrue(ret)
+        # The usage of both containers is handed over at once, added up.
+        metrics_processor.usage_batch.assert_called_once_with(
+            project, start, end, [("o1.standard", "byte", 3072)])
+        metrics_processor.usage.assert_not_called()
+
+    @mock.patch('eventlet.spawn_n')
+    @mock.patch('distil.collector.base.BaseCollector.get_meter')
+    def test_collect_usage_async_metrics_dispatch(self, mock_get_meter,
+                                                  mock_spawn_n):
+        self.override_config('collector', async_metrics_dispatch=True)
+        end = datetime(2017, 2, 27, 1)
+        start = end - timedelta(hours=1)
+        project = "test_collect_usage_async_metrics_dispatch"
+        mock_get_meter.return_value = [
+            {
+                "resource_id": "%s/container" % project,
+                "source": "openstack",
+                "volume": 1024,
+            },
+        ]
+        db_api.project_add(
+            {"id": project, "name": project, "description": project})
+
+        metrics_processor = mock.Mock()
+        collector = collector_base.BaseCollector(
+            metrics_processors=[metrics_processor])
+        ret = collector.collect_usage(
+            {"name": project, "id": project},
+            [(start, end)],
+        )
+
+        self.assertTrue(ret)
+        mock_spawn_n.assert_called_once_with(
+            collector_base._dispatch_usage_batch, metrics_processor,
+            project, start, end, [("o1.standard", "byte", 1024)])
+        metrics_processor.usage_batch.assert_not_called()
+
+    def test_usage_batch_fallback(self):
+        start = datetime(2017, 2, 27)
+        end = start + timedelta(hours=1)
+        metrics_processor = metrics_base.BaseCollectorMetrics()
+
+        with mock.patch.object(metrics_processor, 'usage') as mock_usage:
+            metrics_processor.usage_batch(
+                'fake_project', start, end,
+                [('o1.standard', 'byte', 3072),
+                 ('b1.standard', 'gigabyte', 2)])
+
+        self.assertEqual(
+            [
+                mock.call(project_id='fake_project', service='o1.standard',
+                          unit='byte', resource_id=None, start=start,
+                          end=end, volume=3072),
+                mock.call(project_id='fake_project', service='b1.standard',
+                          unit='gigabyte', resource_id=None, start=start,
+                          end=end, volume=2),
+            ],
+            mock_usage.call_args_list,
+        )
+
+    @mock.patch('distil.common.openstack.prefetch_volume_types')
+    def test_prefetch_volume_types(self, mock_prefetch):
+        collector = collector_base.BaseCollector()
+        collector.mapping_plans = tuple(
+            collector._compile_mapping({
+                'meter': meter,
+                'type': 'Volume',
+                'unit': 'gigabyte',
+                'transformer': transformer,
+                'metadata': {},
+            })
+            for meter, transformer in (
+                ('volume.size', 'blockstoragemax'),
+                ('database.volume', 'databasevolumemax'),
+                ('instance', 'max'),
+            )
+        )
+
+        collector._prefetch_volume_types('project_1', {
+            'volume.size': [
+                {'metadata': {'volume_type': 'type_1'}},
+                {'metadata': {'volume_type': 'type_1'}},
+                {'metadata': {}},
+            ],
+            'database.volume': [
+                {'metadata': {'volume_id': 'volume_1'}},
+            ],
+            'instance': [
+                {'metadata': {'volume_id': 'volume_2'}},
+            ],
+        })
+
+        mock_prefetch.assert_called_once_with(
+            'project_1', set(['volume_1']), set(['type_1']))
+
+    @mock.patch('distil.common.openstack.prefetch_volume_types')
+    def test_prefetch_volume_types_no_volumes(self, mock_prefetch):
+        collector = collector_base.BaseCollector()
+
+        collector._prefetch_volume_types('project_1', {
+            mapping.meter: [{'metadata': {'volume_id': 'volume_1'}}]
+            for mapping in collector.mapping_plans
+        })
+
+        mock_prefetch.assert_not_called()
+
+    @mock.patch('distil.common.openstack.prefetch_container_policies')
+    def test_prefetch_container_policies(self, mock_prefetch):
+        collector = collector_base.BaseCollector()
+        collector.mapping_plans = tuple(
+            collector._compile_mapping({
+                'meter': meter,
+                'type': 'Object Storage Container',
+                'unit': 'byte',
+                'transformer': transformer,
+                'metadata': {},
+            })
+            for meter, transformer in (
+                ('storage.containers.objects.size', 'objectstoragemax'),
+                ('storage.objects.size', 'max'),
+            )
+        )
+
+        collector._prefetch_container_policies('project_1', {
+            'storage.containers.objects.size': [
+                {'resource_id': 'project_1/container_1'},
+                {'resource_id': 'project_1/container_1'},
+                {'resource_id': 'project_1/container_2'},
+            ],
+            'storage.objects.size': [
+                {'resource_id': 'project_1/container_3'},
+            ],
+        })
+
+        mock_prefetch.assert_called_once_with(
+            'project_1', set(['container_1', 'container_2']))
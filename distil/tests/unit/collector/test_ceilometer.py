@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 from datetime import datetime
 from datetime import timedelta
@@ -41,6 +42,16 @@ class CeilometerCollectorTest(base.DistilTestCase):
             group='collector'
         )
 
+        transformer_file = os.path.join(
+            os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+            'transformer.yaml'
+        )
+        self.conf.set_default(
+            'transformer_file',
+            transformer_file,
+            group='collector'
+        )
+
     @mock.patch('distil.common.openstack.get_ceilometer_client')
     def test_get_meter(self, mock_cclient):
         class Sample(object):
@@ -66,3 +77,246 @@ class CeilometerCollectorTest(base.DistilTestCase):
         expected = [s3.to_dict(), s2.to_dict(), s1.to_dict()]
 
         self.assertEqual(expected, samples)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    def test_get_meters(self, mock_cclient):
+        cclient = mock.Mock()
+        mock_cclient.return_value = cclient
+        cclient.new_samples.list.return_value = []
+
+        collector = ceilometer.CeilometerCollector()
+        usage_by_meter = collector.get_meters(
+            FAKE_PROJECT, ['instance', 'volume.size', 'instance'], START, END)
+
+        # Without batching, there is one query per distinct meter.
+        self.assertEqual(2, cclient.new_samples.list.call_count)
+        self.assertEqual({'instance': [], 'volume.size': []}, usage_by_meter)
+        cclient.query_samples.query.assert_not_called()
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    def test_get_meters_batched(self, mock_cclient):
+        self.override_config('collector', batch_meter_queries=True)
+
+        class Sample(object):
+            def __init__(self, id, meter, timestamp):
+                self.id = id
+                self.meter = meter
+                self.timestamp = timestamp
+
+            def to_dict(self):
+                return {'meter': self.meter, 'resource_id': self.id,
+                        'timestamp': self.timestamp}
+
+        s1 = Sample('111', 'instance', datetime.utcnow() + timedelta(days=3))
+        s2 = Sample('222', 'volume.size', datetime.utcnow() + timedelta(days=2))
+        s3 = Sample('111', 'instance', datetime.utcnow() + timedelta(days=1))
+        s4 = Sample('333', 'unmapped', datetime.utcnow())
+
+        cclient = mock.Mock()
+        mock_cclient.return_value = cclient
+        cclient.query_samples.query.return_value = [s1, s2, s3, s4]
+
+        collector = ceilometer.CeilometerCollector()
+        usage_by_meter = collector.get_meters(
+            FAKE_PROJECT, ['instance', 'volume.size', 'network'], START, END)
+
+        self.assertEqual(1, cclient.query_samples.query.call_count)
+        self.assertEqual(100000,
+                         cclient.query_samples.query.call_args[1]['limit'])
+        cclient.new_samples.list.assert_not_called()
+
+        query_filter = json.loads(
+            cclient.query_samples.query.call_args[1]['filter'])
+        self.assertIn({'=': {'project_id': FAKE_PROJECT}},
+                      query_filter['and'])
+        self.assertEqual(
+            ['instance', 'network', 'volume.size'],
+            sorted([c['in']['counter_name'] for c in query_filter['and']
+                    if 'in' in c][0]))
+
+        expected = {
+            'instance': [s3.to_dict(), s1.to_dict()],
+            'volume.size': [s2.to_dict()],
+            'network': [],
+        }
+        self.assertEqual(expected, usage_by_meter)
+
+    @mock.patch('distil.collector.ceilometer.CeilometerCollector.iter_meter')
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    def test_get_meters_batched_truncated(self, mock_cclient,
+                                          mock_iter_meter):
+        self.override_config('collector', batch_meter_queries=True,
+                             batch_query_limit=2)
+        cclient = mock.Mock()
+        mock_cclient.return_value = cclient
+        # The result reaches the limit, so it may have been truncated.
+        cclient.query_samples.query.return_value = [mock.Mock(), mock.Mock()]
+        samples = {
+            'instance': [
+                {'resource_id': '222', 'timestamp': '2017-02-27T00:00:00'},
+                {'resource_id': '111', 'timestamp': '2017-02-27T00:10:00'},
+                {'resource_id': '111', 'timestamp': '2017-02-27T00:20:00'},
+            ],
+            'volume.size': [],
+        }
+        mock_iter_meter.side_effect = (
+            lambda project_id, meter, start, end: iter(samples[meter]))
+
+        collector = ceilometer.CeilometerCollector()
+        usage_by_meter = collector.get_meters(
+            FAKE_PROJECT, ['instance', 'volume.size'], START, END)
+
+        self.assertEqual(samples, usage_by_meter)
+        self.assertEqual(2, mock_iter_meter.call_count)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    def test_iter_meter(self, mock_cclient):
+        self.override_config('collector', sample_page_size=2)
+
+        class Sample(object):
+            def __init__(self, id, resource_id, timestamp):
+                self.id = id
+                self.resource_id = resource_id
+                self.timestamp = timestamp
+
+            def to_dict(self):
+                return {'id': self.id, 'meter': 'instance',
+                        'resource_id': self.resource_id,
+                        'timestamp': self.timestamp}
+
+        s1 = Sample('s1', '111', '2017-02-27T00:00:00')
+        s2 = Sample('s2', '111', '2017-02-27T00:10:00')
+        s3 = Sample('s3', '222', '2017-02-27T00:00:00')
+
+        cclient = mock.Mock()
+        mock_cclient.return_value = cclient
+        # Each page after the first starts with the last sample of the
+        # previous page.
+        cclient.query_samples.query.side_effect = [[s1, s2], [s2, s3], [s3]]
+
+        collector = ceilometer.CeilometerCollector()
+        samples = list(
+            collector.iter_meter(FAKE_PROJECT, FAKE_METER, START, END))
+
+        self.assertEqual([s1.to_dict(), s2.to_dict(), s3.to_dict()], samples)
+        self.assertEqual(3, cclient.query_samples.query.call_count)
+
+        calls = cclient.query_samples.query.call_args_list
+        self.assertEqual(2, calls[0][1]['limit'])
+        self.assertEqual(
+            [{'resource_id': 'asc'}, {'timestamp': 'asc'}],
+            json.loads(calls[0][1]['orderby']))
+        query_filter = json.loads(calls[1][1]['filter'])
+        self.assertIn({'=': {'counter_name': FAKE_METER}},
+                      query_filter['and'])
+        self.assertIn(
+            {'or': [
+                {'>': {'resource_id': '111'}},
+                {'and': [
+                    {'=': {'resource_id': '111'}},
+                    {'>=': {'timestamp': '2017-02-27T00:10:00'}},
+                ]},
+            ]},
+            query_filter['and'])
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    def test_iter_meter_single_key_page(self, mock_cclient):
+        self.override_config('collector', sample_page_size=2)
+
+        class Sample(object):
+            def __init__(self, id, resource_id, timestamp):
+                self.id = id
+                self.resource_id = resource_id
+                self.timestamp = timestamp
+
+            def to_dict(self):
+                return {'id': self.id, 'meter': 'instance',
+                        'resource_id': self.resource_id,
+                        'timestamp': self.timestamp}
+
+        s1 = Sample('s1', '111', '2017-02-27T00:00:00')
+        s2 = Sample('s2', '111', '2017-02-27T00:00:00')
+        s3 = Sample('s3', '111', '2017-02-27T00:00:00')
+        s4 = Sample('s4', '222', '2017-02-27T00:00:00')
+
+        cclient = mock.Mock()
+        mock_cclient.return_value = cclient
+        # The first page has a single resource ID and timestamp, so the
+        # samples with them are paged by message ID, then the next page
+        # starts after the timestamp.
+        cclient.query_samples.query.side_effect = [
+            [s1, s2], [s1, s2], [s3], [s4]]
+
+        collector = ceilometer.CeilometerCollector()
+        samples = list(
+            collector.iter_meter(FAKE_PROJECT, FAKE_METER, START, END))
+
+        self.assertEqual(
+            [s1.to_dict(), s2.to_dict(), s3.to_dict(), s4.to_dict()],
+            samples)
+        self.assertEqual(4, cclient.query_samples.query.call_count)
+
+        calls = cclient.query_samples.query.call_args_list
+        self.assertEqual([{'message_id': 'asc'}],
+                         json.loads(calls[1][1]['orderby']))
+        query_filter = json.loads(calls[2][1]['filter'])
+        self.assertIn({'=': {'resource_id': '111'}}, query_filter['and'])
+        self.assertIn({'=': {'timestamp': '2017-02-27T00:00:00'}},
+                      query_filter['and'])
+        self.assertIn({'>': {'message_id': 's2'}}, query_filter['and'])
+        query_filter = json.loads(calls[3][1]['filter'])
+        self.assertIn(
+            {'or': [
+                {'>': {'resource_id': '111'}},
+                {'and': [
+                    {'=': {'resource_id': '111'}},
+                    {'>': {'timestamp': '2017-02-27T00:00:00'}},
+                ]},
+            ]},
+            query_filter['and'])
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    def test_get_active_projects(self, mock_cclient):
+        cclient = mock.Mock()
+        mock_cclient.return_value = cclient
+        cclient.resources.list.return_value = [
+            mock.Mock(project_id='111'),
+            mock.Mock(project_id='222'),
+            mock.Mock(project_id='111'),
+        ]
+        start = datetime(2017, 2, 27)
+        end = start + timedelta(hours=2)
+
+        collector = ceilometer.CeilometerCollector()
+        active = collector.get_active_projects(start, end)
+
+        self.assertEqual(set(['111', '222']), active)
+        cclient.resources.list.assert_called_once_with(
+            q=[
+                {'field': 'timestamp', 'op': 'ge',
+                 'value': '2017-02-27T00:00:00'},
+                {'field': 'timestamp', 'op': 'lt',
+                 'value': '2017-02-27T02:00:00'},
+            ],
+            limit=100000,
+            links=False,
+        )
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    def test_get_active_projects_truncated(self, mock_cclient):
+        self.override_config('collector', idle_projects_probe_limit=2)
+        cclient = mock.Mock()
+        mock_cclient.return_value = cclient
+        # The list reaches the limit, so other projects may have samples.
+        cclient.resources.list.return_value = [
+            mock.Mock(project_id='111'),
+            mock.Mock(project_id='222'),
+        ]
+        start = datetime(2017, 2, 27)
+
+        collector = ceilometer.CeilometerCollector()
+        active = collector.get_active_projects(start,
+                                               start + timedelta(hours=1))
+
+        self.assertIsNone(active)
+        self.assertEqual(2, cclient.resources.list.call_args[1]['limit'])
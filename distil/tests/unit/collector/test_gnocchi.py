@@ -0,0 +1,354 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import json
+import os
+import threading
+
+from keystoneauth1 import session
+import mock
+from six.moves import BaseHTTPServer
+from six.moves.urllib import parse
+
+from distil.collector import gnocchi
+from distil.db import api as db_api
+from distil import exceptions as exc
+from distil.tests.unit import base
+
+FAKE_PROJECT = 'fake_project'
+END = datetime(2017, 2, 27, 1)
+START = END - timedelta(hours=1)
+
+# Aggregated measures of each metric, by resource.
+MEASURES = {
+    'ip.floating': {
+        'fip_1': [['2017-02-27T00:00:00+00:00', 3600.0, 1.0]],
+        # Resources without measures in the window are skipped.
+        'fip_2': [['2017-02-27T00:00:00+00:00', 3600.0, None]],
+    },
+    'traffic.outbound.international': {
+        'port_1': [['2017-02-27T00:00:00+00:00', 1800.0, 100.0],
+                   ['2017-02-27T00:30:00+00:00', 1800.0, 200.0]],
+    },
+    'instance': {
+        'vm_1': [['2017-02-27T00:00:00+00:00', 3600.0, 1.0]],
+    },
+}
+
+RESOURCES = {
+    'fip_1': {'id': 'fip_1', 'original_resource_id': 'fip_1',
+              'project_id': FAKE_PROJECT,
+              'floating_ip_address': '10.0.0.1'},
+    'fip_2': {'id': 'fip_2', 'original_resource_id': 'fip_2',
+              'project_id': FAKE_PROJECT,
+              'floating_ip_address': '10.0.0.2'},
+    'port_1': {'id': 'port_1', 'original_resource_id': None,
+               'project_id': FAKE_PROJECT, 'name': 'port-1'},
+    'vm_1': {'id': 'vm_1', 'original_resource_id': 'vm_1',
+             'project_id': FAKE_PROJECT, 'display_name': 'vm-1',
+             'image_ref': 'image_1'},
+}
+
+
+class FakeGnocchiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the Gnocchi aggregates and resource search APIs.
+
+    Searches return up to the server's max_limit resources.
+    """
+
+    def do_POST(self):
+        url = parse.urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        self.server.requests.append(
+            (url.path, parse.parse_qs(url.query), body))
+
+        if url.path == '/v1/aggregates':
+            metric, aggregation = body['operations'][1:]
+            response = [
+                {
+                    'group': {'id': resource_id},
+                    'measures': {
+                        'references': [{'id': resource_id}],
+                        'measures': {
+                            resource_id: {metric: {aggregation: points}},
+                        },
+                    },
+                }
+                for resource_id, points in MEASURES.get(metric, {}).items()
+            ]
+        elif url.path.startswith('/v1/search/resource/'):
+            limit = min(int(parse.parse_qs(url.query)['limit'][0]),
+                        self.server.max_limit)
+            response = [
+                RESOURCES[resource_id]
+                for resource_id in body['in']['id'][:limit]
+            ]
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class GnocchiCollectorTest(base.DistilWithDbTestCase):
+    def setUp(self):
+        super(GnocchiCollectorTest, self).setUp()
+
+        self.conf.set_default(
+            'meter_mappings_file',
+            os.path.join(
+                os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+                'test_gnocchi',
+                'meter_mappings.yaml',
+            ),
+            group='collector'
+        )
+        self.conf.set_default(
+            'transformer_file',
+            os.path.join(
+                os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+                'transformer.yaml',
+            ),
+            group='collector'
+        )
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FakeGnocchiHandler)
+        self.server.requests = []
+        self.server.max_limit = 1000
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.override_config(
+            'collector',
+            gnocchi_endpoint='http://127.0.0.1:%s' % self.server.server_port,
+        )
+        patcher = mock.patch('distil.common.openstack.get_keystone_session',
+                             return_value=session.Session())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_meter(self):
+        collector = gnocchi.GnocchiCollector()
+        samples = collector.get_meter(FAKE_PROJECT, 'ip.floating', START, END)
+
+        self.assertEqual(
+            [
+                {
+                    'meter': 'ip.floating',
+                    'metadata': RESOURCES['fip_1'],
+                    'project_id': FAKE_PROJECT,
+                    'resource_id': 'fip_1',
+                    'source': 'openstack',
+                    'timestamp': '2017-02-27T00:00:00',
+                    'volume': 1.0,
+                },
+            ],
+            samples,
+        )
+
+        self.assertEqual(2, len(self.server.requests))
+        path, query, body = self.server.requests[0]
+        self.assertEqual('/v1/aggregates', path)
+        self.assertEqual(
+            {
+                'start': ['2017-02-27T00:00:00'],
+                'stop': ['2017-02-27T01:00:00'],
+                'granularity': ['3600'],
+                'groupby': ['id'],
+            },
+            query,
+        )
+        self.assertEqual(
+            {
+                'operations': ['metric', 'ip.floating', 'max'],
+                'resource_type': 'network',
+                'search': {'=': {'project_id': FAKE_PROJECT}},
+            },
+            body,
+        )
+        path, query, body = self.server.requests[1]
+        self.assertEqual('/v1/search/resource/network', path)
+        self.assertEqual({'limit': ['1']}, query)
+        self.assertEqual({'in': {'id': ['fip_1']}}, body)
+
+    def _get_searched_ids(self):
+        return [
+            body['in']['id'] for path, query, body in self.server.requests
+            if path.startswith('/v1/search/resource/')
+        ]
+
+    def test_get_meter_search_capped(self):
+        # Gnocchi only returns up to its api.max_limit resources.
+        self.server.max_limit = 1
+
+        collector = gnocchi.GnocchiCollector()
+        with mock.patch.dict(MEASURES['ip.floating'],
+                             {'fip_2': [['2017-02-27T00:00:00+00:00', 3600.0,
+                                         2.0]]}):
+            samples = collector.get_meter(FAKE_PROJECT, 'ip.floating',
+                                          START, END)
+
+        self.assertEqual(
+            [('fip_1', 1.0), ('fip_2', 2.0)],
+            [(sample['resource_id'], sample['volume']) for sample in samples],
+        )
+        self.assertEqual([['fip_1', 'fip_2'], ['fip_2']],
+                         self._get_searched_ids())
+
+    @mock.patch.object(gnocchi, 'SEARCH_BATCH_SIZE', 1)
+    def test_get_meter_search_batches(self):
+        collector = gnocchi.GnocchiCollector()
+        with mock.patch.dict(MEASURES['ip.floating'],
+                             {'fip_2': [['2017-02-27T00:00:00+00:00', 3600.0,
+                                         2.0]]}):
+            samples = collector.get_meter(FAKE_PROJECT, 'ip.floating',
+                                          START, END)
+
+        self.assertEqual(['fip_1', 'fip_2'],
+                         [sample['resource_id'] for sample in samples])
+        self.assertEqual([['fip_1'], ['fip_2']], self._get_searched_ids())
+
+    @mock.patch('distil.common.openstack.get_root_volume_image_metadata',
+                return_value=None)
+    @mock.patch('distil.common.openstack.get_image_os_distro',
+                return_value='linux')
+    def test_get_meter_instance(self, mock_get_image, mock_get_root):
+        self.conf.set_default(
+            'meter_mappings_file',
+            os.path.join(
+                os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+                'test_gnocchi_instance',
+                'meter_mappings.yaml',
+            ),
+            group='collector'
+        )
+        self.override_config('collector', gnocchi_source='gnocchi')
+
+        collector = gnocchi.GnocchiCollector()
+        samples = collector.get_meter(FAKE_PROJECT, 'instance', START, END)
+
+        self.assertEqual(1, len(samples))
+        self.assertEqual('gnocchi', samples[0]['source'])
+        self.assertEqual('image_1', samples[0]['metadata']['image_ref_url'])
+        self.assertEqual('linux', collector._get_os_distro(samples[0]))
+        mock_get_image.assert_called_once_with('image_1')
+
+    def test_invalid_instance_resource_type(self):
+        self.conf.set_default(
+            'meter_mappings_file',
+            os.path.join(
+                os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+                'test_gnocchi_instance_generic',
+                'meter_mappings.yaml',
+            ),
+            group='collector'
+        )
+
+        self.assertRaises(exc.InvalidConfig, gnocchi.GnocchiCollector)
+
+    def test_get_meter_no_measures(self):
+        collector = gnocchi.GnocchiCollector()
+        samples = collector.get_meter(FAKE_PROJECT, 'router', START, END)
+
+        self.assertEqual([], samples)
+        # Resources are only searched for when there are measures.
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_collect_usage(self):
+        db_api.project_add(
+            {"id": FAKE_PROJECT, "name": FAKE_PROJECT,
+             "description": FAKE_PROJECT})
+
+        collector = gnocchi.GnocchiCollector()
+        ret = collector.collect_usage(
+            {"name": FAKE_PROJECT, "id": FAKE_PROJECT},
+            [(START, END)],
+        )
+
+        self.assertTrue(ret)
+        actual = sorted(
+            (entry.resource_id, entry.service, entry.volume)
+            for entry in db_api.usage_get(FAKE_PROJECT, START, END)
+        )
+        self.assertEqual(
+            [
+                ('fip_1', 'n1.ip', Decimal(1)),
+                ('port_1', 'n1.international-out', Decimal(300)),
+            ],
+            actual,
+        )
+        # One aggregates request per meter, and one resource search per
+        # meter with measures.
+        self.assertEqual(4, len(self.server.requests))
+
+    def test_collect_usage_catch_up(self):
+        self.override_config('collector', catch_up=True)
+        windows = [(START - timedelta(hours=1), START), (START, END)]
+        db_api.project_add(
+            {"id": FAKE_PROJECT, "name": FAKE_PROJECT,
+             "description": FAKE_PROJECT})
+
+        collector = gnocchi.GnocchiCollector()
+        ret = collector.collect_usage(
+            {"name": FAKE_PROJECT, "id": FAKE_PROJECT}, windows)
+
+        self.assertTrue(ret)
+        # Gnocchi aggregates the measures of the requested range, so each
+        # window is still collected on its own, and gets its own usage.
+        for window_start, window_end in windows:
+            actual = sorted(
+                (entry.resource_id, entry.service, entry.volume)
+                for entry in db_api.usage_get(FAKE_PROJECT, window_start,
+                                              window_end)
+            )
+            self.assertEqual(
+                [
+                    ('fip_1', 'n1.ip', Decimal(1)),
+                    ('port_1', 'n1.international-out', Decimal(300)),
+                ],
+                actual,
+            )
+        self.assertEqual(8, len(self.server.requests))
+
+    def test_invalid_aggregation(self):
+        self.conf.set_default(
+            'meter_mappings_file',
+            os.path.join(
+                os.environ["DISTIL_TESTS_CONFIGS_DIR"],
+                'test_collect_usage_filters_multiple',
+                'meter_mappings.yaml',
+            ),
+            group='collector'
+        )
+
+        with mock.patch.dict(gnocchi.TRANSFORMER_AGGREGATIONS, clear=True):
+            self.assertRaises(exc.InvalidConfig, gnocchi.GnocchiCollector)
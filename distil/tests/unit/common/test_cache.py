@@ -50,3 +50,97 @@ class TestCache(base.DistilTestCase):
         name = 'Tom'
         for x in range(0, 2):
             self.assertEqual(test(name), 'hello, Tom')
+
+
+class TestTTLCache(base.DistilTestCase):
+
+    def setUp(self):
+        super(TestTTLCache, self).setUp()
+        self.now = 1000.0
+
+    def _timer(self):
+        return self.now
+
+    def test_get_set(self):
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=60, timer=self._timer)
+        ttl_cache.set('key', 'value')
+
+        self.assertEqual('value', ttl_cache.get('key'))
+        self.assertIsNone(ttl_cache.get('missing'))
+        self.assertEqual('default', ttl_cache.get('missing', 'default'))
+        self.assertIn('key', ttl_cache)
+
+    def test_expiry(self):
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=60, timer=self._timer)
+        ttl_cache.set('key', 'value')
+
+        self.now += 59
+        self.assertEqual('value', ttl_cache.get('key'))
+
+        self.now += 1
+        self.assertIsNone(ttl_cache.get('key'))
+        self.assertEqual(0, len(ttl_cache))
+
+    def test_no_expiry(self):
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=0, timer=self._timer)
+        ttl_cache.set('key', 'value')
+
+        self.now += 10 ** 9
+        self.assertEqual('value', ttl_cache.get('key'))
+
+    def test_lru_eviction(self):
+        ttl_cache = cache.TTLCache(maxsize=2, ttl=60, timer=self._timer)
+        ttl_cache.set('key1', 'value1')
+        ttl_cache.set('key2', 'value2')
+        # Using key1 makes key2 the least recently used entry.
+        ttl_cache.get('key1')
+        ttl_cache.set('key3', 'value3')
+
+        self.assertEqual(2, len(ttl_cache))
+        self.assertEqual('value1', ttl_cache.get('key1'))
+        self.assertIsNone(ttl_cache.get('key2'))
+        self.assertEqual('value3', ttl_cache.get('key3'))
+
+    def test_hits_and_misses(self):
+        ttl_cache = cache.TTLCache(maxsize=10, ttl=60, timer=self._timer)
+        ttl_cache.get('key')
+        ttl_cache.set('key', 'value')
+        ttl_cache.get('key')
+        ttl_cache.get('key')
+
+        self.assertEqual(2, ttl_cache.hits)
+        self.assertEqual(1, ttl_cache.misses)
+
+
+class TestRegionCache(base.DistilTestCase):
+
+    def setUp(self):
+        super(TestRegionCache, self).setUp()
+        self.region = core.create_region()
+        self.region.configure('dogpile.cache.memory')
+
+    def test_get_set(self):
+        flavors = cache.RegionCache('flavors', 60, region=self.region)
+        volume_types = cache.RegionCache('volume_types', 60,
+                                         region=self.region)
+        flavors.set('id', 'm1.small')
+
+        self.assertEqual('m1.small', flavors.get('id'))
+        self.assertIn('id', flavors)
+        self.assertIsNone(volume_types.get('id'))
+        self.assertEqual('m1.small', self.region.get('distil-flavors-id'))
+        self.assertEqual(2, flavors.hits)
+        self.assertEqual(0, flavors.misses)
+        self.assertEqual(1, volume_types.misses)
+
+    @mock.patch('time.time')
+    def test_expiry(self, mock_time):
+        mock_time.return_value = 1000.0
+        region_cache = cache.RegionCache('flavors', 60, region=self.region)
+        region_cache.set('id', 'm1.small')
+
+        mock_time.return_value = 1059.0
+        self.assertEqual('m1.small', region_cache.get('id'))
+
+        mock_time.return_value = 1061.0
+        self.assertIsNone(region_cache.get('id'))
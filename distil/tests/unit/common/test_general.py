@@ -0,0 +1,71 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+
+import mock
+
+from distil.common import constants
+from distil.common import general
+from distil.tests.unit import base
+
+
+class ParseTimestampTest(base.DistilTestCase):
+    def setUp(self):
+        super(ParseTimestampTest, self).setUp()
+        patcher = mock.patch.object(general, '_TIMESTAMP_CACHE', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_timestamp(self):
+        for timestamp in (
+            datetime(2016, 8, 4, 11, 35),
+            datetime(2016, 8, 4, 11, 35, 0, 123456),
+            datetime(1969, 12, 31, 23, 59, 59, 500000),
+        ):
+            expected = general.to_epoch_us(timestamp)
+            for string in (timestamp.strftime(constants.date_format_f),
+                           timestamp.isoformat()):
+                self.assertEqual(expected, general.parse_timestamp(string))
+            self.assertEqual(expected, general.parse_timestamp(timestamp))
+
+        self.assertEqual(1470310500000000,
+                         general.parse_timestamp('2016-08-04T11:35:00'))
+        # Fractions of a second are not always given with 6 digits.
+        self.assertEqual(1470310500120000,
+                         general.parse_timestamp('2016-08-04T11:35:00.12'))
+
+    def test_parse_timestamp_invalid(self):
+        for timestamp in ('2016-08-04', '2016-08-04 11:35:00',
+                          '2016-08-04T11:35:00Z', '2016-08-04T11:35:00.',
+                          '2016-08-04T11:35:00.1234567',
+                          '2016-13-04T11:35:00'):
+            self.assertRaises(ValueError, general.parse_timestamp, timestamp)
+
+    def test_parse_timestamp_cached(self):
+        timestamp = '2016-08-04T11:35:00.123456'
+        epoch = general.parse_timestamp(timestamp)
+
+        with mock.patch.object(general, '_parse_timestamp') as mock_parse:
+            self.assertEqual(epoch, general.parse_timestamp(timestamp))
+        mock_parse.assert_not_called()
+
+    @mock.patch.object(general, '_TIMESTAMP_CACHE_SIZE', 2)
+    def test_parse_timestamp_cache_size(self):
+        for second in range(3):
+            general.parse_timestamp('2016-08-04T11:35:0%s' % second)
+
+        self.assertEqual(['2016-08-04T11:35:02'],
+                         list(general._TIMESTAMP_CACHE))
@@ -0,0 +1,56 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import Counter
+
+from distil.common import hashring
+from distil.tests.unit import base
+
+KEYS = ['project_%s' % i for i in range(1000)]
+
+
+class HashRingTest(base.DistilTestCase):
+    def _assignments(self, ring):
+        return dict((key, ring.get_member(key)) for key in KEYS)
+
+    def test_get_member(self):
+        members = ['member_1', 'member_2', 'member_3']
+        assignments = self._assignments(hashring.HashRing(members))
+
+        # Keys are spread between all members, regardless of their order.
+        counts = Counter(assignments.values())
+        self.assertEqual(set(members), set(counts))
+        for count in counts.values():
+            self.assertTrue(200 < count < 500, counts)
+        self.assertEqual(
+            assignments,
+            self._assignments(hashring.HashRing(reversed(members))),
+        )
+
+    def test_get_member_no_members(self):
+        self.assertIsNone(hashring.HashRing([]).get_member('project_1'))
+
+    def test_member_removed(self):
+        before = self._assignments(
+            hashring.HashRing(['member_1', 'member_2', 'member_3']))
+        after = self._assignments(
+            hashring.HashRing(['member_1', 'member_3']))
+
+        # Only the keys of the removed member move.
+        for key in KEYS:
+            if before[key] != 'member_2':
+                self.assertEqual(before[key], after[key])
+            else:
+                self.assertIn(after[key], ('member_1', 'member_3'))
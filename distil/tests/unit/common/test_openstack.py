@@ -17,6 +17,7 @@ import flask
 import mock
 
 from keystoneauth1.exceptions import NotFound
+from oslo_cache import core as cache_core
 
 from distil import exceptions as ex
 from distil.common import openstack
@@ -60,3 +61,321 @@ class TestOpenStack(base.DistilTestCase):
         self.assertEqual([project_1.to_dict.return_value], projects)
         ks_client.domains.get.assert_called_with("domain_1")
         ks_client.projects.list.assert_called_with(domain=domain_1)
+
+    @mock.patch('distil.common.openstack.get_glance_client')
+    def test_get_image_os_distro_cached(self, glance_client_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        glance_client = mock.MagicMock()
+        glance_client_factory.return_value = glance_client
+        glance_client.images.get.side_effect = [
+            mock.Mock(os_distro='linux'),
+            mock.Mock(spec=[]),
+        ]
+
+        for i in range(2):
+            self.assertEqual('linux',
+                             openstack.get_image_os_distro('image_1'))
+            # Images without an os_distro are cached as well.
+            self.assertIsNone(openstack.get_image_os_distro('image_2'))
+
+        self.assertEqual(2, glance_client.images.get.call_count)
+
+    @mock.patch('distil.common.openstack.get_glance_client')
+    @mock.patch('distil.common.openstack.get_cinder_client')
+    @mock.patch('distil.common.openstack.get_nova_client')
+    def test_prefetch_os_distro_info(self, nova_client_factory,
+                                     cinder_client_factory,
+                                     glance_client_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        nova_client = mock.MagicMock()
+        nova_client_factory.return_value = nova_client
+        cinder_client = mock.MagicMock()
+        cinder_client_factory.return_value = cinder_client
+        glance_client = mock.MagicMock()
+        glance_client_factory.return_value = glance_client
+
+        root_volume = mock.Mock(
+            id='volume_1',
+            attachments=[{'server_id': 'server_1', 'device': '/dev/vda'}],
+            volume_image_metadata={'os_distro': 'windows'},
+        )
+        data_volume = mock.Mock(
+            id='volume_2',
+            attachments=[{'server_id': 'server_2', 'device': '/dev/vdb'}],
+            volume_image_metadata=None,
+        )
+        nova_client.servers.list.return_value = [
+            mock.Mock(id='server_1'),
+            mock.Mock(id='server_2'),
+        ]
+        cinder_client.volumes.list.return_value = [root_volume, data_volume]
+        image = mock.Mock(id='image_1', os_distro='linux')
+        glance_client.images.list.return_value = [image]
+
+        openstack.prefetch_os_distro_info('project_1', set(['image_1']))
+
+        nova_client.servers.list.assert_called_once_with(
+            search_opts={'all_tenants': True, 'project_id': 'project_1'},
+            limit=-1,
+        )
+        glance_client.images.list.assert_called_once_with(
+            filters={'id': 'in:image_1'})
+
+        # Lookups are now served from the cache.
+        self.assertEqual(
+            {'os_distro': 'windows'},
+            openstack.get_root_volume_image_metadata('server_1'))
+        self.assertIsNone(openstack.get_root_volume_image_metadata('server_2'))
+        self.assertEqual('linux', openstack.get_image_os_distro('image_1'))
+        nova_client.volumes.get_server_volumes.assert_not_called()
+        cinder_client.volumes.get.assert_not_called()
+        glance_client.images.get.assert_not_called()
+
+    @mock.patch('distil.common.openstack.get_cinder_client')
+    def test_prefetch_volume_types(self, cinder_client_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        cinder_client = mock.MagicMock()
+        cinder_client_factory.return_value = cinder_client
+        cinder_client.volumes.list.return_value = [
+            mock.Mock(id='volume_1', volume_type='b1.standard',
+                      volume_image_metadata=None),
+            mock.Mock(id='volume_2', volume_type='b1.sr-r3-nvme-1000',
+                      volume_image_metadata=None),
+        ]
+        # mock.Mock uses the name argument for itself, so set it afterwards.
+        volume_type = mock.Mock(id='type_1')
+        volume_type.name = 'b1.standard'
+        cinder_client.volume_types.list.return_value = [volume_type]
+
+        openstack.prefetch_volume_types(
+            'project_1', set(['volume_1', 'volume_2']), set(['type_1']))
+
+        cinder_client.volumes.list.assert_called_once_with(
+            search_opts={'all_tenants': True, 'project_id': 'project_1'})
+        cinder_client.volume_types.list.assert_called_once_with()
+
+        # Lookups are now served from the cache.
+        self.assertEqual('b1.standard',
+                         openstack.get_volume_type_for_volume('volume_1'))
+        self.assertEqual('b1.sr-r3-nvme-1000',
+                         openstack.get_volume_type_for_volume('volume_2'))
+        self.assertEqual('b1.standard',
+                         openstack.get_volume_type_name('type_1'))
+        self.assertEqual('b1.standard',
+                         openstack.get_volume_type_name('b1.standard'))
+        cinder_client.volumes.get.assert_not_called()
+        cinder_client.volume_types.get.assert_not_called()
+
+        # Nothing is listed again once everything is cached.
+        openstack.prefetch_volume_types(
+            'project_1', set(['volume_1']), set(['b1.standard']))
+        self.assertEqual(1, cinder_client.volumes.list.call_count)
+        self.assertEqual(1, cinder_client.volume_types.list.call_count)
+
+    @mock.patch('distil.common.openstack.get_cinder_client')
+    def test_get_volume_type_for_volume_none_cached(self,
+                                                    cinder_client_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        cinder_client = mock.MagicMock()
+        cinder_client_factory.return_value = cinder_client
+        cinder_client.volumes.get.return_value = mock.Mock(volume_type=None)
+
+        for i in range(2):
+            self.assertIsNone(
+                openstack.get_volume_type_for_volume('volume_1'))
+
+        # A volume without a type is looked up once.
+        cinder_client.volumes.get.assert_called_once_with('volume_1')
+
+    @mock.patch('distil.common.openstack.get_keystone_session')
+    @mock.patch('distil.common.openstack.get_keystone_client')
+    def test_get_container_policy_cached(self, ks_client_factory,
+                                         session_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        ks_client = mock.MagicMock()
+        ks_client_factory.return_value = ks_client
+        ks_client.endpoints.list.return_value = [
+            mock.Mock(url='https://swift/v1/AUTH_%(tenant_id)s'),
+        ]
+        sess = mock.MagicMock()
+        session_factory.return_value = sess
+        sess.head.return_value.headers = {'X-Storage-Policy': 'policy_1'}
+
+        for i in range(2):
+            for container_name in ('container_1', 'container_2'):
+                self.assertEqual(
+                    'policy_1',
+                    openstack.get_container_policy('project_1',
+                                                   container_name))
+
+        # The endpoint is looked up once, and each container once.
+        ks_client.endpoints.list.assert_called_once()
+        self.assertEqual(
+            [mock.call('https://swift/v1/AUTH_project_1/container_1'),
+             mock.call('https://swift/v1/AUTH_project_1/container_2')],
+            sess.head.call_args_list,
+        )
+
+    @mock.patch('distil.common.openstack.get_keystone_session')
+    @mock.patch('distil.common.openstack.get_keystone_client')
+    def test_prefetch_container_policies(self, ks_client_factory,
+                                         session_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        self.override_config('collector', container_policy_concurrency=2)
+        ks_client = mock.MagicMock()
+        ks_client_factory.return_value = ks_client
+        ks_client.endpoints.list.return_value = [
+            mock.Mock(url='https://swift/v1/AUTH_%(tenant_id)s'),
+        ]
+
+        def head(url):
+            if url.endswith('/container_3'):
+                raise NotFound()
+            if url.endswith('/container_4'):
+                raise Exception('Connection reset')
+            return mock.Mock(headers={'X-Storage-Policy': url[-11:]})
+
+        sess = mock.MagicMock()
+        session_factory.return_value = sess
+        sess.head.side_effect = head
+
+        openstack.prefetch_container_policies(
+            'project_1',
+            ['container_1', 'container_2', 'container_3', 'container_4'])
+
+        self.assertEqual(4, sess.head.call_count)
+        # Lookups are now served from the cache, apart from the failed one.
+        self.assertEqual(
+            'container_1',
+            openstack.get_container_policy('project_1', 'container_1'))
+        self.assertEqual(
+            'container_2',
+            openstack.get_container_policy('project_1', 'container_2'))
+        self.assertIsNone(
+            openstack.get_container_policy('project_1', 'container_3'))
+        self.assertEqual(4, sess.head.call_count)
+        self.assertRaises(Exception, openstack.get_container_policy,
+                          'project_1', 'container_4')
+        ks_client.endpoints.list.assert_called_once()
+
+        # Nothing is looked up again once everything is cached.
+        openstack.prefetch_container_policies(
+            'project_1', ['container_1', 'container_3'])
+        self.assertEqual(5, sess.head.call_count)
+
+    @mock.patch('distil.common.openstack.get_nova_client')
+    def test_get_flavor_name_cached(self, nova_client_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        self.override_config('collector', openstack_cache_sizes={'flavors': 1})
+        nova_client = mock.MagicMock()
+        nova_client_factory.return_value = nova_client
+        # mock.Mock uses the name argument for itself, so set it afterwards.
+        flavors = {}
+        for flavor_id in ('flavor_1', 'flavor_2'):
+            flavors[flavor_id] = mock.Mock(id=flavor_id)
+            flavors[flavor_id].name = 'name_' + flavor_id
+        nova_client.flavors.get.side_effect = flavors.get
+
+        self.assertEqual('name_flavor_1', openstack.get_flavor_name('flavor_1'))
+        self.assertEqual('name_flavor_1', openstack.get_flavor_name('flavor_1'))
+        self.assertEqual(1, nova_client.flavors.get.call_count)
+
+        # The flavors cache only holds one entry, so flavor_1 is evicted.
+        self.assertEqual('name_flavor_2', openstack.get_flavor_name('flavor_2'))
+        self.assertEqual('name_flavor_1', openstack.get_flavor_name('flavor_1'))
+        self.assertEqual(3, nova_client.flavors.get.call_count)
+
+        self.assertEqual({'flavors': (1, 3, 1)}, openstack.get_cache_stats())
+
+    @mock.patch('distil.common.openstack.get_cinder_client')
+    def test_get_volume_type_name_oslo_cache(self, cinder_client_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        self.override_config('collector', openstack_cache_backend='oslo_cache')
+        region = cache_core.create_region()
+        region.configure('dogpile.cache.memory')
+        patcher = mock.patch('distil.common.cache.CACHE_REGION', region)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cinder_client = mock.MagicMock()
+        cinder_client_factory.return_value = cinder_client
+        vtype = mock.Mock(id='type_id')
+        vtype.name = 'b1.standard'
+        cinder_client.volume_types.get.return_value = vtype
+
+        for volume_type in ('type_id', 'b1.standard'):
+            self.assertEqual('b1.standard',
+                             openstack.get_volume_type_name(volume_type))
+
+        cinder_client.volume_types.get.assert_called_once_with('type_id')
+        self.assertEqual({'volume_types': (1, 1, None)},
+                         openstack.get_cache_stats())
+
+    @mock.patch('distil.common.openstack.novaclient.Client')
+    @mock.patch('distil.common.openstack.get_keystone_session')
+    def test_get_nova_client_built_once(self, mock_session, mock_client):
+        self.addCleanup(openstack.reset_clients)
+        openstack.reset_clients()
+
+        client = openstack.get_nova_client()
+        self.assertIs(client, openstack.get_nova_client())
+        mock_client.assert_called_once_with(
+            '2', session=mock_session.return_value, region_name=mock.ANY)
+
+        # The clients of a parent process are not reused by a forked one.
+        with mock.patch('os.getpid', return_value=-1):
+            openstack.get_nova_client()
+        self.assertEqual(2, mock_client.call_count)
+
+    def test_get_http_session_pool(self):
+        self.override_config('collector', openstack_pool_size=25)
+
+        for keepalive, adapter_class in (
+            (True, openstack.session.TCPKeepAliveAdapter),
+            (False, openstack.requests.adapters.HTTPAdapter),
+        ):
+            self.override_config('collector',
+                                 openstack_tcp_keepalive=keepalive)
+            http_session = openstack._get_http_session()
+            for scheme in ('http://', 'https://'):
+                adapter = http_session.adapters[scheme]
+                self.assertIs(adapter_class, type(adapter))
+                self.assertEqual(25, adapter._pool_maxsize)
+
+    @mock.patch('distil.common.openstack.get_glance_client')
+    @mock.patch('distil.common.openstack.get_cinder_client')
+    @mock.patch('distil.common.openstack.get_nova_client')
+    def test_os_distro_info_oslo_cache_pickled(self, nova_client_factory,
+                                               cinder_client_factory,
+                                               glance_client_factory):
+        self.addCleanup(openstack._CACHES.clear)
+        self.override_config('collector', openstack_cache_backend='oslo_cache')
+        # This backend pickles its values, as memcached and redis do, so
+        # caching the client resources (here mocks) themselves would fail.
+        region = cache_core.create_region()
+        region.configure('dogpile.cache.memory_pickle')
+        patcher = mock.patch('distil.common.cache.CACHE_REGION', region)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        nova_client = mock.MagicMock()
+        nova_client_factory.return_value = nova_client
+        nova_client.volumes.get_server_volumes.return_value = [
+            mock.Mock(device='/dev/vda', volumeId='volume_1'),
+        ]
+        cinder_client = mock.MagicMock()
+        cinder_client_factory.return_value = cinder_client
+        cinder_client.volumes.get.return_value = mock.Mock(
+            volume_image_metadata={'os_distro': 'windows'})
+        glance_client = mock.MagicMock()
+        glance_client_factory.return_value = glance_client
+        glance_client.images.get.return_value = mock.Mock(os_distro='linux')
+
+        for i in range(2):
+            self.assertEqual(
+                {'os_distro': 'windows'},
+                openstack.get_root_volume_image_metadata('server_1'))
+            self.assertEqual('linux', openstack.get_image_os_distro('image_1'))
+
+        nova_client.volumes.get_server_volumes.assert_called_once_with(
+            'server_1')
+        cinder_client.volumes.get.assert_called_once_with('volume_1')
+        glance_client.images.get.assert_called_once_with('image_1')
@@ -13,7 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+from datetime import timedelta
+import json
+
 from distil.db.sqlalchemy import api as db_api
+from distil import exceptions
 from distil.tests.unit import base
 
 
@@ -28,3 +33,304 @@ class ProjectLockTest(base.DistilWithDbTestCase):
 
         # Make sure that outside 'with' section the lock record does not exist.
         self.assertEqual(0, len(db_api.get_project_locks(project_id)))
+
+
+class ProjectLeaseTest(base.DistilWithDbTestCase):
+    def _owners(self, project_ids):
+        return dict(
+            (lease.project_id, lease.owner)
+            for lease in db_api.get_project_leases(project_ids)
+        )
+
+    def test_claim_projects(self):
+        project_ids = ['p1', 'p2', 'p3', 'p4']
+
+        claimed = db_api.claim_projects(project_ids, 'owner_1', 2, 600)
+        self.assertEqual(['p1', 'p2'], claimed)
+
+        # Projects leased by another owner are skipped.
+        claimed = db_api.claim_projects(project_ids, 'owner_2', 3, 600)
+        self.assertEqual(['p3', 'p4'], claimed)
+
+        self.assertEqual(
+            {'p1': 'owner_1', 'p2': 'owner_1',
+             'p3': 'owner_2', 'p4': 'owner_2'},
+            self._owners(project_ids),
+        )
+
+        # Claiming projects already held by the owner renews their lease.
+        self.assertEqual(
+            ['p1'], db_api.claim_projects(['p1', 'p3'], 'owner_1', 2, 600))
+
+    def test_claim_projects_expired(self):
+        db_api.claim_projects(['p1', 'p2'], 'owner_1', 2, 600)
+        session = db_api.get_session()
+        session.execute(
+            db_api.ProjectLease.__table__.update().
+            where(db_api.ProjectLease.__table__.c.project_id == 'p1').
+            values(expires=datetime.utcnow() - timedelta(seconds=1))
+        )
+
+        # The expired lease of p1 can be claimed by another owner.
+        claimed = db_api.claim_projects(['p1', 'p2'], 'owner_2', 2, 600)
+        self.assertEqual(['p1'], claimed)
+
+    def test_renew_and_release_project_leases(self):
+        db_api.claim_projects(['p1', 'p2'], 'owner_1', 2, 60)
+        before = dict(
+            (lease.project_id, lease.expires)
+            for lease in db_api.get_project_leases(['p1', 'p2'])
+        )
+
+        self.assertEqual(
+            1, db_api.renew_project_leases(['p1', 'p3'], 'owner_1', 600))
+        self.assertEqual(
+            0, db_api.renew_project_leases(['p2'], 'owner_2', 600))
+        after = dict(
+            (lease.project_id, lease.expires)
+            for lease in db_api.get_project_leases(['p1', 'p2'])
+        )
+        self.assertTrue(after['p1'] > before['p1'])
+        self.assertEqual(before['p2'], after['p2'])
+
+        # Only the owner can release its leases.
+        db_api.release_project_leases(['p1', 'p2'], 'owner_2')
+        self.assertEqual({'p1': 'owner_1', 'p2': 'owner_1'},
+                         self._owners(['p1', 'p2']))
+        db_api.release_project_leases(['p1', 'p2'], 'owner_1')
+        self.assertEqual({'p1': None, 'p2': None},
+                         self._owners(['p1', 'p2']))
+        self.assertEqual(
+            ['p2', 'p1'],
+            db_api.claim_projects(['p2', 'p1'], 'owner_2', 2, 600))
+
+
+class CollectorMemberTest(base.DistilWithDbTestCase):
+    def test_collector_members(self):
+        start = datetime.utcnow()
+        db_api.collector_member_heartbeat('member_2')
+        db_api.collector_member_heartbeat('member_1')
+        db_api.collector_member_heartbeat('member_1')
+
+        self.assertEqual(['member_1', 'member_2'],
+                         db_api.collector_member_get_all(start))
+
+        # Members not seen since are left out.
+        session = db_api.get_session()
+        session.execute(
+            db_api.CollectorMember.__table__.update().
+            where(db_api.CollectorMember.__table__.c.name == 'member_2').
+            values(last_seen=start - timedelta(hours=1))
+        )
+        self.assertEqual(['member_1'],
+                         db_api.collector_member_get_all(start))
+
+        db_api.collector_member_delete('member_1')
+        self.assertEqual([], db_api.collector_member_get_all(start))
+
+
+class ProjectsAddTest(base.DistilWithDbTestCase):
+    def test_projects_add(self):
+        last_collect = datetime.utcnow().replace(
+            minute=0, second=0, microsecond=0) - timedelta(hours=2)
+
+        added = db_api.projects_add(
+            [
+                {'id': 'p1', 'name': 'project_1', 'description': ''},
+                {'id': 'p2', 'name': 'project_2', 'description': ''},
+            ],
+            last_collect,
+        )
+
+        self.assertEqual({'p1': last_collect, 'p2': last_collect}, added)
+        self.assertEqual(
+            [('p1', last_collect), ('p2', last_collect)],
+            sorted(db_api.get_last_collected_all()),
+        )
+
+    def test_projects_add_existing(self):
+        last_collected = datetime(2017, 2, 27)
+        db_api.project_add(
+            {'id': 'p1', 'name': 'project_1', 'description': ''})
+        session = db_api.get_session()
+        session.execute(
+            db_api.Tenant.__table__.update().
+            values(last_collected=last_collected)
+        )
+
+        # Projects added in the meantime are kept as they are.
+        added = db_api.projects_add(
+            [
+                {'id': 'p1', 'name': 'project_1', 'description': ''},
+                {'id': 'p2', 'name': 'project_2', 'description': ''},
+            ],
+        )
+
+        self.assertEqual(['p1', 'p2'], sorted(added))
+        self.assertEqual(last_collected, added['p1'])
+        self.assertEqual(last_collected,
+                         db_api.project_get('p1').last_collected)
+
+
+    def test_projects_advance_last_collected(self):
+        start = datetime.utcnow().replace(
+            minute=0, second=0, microsecond=0) - timedelta(hours=3)
+        db_api.projects_add(
+            [
+                {'id': 'p1', 'name': 'project_1', 'description': ''},
+                {'id': 'p2', 'name': 'project_2', 'description': ''},
+            ],
+            start,
+        )
+
+        # Projects whose last collected time changed in the meantime are
+        # left as they are.
+        db_api.projects_advance_last_collected([
+            ('p1', start, start + timedelta(hours=2)),
+            ('p2', start - timedelta(hours=1), start + timedelta(hours=2)),
+        ])
+
+        self.assertEqual(
+            [('p1', start + timedelta(hours=2)), ('p2', start)],
+            sorted(db_api.get_last_collected_all()),
+        )
+
+
+class UsagesAddTest(base.DistilWithDbTestCase):
+    def setUp(self):
+        super(UsagesAddTest, self).setUp()
+
+        self.project_id = 'fake_project_id'
+        self.start = datetime(2017, 2, 27)
+        self.end = self.start + timedelta(hours=1)
+
+        db_api.project_add(
+            {
+                'id': self.project_id,
+                'name': 'fake_project',
+                'description': 'project for test',
+            },
+            self.start,
+        )
+        db_api.resource_add(self.project_id, 'res_1',
+                            {'type': 'Volume', 'name': 'old_name'})
+
+    def _usage_entry(self, resource_id, volume):
+        return {
+            'service': 'b1.standard',
+            'volume': volume,
+            'unit': 'gigabyte',
+            'resource_id': resource_id,
+            'tenant_id': self.project_id,
+            'start': self.start,
+            'end': self.end,
+        }
+
+    def test_usages_add(self):
+        resources = {
+            'res_1': {'name': 'new_name'},
+            'res_2': {'type': 'Volume', 'name': 'res_2_name'},
+        }
+        usage_entries = [
+            self._usage_entry('res_1', 10),
+            self._usage_entry('res_2', 20),
+        ]
+
+        db_api.usages_add(self.project_id, resources, usage_entries,
+                          self.end)
+
+        res_info = dict(
+            (res.id, json.loads(res.info)) for res in
+            db_api.resource_get_by_ids(self.project_id, ['res_1', 'res_2'])
+        )
+        self.assertEqual(
+            {
+                'res_1': {'type': 'Volume', 'name': 'new_name'},
+                'res_2': {'type': 'Volume', 'name': 'res_2_name'},
+            },
+            res_info,
+        )
+
+        usages = dict(
+            (entry.resource_id, entry.volume) for entry in
+            db_api.usage_get(self.project_id, self.start, self.end)
+        )
+        self.assertEqual({'res_1': 10, 'res_2': 20}, usages)
+
+        self.assertEqual(
+            self.end,
+            db_api.project_get(self.project_id).last_collected,
+        )
+
+    def test_usages_add_already_collected(self):
+        resources = {'res_2': {'type': 'Volume', 'name': 'res_2_name'}}
+        usage_entries = [self._usage_entry('res_2', 20)]
+
+        # The window was collected in the meantime.
+        db_api.usages_add(self.project_id, {}, [], self.end)
+
+        self.assertRaises(
+            exceptions.DuplicateException,
+            db_api.usages_add,
+            self.project_id, resources, usage_entries,
+            self.end + timedelta(hours=1), self.start,
+        )
+
+        self.assertEqual(
+            [], db_api.resource_get_by_ids(self.project_id, ['res_2']))
+        self.assertEqual(
+            self.end,
+            db_api.project_get(self.project_id).last_collected,
+        )
+
+        db_api.usages_add(self.project_id, resources, usage_entries,
+                          self.end + timedelta(hours=1), self.end)
+        self.assertEqual(
+            self.end + timedelta(hours=1),
+            db_api.project_get(self.project_id).last_collected,
+        )
+
+    def test_projects_rewind(self):
+        db_api.usages_add(self.project_id, {},
+                          [self._usage_entry('res_1', 10)], self.end)
+
+        db_api.projects_rewind([self.project_id], self.start)
+
+        self.assertEqual(
+            [], db_api.usage_get(self.project_id, self.start, self.end))
+        self.assertEqual(
+            self.start,
+            db_api.project_get(self.project_id).last_collected,
+        )
+
+        # Projects not collected past the given time are left as they are.
+        db_api.projects_rewind([self.project_id], self.end)
+        self.assertEqual(
+            self.start,
+            db_api.project_get(self.project_id).last_collected,
+        )
+
+    def test_usages_add_rollback(self):
+        resources = {'res_2': {'type': 'Volume', 'name': 'res_2_name'}}
+        # Duplicate usage entries violate the primary key constraint.
+        usage_entries = [
+            self._usage_entry('res_2', 20),
+            self._usage_entry('res_2', 20),
+        ]
+        last_collected = db_api.project_get(self.project_id).last_collected
+
+        self.assertRaises(
+            exceptions.DBException,
+            db_api.usages_add,
+            self.project_id, resources, usage_entries, self.end,
+        )
+
+        # Nothing has been written.
+        self.assertEqual(
+            [], db_api.resource_get_by_ids(self.project_id, ['res_2']))
+        self.assertEqual(
+            [], db_api.usage_get(self.project_id, self.start, self.end))
+        self.assertEqual(
+            last_collected,
+            db_api.project_get(self.project_id).last_collected,
+        )
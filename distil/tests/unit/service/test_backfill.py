@@ -0,0 +1,175 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from datetime import timedelta
+
+import mock
+
+from distil.db.sqlalchemy import api as db_api
+from distil import exceptions as exc
+from distil.service import backfill
+from distil.tests.unit import base
+
+END = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+PROJECTS = [
+    {'id': '111', 'name': 'project_1', 'description': ''},
+    {'id': '222', 'name': 'project_2', 'description': ''},
+]
+
+
+class BackfillTest(base.DistilWithDbTestCase):
+    def setUp(self):
+        super(BackfillTest, self).setUp()
+
+        # Windows fail once when listed here.
+        self.failing = set()
+        self.collected = []
+
+        patcher = mock.patch('distil.service.backfill.driver.DriverManager')
+        mock_driver = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_driver.return_value.driver.collect_usage.side_effect = (
+            self._collect_usage)
+
+        db_api.project_add(PROJECTS[0], END - timedelta(hours=5))
+
+    def _collect_usage(self, project, windows, check_last_collected=False):
+        for start, end in windows:
+            if (project['id'], start) in self.failing:
+                self.failing.remove((project['id'], start))
+                return False
+            db_api.usages_add(project['id'], {}, [], end, start)
+        self.collected.append((project['id'], len(windows)))
+        return True
+
+    def _last_collected(self):
+        return dict(db_api.get_last_collected_all())
+
+    def test_backfill(self):
+        ret = backfill.Backfill(PROJECTS, END, start=END - timedelta(hours=3),
+                                span_windows=2).run()
+
+        self.assertTrue(ret)
+        # The spans of each project are collected in order, and the new
+        # project starts from the given start.
+        self.assertEqual(
+            [('111', 2), ('111', 2), ('111', 1), ('222', 2), ('222', 1)],
+            self.collected,
+        )
+        self.assertEqual({'111': END, '222': END}, self._last_collected())
+
+    def test_backfill_resume(self):
+        self.failing.add(('111', END - timedelta(hours=2)))
+
+        ret = backfill.Backfill(PROJECTS[:1], END, span_windows=2).run()
+
+        # The project stops at the failed window, without trying the
+        # following spans.
+        self.assertFalse(ret)
+        self.assertEqual([('111', 2)], self.collected)
+        self.assertEqual(END - timedelta(hours=2),
+                         self._last_collected()['111'])
+
+        ret = backfill.Backfill(PROJECTS[:1], END, span_windows=2).run()
+
+        # The backfill carries on from the failed window.
+        self.assertTrue(ret)
+        self.assertEqual([('111', 2), ('111', 2)], self.collected)
+        self.assertEqual(END, self._last_collected()['111'])
+
+    def test_backfill_rerate(self):
+        db_api.usages_add(
+            '111', {'res_1': {'type': 'Volume'}},
+            [{'service': 'b1.standard', 'volume': 1, 'unit': 'gigabyte',
+              'resource_id': 'res_1', 'tenant_id': '111',
+              'start': END - timedelta(hours=2),
+              'end': END - timedelta(hours=1)}],
+            END,
+        )
+
+        ret = backfill.Backfill(PROJECTS[:1], END,
+                                start=END - timedelta(hours=2),
+                                span_windows=2, rerate=True).run()
+
+        self.assertTrue(ret)
+        self.assertEqual([('111', 2)], self.collected)
+        self.assertEqual(
+            [], db_api.usage_get('111', END - timedelta(hours=2), END))
+
+    def test_backfill_misaligned(self):
+        self.override_config('collector', collect_window=2)
+        start = datetime(2017, 2, 27, 1)
+
+        # With --rerate, windows from a misaligned start would overlap the
+        # usage already collected before it.
+        self.assertRaises(exc.DateTimeException, backfill.Backfill,
+                          PROJECTS, datetime(2017, 2, 28), start=start,
+                          rerate=True)
+        self.assertRaises(exc.DateTimeException, backfill.Backfill,
+                          PROJECTS, start)
+        self.assertRaises(exc.DateTimeException, backfill.Backfill,
+                          PROJECTS, datetime(2017, 2, 28, 0, 30))
+
+        backfill.Backfill(PROJECTS, datetime(2017, 2, 28),
+                          start=datetime(2017, 2, 27, 2), rerate=True)
+
+    # NOTE: The in-memory test database must not be disposed of.
+    @mock.patch('distil.common.openstack.reset_clients')
+    @mock.patch('distil.db.api.dispose_engine')
+    @mock.patch('multiprocessing.Pool')
+    def test_backfill_workers(self, mock_pool, mock_dispose_engine,
+                              mock_reset_clients):
+        mock_pool.return_value = backfill._InlinePool()
+
+        ret = backfill.Backfill(PROJECTS, END, span_windows=5,
+                                workers=2).run()
+
+        self.assertTrue(ret)
+        self.assertEqual({'111': END, '222': END}, self._last_collected())
+        # The connections of the parent are not shared with the workers.
+        mock_dispose_engine.assert_called_once_with()
+        mock_reset_clients.assert_called_once_with()
+        mock_pool.assert_called_once_with(
+            2, initializer=backfill._init_worker)
+
+    @mock.patch.object(backfill, '_POLL_INTERVAL', 0.01)
+    @mock.patch('distil.service.backfill._collect_span')
+    def test_backfill_worker_error(self, mock_collect_span):
+        # The span raises out of the worker, without giving a result.
+        mock_collect_span.side_effect = Exception('Result not sent back')
+
+        ret = backfill.Backfill(PROJECTS[:1], END, span_windows=2).run()
+
+        self.assertFalse(ret)
+        self.assertEqual(1, mock_collect_span.call_count)
+        self.assertEqual(END - timedelta(hours=5),
+                         self._last_collected()['111'])
+
+    @mock.patch.object(backfill, '_POLL_INTERVAL', 0.01)
+    @mock.patch('distil.db.api.dispose_engine')
+    @mock.patch('multiprocessing.Pool')
+    def test_backfill_span_timeout(self, mock_pool, mock_dispose_engine):
+        # The worker died, so the span never finishes.
+        pool = mock_pool.return_value
+        pool.apply_async.return_value.ready.return_value = False
+
+        ret = backfill.Backfill(PROJECTS[:1], END, span_windows=2, workers=2,
+                                span_timeout=0.05).run()
+
+        self.assertFalse(ret)
+        pool.terminate.assert_called_once_with()
+        pool.close.assert_not_called()
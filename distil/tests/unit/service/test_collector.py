@@ -24,7 +24,10 @@ import mock
 
 from distil.collector import base as collector_base
 from distil.common import constants
+from distil.common import general
+from distil.common import hashring
 from distil.db.sqlalchemy import api as db_api
+from distil import exceptions
 from distil.helpers import get_max_last_collected
 from distil.service import collector
 from distil.tests.unit import base
@@ -172,6 +175,8 @@ class CollectorTest(base.DistilWithDbTestCase):
                             max_last_collected + timedelta(hours=1),
                         ),
                     ],
+                    check_last_collected=True,
+                    deadline=None,
                 ),
                 mock.call(
                     {
@@ -185,6 +190,8 @@ class CollectorTest(base.DistilWithDbTestCase):
                             max_last_collected + timedelta(hours=1),
                         ),
                     ],
+                    check_last_collected=True,
+                    deadline=None,
                 ),
             ],
             mock_collect_usage.call_args_list,
@@ -246,10 +253,14 @@ class CollectorTest(base.DistilWithDbTestCase):
                             max_last_collected + timedelta(hours=1),
                         ),
                     ],
+                    check_last_collected=True,
+                    deadline=None,
                 ),
                 mock.call(
                     project2_metadata,
                     [(current_hour - timedelta(hours=1), current_hour)],
+                    check_last_collected=True,
+                    deadline=None,
                 ),
             ],
             mock_collect_usage.call_args_list,
@@ -359,6 +370,77 @@ class CollectorTest(base.DistilWithDbTestCase):
                        for call_args in mock_get_lock.call_args_list]
         self.assertEqual(expected_list, actual_list)
 
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    @mock.patch('distil.db.api.get_project_locks')
+    def test_project_order_staleness(self, mock_get_lock, mock_get_projects,
+                                     mock_cclient):
+        self.override_config('collector', project_order='staleness')
+
+        mock_get_projects.return_value = [
+            {'id': '111', 'name': 'project_1', 'description': ''},
+            {'id': '222', 'name': 'project_2', 'description': ''},
+            {'id': '333', 'name': 'project_3', 'description': ''},
+            {'id': '444', 'name': 'project_4', 'description': ''},
+        ]
+
+        now = datetime.utcnow()
+        for project_id, hours in (('111', 2), ('222', 5), ('444', 3)):
+            db_api.project_add(
+                {
+                    'id': project_id,
+                    'name': 'project_%s' % project_id[0],
+                    'description': '',
+                },
+                now - timedelta(hours=hours)
+            )
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collect_usage()
+
+        # The new project starts from the oldest last collected time, and
+        # comes after the existing projects that are as far behind.
+        expected_list = ['222', '333', '444', '111']
+        actual_list = [call_args[0][0]
+                       for call_args in mock_get_lock.call_args_list]
+        self.assertEqual(expected_list, actual_list)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    def test_cycle_time_budget(self, mock_get_projects, mock_cclient):
+        self.override_config('collector', cycle_time_budget=60)
+
+        mock_get_projects.return_value = [
+            {'id': '111', 'name': 'project_1', 'description': ''},
+            {'id': '222', 'name': 'project_2', 'description': ''},
+            {'id': '333', 'name': 'project_3', 'description': ''},
+        ]
+
+        def _collect_usage(project, windows, check_last_collected=False,
+                           deadline=None):
+            # Collecting the second project uses up the time budget.
+            if project['id'] == '222':
+                mock_utcnow.return_value += timedelta(seconds=61)
+            return True
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collector.collect_usage.side_effect = _collect_usage
+        with mock.patch('distil.service.collector.datetime') as mock_dt:
+            mock_dt.side_effect = datetime
+            mock_dt.min = datetime.min
+            mock_dt.strptime = datetime.strptime
+            mock_utcnow = mock_dt.utcnow
+            mock_utcnow.return_value = datetime.utcnow()
+            svc.collect_usage()
+
+        self.assertEqual(
+            ['111', '222'],
+            [c[0][0]['id']
+             for c in svc.collector.collect_usage.call_args_list],
+        )
+
     @mock.patch('os.kill')
     @mock.patch('distil.common.openstack.get_ceilometer_client')
     @mock.patch('distil.common.openstack.get_projects')
@@ -391,3 +473,290 @@ class CollectorTest(base.DistilWithDbTestCase):
 
         self.assertEqual(1, srv.thread_grp.stop.call_count)
         self.assertEqual(1, mock_kill.call_count)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    def test_collect_usage_concurrently(self, mock_get_projects,
+                                        mock_cclient):
+        self.override_config('collector', collect_pool_size=3)
+
+        projects = [
+            {'id': '111', 'name': 'project_1', 'description': ''},
+            {'id': '222', 'name': 'project_2', 'description': ''},
+            {'id': '333', 'name': 'project_3', 'description': ''},
+            {'id': '444', 'name': 'project_4', 'description': ''},
+        ]
+        mock_get_projects.return_value = projects
+
+        # Insert a project in the database in order to get last_collect time.
+        db_api.project_add(
+            {
+                'id': '111',
+                'name': 'project_1',
+                'description': '',
+            },
+            datetime.utcnow() - timedelta(hours=2)
+        )
+
+        locked_projects = []
+
+        def _collect_usage(project, windows, check_last_collected=False,
+                           deadline=None):
+            # Each project must be collected while holding its own lock.
+            locks = db_api.get_project_locks(project['id'])
+            locked_projects.extend(lock.project_id for lock in locks)
+            return True
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collector.collect_usage.side_effect = _collect_usage
+        svc.collect_usage()
+
+        self.assertEqual(4, svc.collector.collect_usage.call_count)
+        self.assertEqual(['111', '222', '333', '444'],
+                         sorted(locked_projects))
+        for project in projects:
+            self.assertEqual(0, len(db_api.get_project_locks(project['id'])))
+
+    @mock.patch('os.kill')
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    @mock.patch('distil.db.api.get_project_locks')
+    def test_collect_usage_concurrently_skips_locked(self, mock_get_lock,
+                                                     mock_get_projects,
+                                                     mock_cclient,
+                                                     mock_kill):
+        end_time = datetime.utcnow() + timedelta(hours=0.5)
+        self.override_config(
+            collect_end_time=end_time.strftime("%Y-%m-%dT%H:00:00"))
+        self.override_config('collector', collect_pool_size=2)
+
+        mock_get_projects.return_value = [
+            {'id': '111', 'name': 'project_1', 'description': ''},
+            {'id': '222', 'name': 'project_2', 'description': ''},
+        ]
+        # project_2 is being processed by another collector.
+        mock_get_lock.side_effect = lambda project_id: (
+            [mock.Mock(owner='other_collector')]
+            if project_id == '222' else []
+        )
+
+        db_api.project_add(
+            {
+                'id': '111',
+                'name': 'project_1',
+                'description': '',
+            },
+            datetime.utcnow()
+        )
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.thread_grp = mock.Mock()
+        svc.collect_usage()
+
+        # The locked project is neither processed, nor does it prevent the
+        # collector from stopping once every processed project is
+        # up-to-date.
+        svc.collector.collect_usage.assert_not_called()
+        self.assertEqual(1, mock_kill.call_count)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    def test_collect_usage_leases(self, mock_get_projects, mock_cclient):
+        self.override_config('collector', project_claiming='lease',
+                             lease_batch_size=2, collect_pool_size=2)
+
+        projects = [
+            {'id': '111', 'name': 'project_1', 'description': ''},
+            {'id': '222', 'name': 'project_2', 'description': ''},
+            {'id': '333', 'name': 'project_3', 'description': ''},
+        ]
+        mock_get_projects.return_value = projects
+
+        db_api.project_add(
+            {
+                'id': '111',
+                'name': 'project_1',
+                'description': '',
+            },
+            datetime.utcnow() - timedelta(hours=2)
+        )
+        # project_2 is leased by another collector.
+        db_api.claim_projects(['222'], 'other_collector', 1, 600)
+
+        leased_projects = []
+
+        def _collect_usage(project, windows, check_last_collected=False,
+                           deadline=None):
+            # Each project must be collected while holding its lease.
+            leases = db_api.get_project_leases([project['id']])
+            leased_projects.extend(
+                lease.project_id for lease in leases
+                if lease.owner == svc.identifier)
+            return True
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collector.collect_usage.side_effect = _collect_usage
+        with mock.patch('distil.db.api.claim_projects',
+                        side_effect=db_api.claim_projects) as mock_claim:
+            svc.collect_usage()
+
+        # Projects are claimed in batches of lease_batch_size.
+        self.assertEqual(2, mock_claim.call_count)
+        self.assertEqual(['111', '333'], sorted(leased_projects))
+        owners = dict(
+            (lease.project_id, lease.owner)
+            for lease in db_api.get_project_leases(['111', '222', '333'])
+        )
+        # The leases are released after collection, apart from the one
+        # held by the other collector.
+        self.assertEqual(
+            {'111': None, '222': 'other_collector', '333': None}, owners)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    def test_collect_usage_shard(self, mock_get_projects, mock_cclient):
+        identifier = general.get_process_identifier()
+        members = [identifier, 'other_collector']
+        self.override_config('collector', shard_members=members)
+
+        projects = [
+            {'id': 'project_%s' % i, 'name': 'project_%s' % i,
+             'description': ''}
+            for i in range(20)
+        ]
+        mock_get_projects.return_value = projects
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collector.collect_usage.return_value = True
+        svc.collect_usage()
+
+        ring = hashring.HashRing(members)
+        expected = [p['id'] for p in projects
+                    if ring.get_member(p['id']) == identifier]
+        self.assertTrue(0 < len(expected) < len(projects))
+        self.assertEqual(
+            expected,
+            [c[0][0]['id']
+             for c in svc.collector.collect_usage.call_args_list],
+        )
+
+    def test_shard_members_without_collector(self):
+        self.override_config('collector', shard_members=['other_collector'])
+
+        self.assertRaises(exceptions.InvalidConfig,
+                          collector.CollectorService)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    def test_collect_usage_shard_db_members(self, mock_get_projects,
+                                            mock_cclient):
+        self.override_config('collector', shard_membership='db')
+        mock_get_projects.return_value = [
+            {'id': 'project_%s' % i, 'name': 'project_%s' % i,
+             'description': ''}
+            for i in range(20)
+        ]
+        db_api.collector_member_heartbeat('other_collector')
+        # A member not seen within shard_member_timeout has left.
+        db_api.collector_member_heartbeat('stopped_collector')
+        session = db_api.get_session()
+        session.execute(
+            db_api.CollectorMember.__table__.update().
+            where(db_api.CollectorMember.__table__.c.name ==
+                  'stopped_collector').
+            values(last_seen=datetime.utcnow() - timedelta(days=1))
+        )
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collector.collect_usage.return_value = True
+        svc.collect_usage()
+
+        ring = hashring.HashRing([svc.identifier, 'other_collector'])
+        self.assertEqual(
+            sorted(p['id'] for p in mock_get_projects.return_value
+                   if ring.get_member(p['id']) == svc.identifier),
+            sorted(c[0][0]['id']
+                   for c in svc.collector.collect_usage.call_args_list),
+        )
+
+        svc.thread_grp = None
+        svc.stop()
+        self.assertNotIn(
+            svc.identifier,
+            db_api.collector_member_get_all(datetime(1970, 1, 1)),
+        )
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    def test_collect_usage_tenant_snapshot(self, mock_get_projects,
+                                           mock_cclient):
+        mock_get_projects.return_value = [
+            {'id': '111', 'name': 'project_1', 'description': ''},
+            {'id': '222', 'name': 'project_2', 'description': ''},
+            {'id': '333', 'name': 'project_3', 'description': ''},
+        ]
+        db_api.project_add(
+            {
+                'id': '111',
+                'name': 'project_1',
+                'description': '',
+            },
+            datetime.utcnow() - timedelta(hours=2)
+        )
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collector.collect_usage.return_value = True
+        with mock.patch('distil.db.api.project_add') as mock_project_add, \
+                mock.patch('distil.db.api.projects_add',
+                           side_effect=db_api.projects_add) as mock_add:
+            svc.collect_usage()
+
+        # The new projects are added at once, and no project is looked up
+        # on its own.
+        mock_project_add.assert_not_called()
+        self.assertEqual(1, mock_add.call_count)
+        self.assertEqual(['222', '333'],
+                         [p['id'] for p in mock_add.call_args[0][0]])
+        self.assertEqual(3, svc.collector.collect_usage.call_count)
+
+    @mock.patch('distil.common.openstack.get_ceilometer_client')
+    @mock.patch('distil.common.openstack.get_projects')
+    def test_collect_usage_skip_idle_projects(self, mock_get_projects,
+                                              mock_cclient):
+        self.override_config('collector', skip_idle_projects=True,
+                             max_windows_per_cycle=2)
+
+        mock_get_projects.return_value = [
+            {'id': '111', 'name': 'project_1', 'description': ''},
+            {'id': '222', 'name': 'project_2', 'description': ''},
+        ]
+        end = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        start = end - timedelta(hours=2)
+        db_api.projects_add(
+            [
+                {'id': '111', 'name': 'project_1', 'description': ''},
+                {'id': '222', 'name': 'project_2', 'description': ''},
+            ],
+            start,
+        )
+
+        svc = collector.CollectorService()
+        svc.collector = mock.Mock()
+        svc.collector.get_active_projects.return_value = set(['111'])
+        svc.collector.collect_usage.return_value = True
+        svc.collect_usage()
+
+        svc.collector.get_active_projects.assert_called_once_with(start, end)
+        self.assertEqual(
+            ['111'],
+            [c[0][0]['id']
+             for c in svc.collector.collect_usage.call_args_list],
+        )
+        # The idle project is up-to-date without collecting its usage.
+        self.assertEqual(end, db_api.project_get('222').last_collected)
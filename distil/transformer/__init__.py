@@ -21,7 +21,9 @@ from distil.common import general
 class BaseTransformer(object):
 
     def __init__(self, name, override_config=None):
-        self.config = general.get_transformer_config(name)
+        # NOTE: Copy the shared config, so that the overrides of one
+        # transformer instance do not leak into the others.
+        self.config = dict(general.get_transformer_config(name))
         if override_config:
             self.config.update(override_config)
 
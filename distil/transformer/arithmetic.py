@@ -13,12 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import datetime
-
 from oslo_log import log as logging
 
 from distil.transformer import BaseTransformer
 from distil.common import constants
+from distil.common import general
 from distil.common import openstack
 
 LOG = logging.getLogger(__name__)
@@ -148,17 +147,13 @@ class SumTransformer(BaseTransformer):
     """
 
     def _transform_usage(self, meter_name, raw_data, start_at, end_at):
+        start = general.to_epoch_us(start_at)
+        end = general.to_epoch_us(end_at)
+
         sum_vol = 0
         for sample in raw_data:
-            try:
-                t = datetime.datetime.strptime(sample['timestamp'],
-                                               '%Y-%m-%dT%H:%M:%S.%f')
-            except ValueError:
-                # In case of u'timestamp': u'2016-08-04T11:35:00',
-                t = datetime.datetime.strptime(sample['timestamp'],
-                                               '%Y-%m-%dT%H:%M:%S')
-
-            if t >= start_at and t < end_at:
+            t = general.parse_timestamp(sample['timestamp'])
+            if t >= start and t < end:
                 sum_vol += sample["volume"] or 0
 
         return {meter_name: sum_vol}
@@ -0,0 +1,82 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the meter mapping filters and volume sources on samples.
+
+Prints the samples pre-processed per second, as in _transform_usages, with
+the expressions given as strings (searched with jmespath.search, as before
+meter mappings were compiled) and compiled with jmespath.compile.
+
+Usage: python tools/benchmark_sample_filters.py [resources] [samples]
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+import jmespath
+
+from distil.collector.base import BaseCollector
+
+FILTERS = (
+    "metadata.status == 'active'",
+    "contains(['nova', 'cinder'], metadata.service)",
+)
+VOLUME_SOURCE = "metadata.size"
+
+
+def _get_samples(resources, samples):
+    return [
+        {
+            'resource_id': 'resource-%s' % r,
+            'volume': 1,
+            'metadata': {
+                'status': 'active' if s % 10 else 'deleted',
+                'service': 'nova',
+                'size': s,
+            },
+        }
+        for r in range(resources)
+        for s in range(samples)
+    ]
+
+
+def _preprocess(samples, filters, volume_source):
+    entries = (sample for sample in samples
+               if BaseCollector._sample_filter(filters, sample))
+    return list(BaseCollector._sample_volumes(entries, volume_source))
+
+
+def main():
+    resources = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    samples = _get_samples(resources, count)
+
+    print('%-12s %14s' % ('expressions', 'samples/s'))
+    for name, filters, volume_source in (
+        ('string', FILTERS, VOLUME_SOURCE),
+        ('compiled', tuple(jmespath.compile(f) for f in FILTERS),
+         jmespath.compile(VOLUME_SOURCE)),
+    ):
+        duration = min(timeit.repeat(
+            lambda: _preprocess(samples, filters, volume_source),
+            number=1, repeat=5,
+        ))
+        print('%-12s %14.0f' % (name, len(samples) / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Copyright (C) 2013-2024 Catalyst Cloud Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the transformers on the samples of a resource.
+
+Prints the samples transformed per second by each transformer, to compare
+against alternative transform paths (e.g. the removed columnar path, which
+was slower for all of them but sum on long sample series).
+
+Usage: python tools/benchmark_transformers.py [samples] [repeat]
+"""
+
+from __future__ import print_function
+
+from datetime import datetime
+from datetime import timedelta
+import os
+import sys
+import timeit
+
+from oslo_config import cfg
+
+from distil import config  # noqa: F401, registers the collector options
+from distil.common import constants
+from distil.transformer import get_transformer
+
+CONF = cfg.CONF
+
+TRANSFORMERS = ('max', 'numbool', 'sum', 'networkservice')
+
+
+def _get_samples(count, start, end):
+    """Get samples of a resource evenly spread over the window."""
+    step = (end - start).total_seconds() / count
+    return [
+        {
+            'resource_id': 'resource',
+            'timestamp': (start + timedelta(seconds=i * step)).strftime(
+                constants.date_format_f),
+            'volume': i % 2,
+            'metadata': {'status': 'active'},
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    CONF([], project='distil')
+    CONF.set_override(
+        'transformer_file',
+        os.path.join(os.path.dirname(__file__), os.pardir, 'etc',
+                     'transformer.yaml.sample'),
+        group='collector',
+    )
+
+    end = datetime(2017, 2, 27, 1)
+    start = end - timedelta(hours=1)
+    samples = _get_samples(count, start, end)
+
+    print('%-16s %14s' % ('transformer', 'samples/s'))
+    for name in TRANSFORMERS:
+        transformer = get_transformer(name)
+        duration = timeit.timeit(
+            lambda: transformer.transform_usage(name, samples, start, end),
+            number=repeat,
+        )
+        print('%-16s %14.0f' % (name, count * repeat / duration))
+
+
+if __name__ == '__main__':
+    main()